@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+Times a rerun_workflow.py sweep over synthetic workflow trees.
+
+For every requested size a tree of job directories is generated with a mix
+of converged, unconverged (electronic), fizzled, queued and not yet started
+jobs, multi-step jobs among them, vasprun.xml files padded to a realistic
+size and backup/N folders. Queued jobs are held in the SLURM emulator, which
+is put first on PATH so every squeue call is a real subprocess. Submissions
+are recorded instead of run unless --submit is given.
+
+check_num_jobs_in_workflow, vasp_run_main and driver() are timed separately,
+with a per-function breakdown (inclusive times, so nested calls are counted
+in both the caller and the callee). Results are written as json and checked
+against benchmarks/thresholds.json, and against a previous results file with
+--baseline; the exit code is 1 if anything regressed.
+
+    sweep_benchmark.py --sizes 100 1000 --baseline benchmarks/results/sweep_abc1234.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import warnings
+import contextlib
+import subprocess
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+WORKFLOW_PATH = os.path.dirname(BENCHMARK_PATH)
+sys.path.insert(0, WORKFLOW_PATH)
+from slurm_emulator import mock_vasp
+from slurm_emulator.emulator import EmulatedSlurm
+
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+DEFAULT_MIX = {'converged': 0.5, 'electronic': 0.15, 'fizzled': 0.1,
+               'queued': 0.2, 'new': 0.05}
+MULTI_STEP_FRACTION = 0.2
+TIMED_FUNCTIONS = ['jobs_in_queue', 'get_job_name', 'is_converged', 'fizzled_job',
+                   'rerun_job', 'store_data', 'Vasprun', 'replace_incar_tags',
+                   'check_vasp_input']
+PHASES = ['check_num_jobs_in_workflow', 'vasp_run_main', 'driver']
+POSCAR = '''{name}
+1.0
+5.9 0.0 0.0
+0.0 5.9 0.0
+0.0 0.0 5.9
+Cs Pb Br
+1 1 3
+Direct
+0.5 0.5 0.5
+0.0 0.0 0.0
+0.5 0.0 0.0
+0.0 0.5 0.0
+0.0 0.0 0.5
+'''
+CONVERGENCE = '\n0 Step\n\nNSW = 99\n\n1 Step\n\nEDIFF = 1e-08\nNSW = 0\n'
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES[:2],
+                        help='number of job directories per tree (suite: %s)' %
+                             ' '.join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument('--vasprun-kb', type=int, default=256,
+                        help='approximate size of every vasprun.xml in kB')
+    parser.add_argument('--max-backups', type=int, default=3,
+                        help='each job gets 0 to max-backups backup/N folders')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', type=str,
+                        help='where trees are generated (default: a temporary directory)')
+    parser.add_argument('--output', type=str,
+                        help='results json (default benchmarks/results/sweep_<commit>.json)')
+    parser.add_argument('--baseline', type=str, help='results json to compare against')
+    parser.add_argument('--thresholds', type=str,
+                        default=os.path.join(BENCHMARK_PATH, 'thresholds.json'))
+    parser.add_argument('--submit', action='store_true',
+                        help='really run vasp.py for resubmissions instead of recording them')
+    return parser.parse_args()
+
+
+def git_commit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=WORKFLOW_PATH,
+                            capture_output=True, text=True)
+    return result.stdout.strip() or 'unknown'
+
+
+def write_file(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def make_prototypes(prototype_dir, vasprun_kb):
+    """
+    Runs the mock VASP once per outcome, job directories are filled with copies
+    Returns: {outcome: directory holding its output files}
+    """
+    ionic_steps = 4
+    os.environ['MOCK_VASP_PAD_KB'] = str(max(0, vasprun_kb // ionic_steps - 8))
+    prototypes = {}
+    for outcome in ['converged', 'electronic', 'fizzled']:
+        directory = os.path.join(prototype_dir, outcome)
+        os.makedirs(directory)
+        write_file(os.path.join(directory, 'POSCAR'), POSCAR.format(name='CsPbBr3'))
+        write_file(os.path.join(directory, 'INCAR'), 'NSW = 5\nIBRION = 2\nNELM = 60\n')
+        random.seed(outcome)
+        mock_vasp.write_outputs(directory, outcome)
+        prototypes[outcome] = directory
+    del os.environ['MOCK_VASP_PAD_KB']
+    return prototypes
+
+
+def generate_tree(root, n_jobs, prototypes, max_backups, rng, mix=DEFAULT_MIX):
+    """
+    Returns: {category: list of job directories}
+    """
+    os.makedirs(root)
+    write_file(os.path.join(root, 'WORKFLOW_NAME'), 'NAME = bench_%d' % n_jobs)
+    categories = {category: [] for category in mix}
+    names = list(mix.keys())
+    weights = list(mix.values())
+    for i in range(n_jobs):
+        category = rng.choices(names, weights)[0]
+        # the same three levels WriteVaspFiles writes: structure/magnetism/calculation
+        job_dir = os.path.join(root, 'CsPbBr3_%d' % (i // 100), 'FM_%d' % (i % 100 // 10),
+                               'job_%d' % i)
+        os.makedirs(job_dir)
+        name = 'bench-%d' % i
+        incar = 'SYSTEM = %s\nNSW = 5\nIBRION = 2\nNELM = 60\nNPAR = 1\n' % name
+        if rng.random() < MULTI_STEP_FRACTION:
+            incar += 'STAGE_NUMBER = 1\n'
+            write_file(os.path.join(job_dir, 'CONVERGENCE'), CONVERGENCE)
+        write_file(os.path.join(job_dir, 'INCAR'), incar)
+        write_file(os.path.join(job_dir, 'POSCAR'), POSCAR.format(name=name))
+        write_file(os.path.join(job_dir, 'KPOINTS'), 'Automatic\n0\nGamma\n4 4 4\n')
+        write_file(os.path.join(job_dir, 'POTCAR'), '  PAW_PBE Cs_sv 08Apr2002\n')
+        outcome = {'queued': 'converged', 'new': None}.get(category, category)
+        if outcome is not None:
+            for file_name in ['vasprun.xml', 'OUTCAR', 'OSZICAR', 'CONTCAR']:
+                shutil.copyfile(os.path.join(prototypes[outcome], file_name),
+                                os.path.join(job_dir, file_name))
+            for b in range(rng.randint(0, max_backups)):
+                backup_dir = os.path.join(job_dir, 'backup', str(b))
+                os.makedirs(backup_dir)
+                for file_name in ['OUTCAR', 'POSCAR', 'INCAR', 'KPOINTS']:
+                    shutil.copyfile(os.path.join(job_dir, file_name),
+                                    os.path.join(backup_dir, file_name))
+        categories[category].append(job_dir)
+    return categories
+
+
+class Timers:
+    # wraps functions in rerun_workflow's namespace and accumulates their time
+    def __init__(self, module, names):
+        self.module = module
+        self.originals = {name: getattr(module, name) for name in names}
+        self.stats = {name: {'seconds': 0.0, 'calls': 0} for name in names}
+
+    def wrap(self, name, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stats[name]['seconds'] += time.perf_counter() - start
+                self.stats[name]['calls'] += 1
+        return timed
+
+    def __enter__(self):
+        for name, function in self.originals.items():
+            setattr(self.module, name, self.wrap(name, function))
+        return self
+
+    def __exit__(self, *exc):
+        for name, function in self.originals.items():
+            setattr(self.module, name, function)
+
+    def summary(self):
+        return {name: {'seconds': round(s['seconds'], 4), 'calls': s['calls']}
+                for name, s in self.stats.items() if s['calls'] > 0}
+
+
+def timed_call(function, *args):
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_size(rerun_workflow, workdir, n_jobs, prototypes, args):
+    rng = random.Random(args.seed + n_jobs)
+    root = os.path.join(workdir, 'tree_%d' % n_jobs)
+    start = time.perf_counter()
+    categories = generate_tree(root, n_jobs, prototypes, args.max_backups, rng)
+    EmulatedSlurm().hold_jobs(categories['queued'])
+    generate_seconds = time.perf_counter() - start
+
+    submissions = []
+    if not args.submit:
+        rerun_workflow.rerun_job = lambda job_type, job_name: submissions.append(job_type)
+
+    result = {'jobs': n_jobs,
+              'categories': {c: len(d) for c, d in categories.items()},
+              'generate_seconds': round(generate_seconds, 3)}
+    cwd = os.getcwd()
+    try:
+        os.chdir(root)
+        n_found, seconds = timed_call(rerun_workflow.check_num_jobs_in_workflow, root)
+        result['jobs_found'] = n_found
+        result['check_num_jobs_in_workflow'] = round(seconds, 4)
+
+        with Timers(rerun_workflow, TIMED_FUNCTIONS) as timers:
+            entries, seconds = timed_call(rerun_workflow.vasp_run_main, root)
+        os.chdir(root)
+        result['vasp_run_main'] = round(seconds, 4)
+        result['vasp_run_main_breakdown'] = timers.summary()
+        result['converged_entries'] = len(entries)
+        result['submissions'] = {t: submissions.count(t) for t in set(submissions)}
+
+        with Timers(rerun_workflow, ['check_num_jobs_in_workflow', 'vasp_run_main']) as timers:
+            dummy, seconds = timed_call(rerun_workflow.driver)
+        os.chdir(root)
+        result['driver'] = round(seconds, 4)
+        phases = timers.summary()
+        phases['write_results'] = {'seconds': round(seconds - sum(
+            p['seconds'] for p in phases.values()), 4), 'calls': 1}
+        result['driver_phases'] = phases
+    finally:
+        os.chdir(cwd)
+    return result
+
+
+def check_regressions(results, thresholds, baseline=None):
+    """
+    Returns: list of human readable regression messages, empty if none
+    """
+    problems = []
+    for size, result in results['sizes'].items():
+        for phase in PHASES:
+            per_job = result[phase] / max(result['jobs'], 1)
+            limit = thresholds['max_seconds_per_job'].get(phase)
+            if limit is not None and per_job > limit:
+                problems.append('%s jobs: %s took %.4f s per job (limit %.4f)'
+                                % (size, phase, per_job, limit))
+            if baseline is None or size not in baseline['sizes']:
+                continue
+            before = baseline['sizes'][size][phase]
+            if max(before, result[phase]) < thresholds['noise_floor_seconds']:
+                continue
+            if result[phase] > before * thresholds['max_slowdown']:
+                problems.append('%s jobs: %s %.3f s vs %.3f s at %s (x%.2f allowed)'
+                                % (size, phase, result[phase], before, baseline['commit'],
+                                   thresholds['max_slowdown']))
+    return problems
+
+
+def main():
+    args = argument_parser()
+    with open(args.thresholds) as f:
+        thresholds = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sweep_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    os.environ['PATH'] = os.path.join(WORKFLOW_PATH, 'slurm_emulator', 'bin') + os.pathsep + os.environ['PATH']
+    os.environ['SLURM_EMULATOR_DIR'] = os.path.join(workdir, 'queue')
+    os.environ.pop('VASP_SCHEDULER', None)
+    warnings.simplefilter('ignore')
+
+    from workflow_scripts import rerun_workflow
+    prototypes = make_prototypes(os.path.join(workdir, 'prototypes'), args.vasprun_kb)
+    results = {'commit': git_commit(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'host': platform.node(),
+               'vasprun_kb': args.vasprun_kb,
+               'sizes': {}}
+    for n_jobs in args.sizes:
+        print('Benchmarking %d job directories' % n_jobs)
+        result = benchmark_size(rerun_workflow, workdir, n_jobs, prototypes, args)
+        results['sizes'][str(n_jobs)] = result
+        print('  check_num_jobs_in_workflow %8.3f s' % result['check_num_jobs_in_workflow'])
+        print('  vasp_run_main              %8.3f s' % result['vasp_run_main'])
+        print('  driver                     %8.3f s' % result['driver'])
+
+    output = args.output or os.path.join(BENCHMARK_PATH, 'results',
+                                         'sweep_%s.json' % results['commit'])
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results written to ' + output)
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+    problems = check_regressions(results, thresholds, baseline)
+    for problem in problems:
+        print('REGRESSION  ' + problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
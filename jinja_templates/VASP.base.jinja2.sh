@@ -3,18 +3,27 @@
 {% if time >= 1%}#SBATCH --time={{ time }}:00:00 {% elif time < 1%}#SBATCH --time=00:{{(time*100) | int }}:00{% endif %}
 #SBATCH -o {{ name }}.o%j
 #SBATCH -e {{ name }}.e%j
-#SBATCH --tasks {{ tasks }}
+{% if shared %}#SBATCH --ntasks {{ tasks }}
+#SBATCH --mem-per-cpu={{ mem_per_cpu }}
+#SBATCH --partition={{ partition }}
+{% else %}#SBATCH --tasks {{ tasks }}
 #SBATCH --nodes {{ nodes }}
 #SBATCH --mem={{ mem }}
 #SBATCH --ntasks-per-node {{ cores }}
-#SBATCH --account={{ account }}
+{% endif %}{% if openmp > 1 %}#SBATCH --cpus-per-task {{ openmp }}
+{% endif %}{% for option in binding_sbatch %}#SBATCH {{ option }}
+{% endfor %}{% if preemptible %}#SBATCH --requeue
+#SBATCH --signal=B:USR1@{{ preempt_signal }}
+{% if preempt_partition and not shared %}#SBATCH --partition={{ preempt_partition }}
+{% endif %}{% elif scratch %}#SBATCH --signal=B:USR2@{{ scratch_signal }}
+{% endif %}#SBATCH --account={{ account }}
 {% if computer == "summit"%}#SBATCH --qos {{ queue }}
 #SBATCH --export=NONE
-#SBATCH -N {{ nodes }}
-{% elif computer == "alpine"%}#SBATCH --qos {{ queue }}
+{% if not shared %}#SBATCH -N {{ nodes }}
+{% endif %}{% elif computer == "alpine"%}#SBATCH --qos {{ queue }}
 #SBATCH --export=NONE
-#SBATCH -N {{ nodes }}
-#SBATCH --constraint=ib {% endif %}
+{% if not shared %}#SBATCH -N {{ nodes }}
+{% endif %}#SBATCH --constraint=ib {% endif %}
 {% if nodes == 1 and computer == "janus"%}#SBATCH --reservation=janus-serial {% endif %}
 
 {% elif queue_type == "pbs" %}#PBS -j eo
@@ -30,15 +39,34 @@ echo $PBS_O_WORKDIR
 {% block environment %}
 # Set Environment
 source {{ vasp_bashrc }}
-export OMP_NUM_THREADS={{ openmp }} {% endblock environment %}
+export OMP_NUM_THREADS={{ openmp }} {% for variable in binding_env %}
+export {{ variable }}{% endfor %}{% endblock environment %}
 
 {% block vasp %}
-python -c "
+{% if scratch or preemptible %}
+JOB_DIR=$(pwd)
+RUN_DIR=$JOB_DIR
+{% endif %}{% if scratch %}
+# Run in node-local scratch, results are copied back on the walltime signal and at the end
+export VASP_SCRATCH_JOB_DIR=$JOB_DIR
+export VASP_SCRATCH_INCLUDE="{{ scratch_include }}"
+export VASP_SCRATCH_EXCLUDE="{{ scratch_exclude }}"
+RUN_DIR={{ scratch_root }}/vasp_${SLURM_JOB_ID:-${PBS_JOBID:-$$}}
+python -m vasp_run.scratch stage $JOB_DIR $RUN_DIR
+trap 'python -m vasp_run.scratch copy-back $RUN_DIR $JOB_DIR' USR2
+{% endif %}{% if preemptible %}
+# Preemptible run, VASP is stopped and the job checkpointed on USR1 (walltime) or TERM (preemption)
+python -m vasp_run.preempt start $JOB_DIR
+trap 'PREEMPT_SIGNAL=USR1; python -m vasp_run.preempt stop $RUN_DIR USR1' USR1
+trap 'PREEMPT_SIGNAL=TERM; python -m vasp_run.preempt stop $RUN_DIR TERM' TERM
+{% endif %}{% if scratch %}cd $RUN_DIR
+{% endif %}python -c "
 {% block python %}
 from custodian.vasp.jobs import *
 from custodian.vasp.handlers import *
 from custodian.custodian import *
 from Classes_Custodian import *
+from vasp_run.handlers import *
 
 incar = Incar.from_file('INCAR')
 
@@ -47,7 +75,7 @@ if 'AUTO_GAMMA' in incar and incar['AUTO_GAMMA']:
 else:
     vasp = '{{ vasp_kpts }}'
 
-vaspjob = [{{ jobtype }}Job(['{{ mpi }}',{% if mpi != "srun" %} '-np', '{{ tasks }}',{% endif %} vasp], '{{ logname }}', auto_npar=False, backup=False)]
+vaspjob = [{{ jobtype }}Job(['{{ mpi }}',{% if mpi != "srun" %} '-np', '{{ tasks }}',{% endif %}{% for option in mpi_options %} '{{ option }}',{% endfor %} vasp], '{{ logname }}', auto_npar=False, backup=False)]
 
 {% if jobtype == "NEB" %}
 handlers = [WalltimeHandler({{ time }}*60*60, 15*60)]
@@ -59,9 +87,28 @@ handlers = [WalltimeHandler({{ time }}*60*60, 15*60), NEBNotTerminating('{{ logn
 {% elif jobtype == "Standard" %}
 handlers = [WalltimeHandler({{ time }}*60*60), UnconvergedErrorHandler()]
 {% endif %}
-
+handlers.append(HangHandler(**{{ hang or {} }}))
+handlers.append(ProgressHandler({{ time }}*60*60))
+{% if preemptible %}handlers.append(PreemptionHandler())
+{% endif %}
 c = Custodian(handlers, vaspjob, max_errors=1000, skip_over_errors=True)
 c.run()
 {% endblock python %}
-"
+"{% if scratch or preemptible %} &
+# wait returns when a signal arrives, keep waiting until Custodian is done
+VASP_PID=$!
+wait $VASP_PID
+while kill -0 $VASP_PID 2> /dev/null; do wait $VASP_PID; done
+cd $JOB_DIR
+{% if scratch %}python -m vasp_run.scratch copy-back $RUN_DIR $JOB_DIR
+COPIED=$?
+{% endif %}{% if preemptible %}if [ -n "$PREEMPT_SIGNAL" ]; then
+    python -m vasp_run.preempt checkpoint $RUN_DIR $JOB_DIR
+fi
+{% endif %}{% if scratch %}[ $COPIED = 0 ] && python -m vasp_run.scratch cleanup $RUN_DIR
+{% endif %}{% if preemptible %}# after a preemption Slurm requeues the job itself
+if [ "$PREEMPT_SIGNAL" = USR1 ] && [ -n "$SLURM_JOB_ID" ]; then
+    scontrol requeue $SLURM_JOB_ID
+fi
+{% endif %}{% endif %}
 {% endblock vasp %}
@@ -2,6 +2,9 @@
 {% block python %}
 from custodian.custodian import *
 from Classes_Custodian import *
+from vasp_run.handlers import *
+from vasp_run.stages import record_stage, skip_stage, finish_skipped
+from vasp_run.handoff import handoff_settings
 import Upgrade_Run
 import logging
 import copy
@@ -37,10 +40,17 @@ elif jobtype == 'Standard':
     job = StandardJob
     continuation = [{'file': 'CONTCAR',
                      'action': {'_file_copy': {'dest': 'POSCAR'}}}]
-
+handlers.append(HangHandler(**{{ hang or {} }}))
+handlers.append(ProgressHandler({{ time }}*60*60))
+{% if preemptible %}handlers.append(PreemptionHandler())
+{% endif %}
 
 def get_runs(max_steps=100):
     for i in range(max_steps):
+        if i > 0 and 'VASP_SCRATCH_JOB_DIR' in os.environ:
+            # previous stage finished in node-local scratch
+            from vasp_run import scratch
+            scratch.copy_back('.', os.environ['VASP_SCRATCH_JOB_DIR'])
         if i > 0 and ((not os.path.exists('CONTCAR') or os.path.getsize('CONTCAR') == 0) and (not os.path.exists('01/CONTCAR') or os.path.getsize('01/CONTCAR') == 0)):
             raise Exception('empty CONTCAR')
         incar = Incar.from_file('INCAR')
@@ -48,13 +58,26 @@ def get_runs(max_steps=100):
         kpoints = Kpoints.from_file('KPOINTS')
         stages = Upgrade_Run.parse_incar_update('{{ CONVERGENCE }}')
         stage_number = incar['STAGE_NUMBER']
+        if i > 0:
+            # the stage in the INCAR has just finished
+            record_stage('.', stage_number)
         if i == 0:
             settings = Upgrade_Run.parse_stage_update(stages[incar['STAGE_NUMBER']], incar)
         else:
             stage_number += 1
+            settings = []
+            # stages whose skip criteria are already met only pass on their INCAR changes
+            while stage_number < len(stages) and skip_stage('.', stage_number, '{{ CONVERGENCE }}'):
+                settings += Upgrade_Run.parse_stage_update(stages[stage_number], incar)
+                stage_number += 1
             if stage_number >= len(stages):
+                if stage_number > incar['STAGE_NUMBER'] + 1:
+                    finish_skipped('.', len(stages) - 1)
                 break
-            settings = Upgrade_Run.parse_stage_update(stages[stage_number], incar)
+            settings += Upgrade_Run.parse_stage_update(stages[stage_number], incar)
+            settings += [{'dict': 'INCAR', 'action': {'_set': {'STAGE_NUMBER': stage_number}}}]
+            # start from the finished stage's WAVECAR or CHGCAR when the next stage can read them
+            settings += handoff_settings('.', incar, kpoints, settings, stage_number)
             settings += continuation
         if stage_number == len(stages) - 1:
             final = True
@@ -68,7 +91,7 @@ def get_runs(max_steps=100):
             vasp = os.environ['VASP_GAMMA']
         else:
             vasp = vasp_kpts
-        yield job(['{{ mpi }}',{% if mpi != "srun" %} '-np', '{{ tasks }}',{% endif %} vasp], '{{ logname }}', auto_npar=False, settings_override=settings, final=final)
+        yield job(['{{ mpi }}',{% if mpi != "srun" %} '-np', '{{ tasks }}',{% endif %}{% for option in mpi_options %} '{{ option }}',{% endfor %} vasp], '{{ logname }}', auto_npar=False, settings_override=settings, final=final)
 
 
 c = Custodian(handlers, get_runs(), max_errors=1000, skip_over_errors=True)
@@ -8,6 +8,8 @@ import numpy as np
 import copy
 from pymatgen.ext.matproj import MPRester
 from configuration.mp_api import MP_api_key
+from vasp_run import archive
+from vasp_run import compact
 from pymatgen.io.vasp import Poscar
 from pymatgen.analysis.magnetism.analyzer import \
     CollinearMagneticStructureAnalyzer
@@ -127,11 +129,36 @@ class PmgStructureObjects:
                     print('%s is not a valid mp-id' % mpid)
                     continue
 
+    def add_structure(self, structure):
+        if self.rescale == True:
+            structure = self.structure_rescaler(structure)
+        structure_key = str(structure.formula) + ' ' + str(self.structure_number)
+        self.structures_dict[structure_key] = structure
+        self.structure_number += 1
+
+    def archived_structure(self, job_dir, name):
+        # jobs packed by vasp_run.archive are read from the archive without unpacking
+        try:
+            with archive.member_path(job_dir, 'vasprun.xml') as vasprun_path, \
+                    archive.member_path(job_dir, 'OUTCAR') as outcar_path:
+                structure = get_structure_from_prev_run(Vasprun(vasprun_path), Outcar(outcar_path))
+        except KeyError:
+            try:
+                structure = Poscar.from_str(archive.read_member(job_dir, name).decode()).structure
+            except KeyError:
+                print('%s not in the archive of %s' % (name, job_dir))
+                return
+        self.add_structure(structure)
+
     def path_structures(self):
         for path in self.paths:
             parent_dir = os.path.dirname(os.path.abspath(path))
-            vasprun_path = os.path.join(parent_dir, 'vasprun.xml')
-            outcar_path = os.path.join(parent_dir, 'OUTCAR')
+            if archive.is_archived(parent_dir):
+                self.archived_structure(parent_dir, os.path.basename(path))
+                continue
+            # compacted jobs keep vasprun.xml.gz and OUTCAR.gz, which pymatgen reads as well
+            vasprun_path = compact.output_path(parent_dir, 'vasprun.xml')
+            outcar_path = compact.output_path(parent_dir, 'OUTCAR')
             if os.path.exists(vasprun_path) == True and os.path.exists(outcar_path) == True:
                 try:
                     V = Vasprun(vasprun_path)
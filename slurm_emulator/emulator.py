@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+"""
+Local SLURM emulator. sbatch, squeue, sacct and scancel in slurm_emulator/bin
+keep their queue in one json file and simulate queue waits, run times and
+job outcomes, so putting slurm_emulator/bin first on PATH lets
+rerun_workflow.py and vasp.py drive a whole workflow on a laptop.
+
+Every submitted job gets a detached runner process that sleeps through the
+simulated queue wait, runs the job and records its exit code. By default the
+runner does not execute the job script (which needs Custodian and the group
+helper scripts); it runs the mock VASP directly and walks through the stages
+of multi-step runs itself. With SLURM_EMULATOR_EXECUTE=1 the job script is
+run with bash instead, with mpirun/srun from slurm_emulator/bin forwarding
+to whatever VASP_KPTS points at (e.g. slurm_emulator/bin/mock_vasp).
+
+Environment variables:
+    SLURM_EMULATOR_DIR: queue directory (default ~/.slurm_emulator)
+    SLURM_EMULATOR_WAIT: mean simulated queue wait in seconds (default 2)
+    SLURM_EMULATOR_RUNTIME: mean simulated run time in seconds (default 2)
+    SLURM_EMULATOR_TIMEOUT_FRACTION: chance a job hits its time limit (default 0)
+    SLURM_EMULATOR_SEED: seed for reproducible waits and outcomes
+    SLURM_EMULATOR_EXECUTE: run the job script itself instead of the mock VASP
+
+sbatch --hold queues a job that stays PENDING until it is cancelled, which is
+how benchmarks fill the queue with jobs that never run
+"""
+
+import os
+import re
+import sys
+import time
+import shlex
+import random
+import getpass
+import datetime
+import subprocess
+
+# bin/ holds symlinks to this file, so resolve them to find the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from vasp_run.schedulers import LocalScheduler, FINISHED_STATES
+from slurm_emulator import mock_vasp
+
+SBATCH_OPTIONS = {'-J': 'name', '--job-name': 'name', '-t': 'time', '--time': 'time',
+                  '-N': 'nodes', '--nodes': 'nodes', '-n': 'tasks', '--ntasks': 'tasks',
+                  '--tasks': 'tasks', '--ntasks-per-node': 'tasks_per_node',
+                  '-p': 'partition', '--partition': 'partition',
+                  '-o': 'output', '--output': 'output', '-e': 'error', '--error': 'error'}
+SQUEUE_FIELDS = {'i': 'job_id', 'j': 'name', 'T': 'state', 'Z': 'cwd', 'u': 'user',
+                 'P': 'partition', 'D': 'nodes', 'l': 'time'}
+LAUNCHER_VALUE_OPTIONS = ['-np', '-n', '--ntasks', '-N', '--nodes', '-c',
+                          '--cpus-per-task', '-m', '--distribution', '--map-by',
+                          '--bind-to', '--rank-by', '-ppn', '--cpu-bind', '--hint']
+SACCT_FIELDS = ['JobID', 'JobName', 'State', 'Elapsed', 'ElapsedRaw', 'NNodes',
+                'NCPUS', 'Submit', 'Start', 'End', 'WorkDir', 'Timelimit',
+                'ExitCode', 'Partition', 'User']
+
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds).isoformat(timespec='seconds')
+
+
+def seconds_to_hms(seconds):
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def parse_sbatch_options(script_text, args=None):
+    """
+    Args:
+        script_text: job script, #SBATCH lines are read
+        args: command line options, which take priority over the script
+    Returns: dict of name, time, nodes, tasks, partition, output, error
+    """
+    words = []
+    for line in script_text.splitlines():
+        if line.startswith('#SBATCH'):
+            words += shlex.split(line[len('#SBATCH'):])
+    if args is not None:
+        words += args
+    options = {}
+    i = 0
+    while i < len(words):
+        word = words[i]
+        if '=' in word and word.startswith('--'):
+            key, value = word.split('=', 1)
+        elif i + 1 < len(words) and not words[i + 1].startswith('-'):
+            key, value = word, words[i + 1]
+            i += 1
+        else:
+            key, value = word, None
+        if key in SBATCH_OPTIONS and value is not None:
+            options[SBATCH_OPTIONS[key]] = value.strip()
+        i += 1
+    return options
+
+
+def time_limit_seconds(time_option):
+    # [D-]HH:MM:SS, HH:MM:SS, MM:SS or minutes
+    if time_option is None:
+        return None
+    days = 0
+    if '-' in time_option:
+        days, time_option = time_option.split('-')
+    parts = [int(p) for p in time_option.split(':')]
+    if len(parts) == 1:
+        seconds = parts[0] * 60
+    elif len(parts) == 2:
+        seconds = parts[0] * 60 + parts[1]
+    else:
+        seconds = parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return int(days) * 86400 + seconds
+
+
+def count_stages(convergence='CONVERGENCE'):
+    # same stage count rerun_workflow.py uses: lines like "0 Step"
+    with open(convergence) as fd:
+        pairs = (line.split(None) for line in fd)
+        return len([p for p in pairs if len(p) == 2 and p[0].isdigit()])
+
+
+def set_stage_number(incar_path, stage):
+    with open(incar_path) as f:
+        text = f.read()
+    text = re.sub(r'STAGE_NUMBER\s*=\s*\d+', 'STAGE_NUMBER = %d' % stage, text)
+    with open(incar_path, 'w') as f:
+        f.write(text)
+
+
+def simulate_job(cwd, ranks=1):
+    """
+    What the job script's Custodian loop would leave behind: runs the mock
+    VASP once, or once per remaining stage of a multi-step run, moving
+    CONTCAR to POSCAR and advancing STAGE_NUMBER between stages
+    Returns: exit code, 0 unless a run fizzled
+    """
+    incar_path = os.path.join(cwd, 'INCAR')
+    incar = mock_vasp.read_incar(incar_path)
+    stage = None
+    n_stages = 1
+    if 'STAGE_NUMBER' in incar and os.path.exists(os.path.join(cwd, 'CONVERGENCE')):
+        stage = int(incar['STAGE_NUMBER'])
+        n_stages = count_stages(os.path.join(cwd, 'CONVERGENCE'))
+    while True:
+        outcome = mock_vasp.write_outputs(cwd, ranks=ranks)
+        if outcome == 'fizzled':
+            return 1
+        if outcome != 'converged' or stage is None or stage >= n_stages - 1:
+            return 0
+        os.replace(os.path.join(cwd, 'CONTCAR'), os.path.join(cwd, 'POSCAR'))
+        stage += 1
+        set_stage_number(incar_path, stage)
+
+
+class EmulatedSlurm(LocalScheduler):
+    """
+    LocalScheduler whose jobs wait in a simulated queue and run the mock VASP
+    """
+    name = 'slurm_emulator'
+
+    def __init__(self, queue_dir=None, **kwargs):
+        if queue_dir is None:
+            queue_dir = os.environ.get('SLURM_EMULATOR_DIR',
+                                       os.path.join(os.path.expanduser('~'), '.slurm_emulator'))
+        super().__init__(queue_dir=queue_dir, max_workers=sys.maxsize, **kwargs)
+        self.mean_wait = float(os.environ.get('SLURM_EMULATOR_WAIT', 2))
+        self.mean_runtime = float(os.environ.get('SLURM_EMULATOR_RUNTIME', 2))
+        self.timeout_fraction = float(os.environ.get('SLURM_EMULATOR_TIMEOUT_FRACTION', 0))
+        self.execute = os.environ.get('SLURM_EMULATOR_EXECUTE', '0') not in ['0', '']
+        self.seed = os.environ.get('SLURM_EMULATOR_SEED')
+
+    def random(self, job_id):
+        # per-job generator so a seeded emulator replays the same waits and outcomes
+        if self.seed is None:
+            return random.Random()
+        return random.Random(int(self.seed) * 1000003 + int(job_id))
+
+    def draw(self, rng, mean):
+        return rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+
+    def expected_start(self, script_text):
+        return datetime.datetime.now() + datetime.timedelta(seconds=self.mean_wait)
+
+    def new_job(self, queue, script, cwd, options):
+        job_id = str(queue['next_id'])
+        queue['next_id'] += 1
+        now = time.time()
+        rng = self.random(job_id)
+        wait = self.draw(rng, self.mean_wait)
+        job = {'job_id': job_id,
+               'script': os.path.abspath(os.path.join(cwd, script)),
+               'cwd': os.path.abspath(cwd),
+               'name': options.get('name', os.path.basename(script)),
+               'user': getpass.getuser(),
+               'partition': options.get('partition', 'emulated'),
+               'nodes': int(options.get('nodes', 1)),
+               'tasks': int(options.get('tasks', int(options.get('nodes', 1)) *
+                                        int(options.get('tasks_per_node', 1)))),
+               'time_limit': time_limit_seconds(options.get('time')),
+               'output': options.get('output'),
+               'error': options.get('error'),
+               'state': 'PENDING',
+               'held': False,
+               'submit': timestamp(now),
+               'planned_start': now + wait,
+               'planned_runtime': self.draw(rng, self.mean_runtime),
+               'timeout': rng.random() < self.timeout_fraction}
+        queue['jobs'].append(job)
+        return job
+
+    def submit(self, script, cwd='.', args=None):
+        with open(os.path.join(cwd, script)) as f:
+            options = parse_sbatch_options(f.read(), args)
+        hold = args is not None and '--hold' in args
+        with self.locked():
+            queue = self.read_queue()
+            job = self.new_job(queue, script, cwd, options)
+            if hold:
+                job['held'] = True
+            else:
+                self.start(job)
+            self.write_queue(queue)
+        return job['job_id']
+
+    def hold_jobs(self, job_dirs, script='vasp_standard.sh'):
+        """
+        Queues one held (never starting) job per directory under a single
+        lock, much faster than sbatch --hold for thousands of directories
+        Returns: list of job ids
+        """
+        with self.locked():
+            queue = self.read_queue()
+            jobs = [self.new_job(queue, script, job_dir, {'name': os.path.basename(job_dir)})
+                    for job_dir in job_dirs]
+            for job in jobs:
+                job['held'] = True
+            self.write_queue(queue)
+        return [job['job_id'] for job in jobs]
+
+    def start(self, job):
+        # the runner sleeps through the queue wait itself, so it is started at submission
+        command = [sys.executable, os.path.realpath(__file__), 'run', self.queue_dir, job['job_id']]
+        env = dict(os.environ)
+        env['SLURM_JOB_ID'] = job['job_id']
+        env['SLURM_JOB_NAME'] = job['name']
+        env['SLURM_NTASKS'] = str(job['tasks'])
+        env['SLURM_JOB_NUM_NODES'] = str(job['nodes'])
+        env['SLURM_SUBMIT_DIR'] = job['cwd']
+        process = subprocess.Popen(command, cwd=job['cwd'], env=env,
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, start_new_session=True)
+        job['pid'] = process.pid
+
+    def refresh(self, queue):
+        now = time.time()
+        for job in queue['jobs']:
+            if job['state'] in FINISHED_STATES or job.get('held'):
+                continue
+            if os.path.exists(self.exit_file(job['job_id'])):
+                with open(self.exit_file(job['job_id'])) as f:
+                    result = f.read().split()
+                job['exit_code'] = result[0]
+                job['state'] = result[1]
+                job['start'] = timestamp(job['planned_start'])
+                job['end'] = result[2]
+            elif not self.is_alive(job['pid']):
+                job['state'] = 'NODE_FAIL'
+                job['end'] = timestamp(now)
+            elif now >= job['planned_start']:
+                job['state'] = 'RUNNING'
+                job['start'] = timestamp(job['planned_start'])
+
+    def run_job(self, job_id):
+        # body of the detached runner process
+        job = self.find_job(job_id)
+        time.sleep(max(0.0, job['planned_start'] - time.time()))
+        if self.seed is not None:
+            # the mock VASP draws its outcome from the module level generator
+            random.seed(self.random(job_id).random())
+        start = time.time()
+        output = os.path.join(job['cwd'], (job['output'] or 'slurm-%j.out').replace('%j', job_id))
+        error = os.path.join(job['cwd'], (job['error'] or job['output'] or 'slurm-%j.out').replace('%j', job_id))
+        with open(output, 'a') as out, open(error, 'a') as err:
+            if self.execute:
+                exit_code = subprocess.call(['bash', job['script']], cwd=job['cwd'],
+                                            stdout=out, stderr=err)
+            else:
+                ranks = job['tasks'] if job['tasks'] > 0 else 1
+                exit_code = simulate_job(job['cwd'], ranks)
+        time.sleep(max(0.0, job['planned_runtime'] - (time.time() - start)))
+        if job['timeout']:
+            state = 'TIMEOUT'
+        elif exit_code == 0:
+            state = 'COMPLETED'
+        else:
+            state = 'FAILED'
+        with open(self.exit_file(job_id), 'w') as f:
+            f.write('%d %s %s\n' % (exit_code, state, timestamp(time.time())))
+
+    def find_job(self, job_id):
+        # the runner can start before submit has written the job to the queue file
+        while True:
+            with self.locked():
+                for job in self.read_queue()['jobs']:
+                    if job['job_id'] == job_id:
+                        return job
+            time.sleep(0.05)
+
+    def cancel(self, job_id):
+        with self.locked():
+            queue = self.read_queue()
+            for job in queue['jobs']:
+                if job['job_id'] == str(job_id) and job['state'] not in FINISHED_STATES:
+                    try:
+                        if not job.get('held'):
+                            os.killpg(job['pid'], 15)
+                    except ProcessLookupError:
+                        pass
+                    job['state'] = 'CANCELLED'
+                    job['end'] = timestamp(time.time())
+            self.write_queue(queue)
+
+    def jobs(self):
+        return self.dispatch()['jobs']
+
+
+def job_elapsed(job):
+    if 'start' not in job:
+        return 0
+    end = job['end'] if 'end' in job else timestamp(time.time())
+    return int((datetime.datetime.fromisoformat(end) -
+                datetime.datetime.fromisoformat(job['start'])).total_seconds())
+
+
+def sbatch_main(argv):
+    options = [a for a in argv]
+    test_only = '--test-only' in options
+    if test_only:
+        options.remove('--test-only')
+    # --hold is kept in options, submit reads it from there
+    parsable = '--parsable' in options
+    if parsable:
+        options.remove('--parsable')
+    script = None
+    if len(options) > 0 and not options[-1].startswith('-') and os.path.isfile(options[-1]):
+        script = options.pop()
+    slurm = EmulatedSlurm()
+    if test_only:
+        script_text = open(script).read() if script else sys.stdin.read()
+        start = slurm.expected_start(script_text)
+        sys.stderr.write('sbatch: Job 0 to start at %s using 1 processors on nodes '
+                         'emulated1 in partition emulated\n' % start.isoformat(timespec='seconds'))
+        return 0
+    if script is None:
+        # sbatch reads the script from stdin when no file is given
+        with open('slurm_stdin.sh', 'w') as f:
+            f.write(sys.stdin.read())
+        script = 'slurm_stdin.sh'
+    job_id = slurm.submit(script, cwd='.', args=options)
+    print(job_id if parsable else 'Submitted batch job ' + job_id)
+    return 0
+
+
+def squeue_main(argv):
+    fmt = '%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R'
+    header = True
+    job_ids = None
+    i = 0
+    while i < len(argv):
+        if argv[i] in ['-h', '--noheader']:
+            header = False
+        elif argv[i] in ['-o', '--format']:
+            fmt = argv[i + 1]
+            i += 1
+        elif argv[i].startswith('--format='):
+            fmt = argv[i].split('=', 1)[1]
+        elif argv[i] in ['-j', '--jobs']:
+            job_ids = argv[i + 1].split(',')
+            i += 1
+        elif argv[i] in ['-u', '--user']:
+            i += 1
+        i += 1
+    jobs = [j for j in EmulatedSlurm().jobs() if j['state'] not in FINISHED_STATES]
+    if job_ids is not None:
+        jobs = [j for j in jobs if j['job_id'] in job_ids]
+
+    def render(job):
+        def field(match):
+            code = match.group(2)
+            if job is None:
+                return {'i': 'JOBID', 'j': 'NAME', 'T': 'STATE', 'Z': 'WORK_DIR',
+                        'u': 'USER', 'P': 'PARTITION', 'D': 'NODES', 'l': 'TIME_LIMIT',
+                        't': 'ST', 'M': 'TIME', 'R': 'NODELIST(REASON)'}.get(code, code)
+            if code in SQUEUE_FIELDS:
+                return str(job[SQUEUE_FIELDS[code]])
+            if code == 't':
+                return {'PENDING': 'PD', 'RUNNING': 'R'}.get(job['state'], 'CG')
+            if code == 'M':
+                return seconds_to_hms(job_elapsed(job))
+            if code == 'R':
+                if job['state'] == 'RUNNING':
+                    return 'emulated1'
+                return '(JobHeldUser)' if job.get('held') else '(Priority)'
+            return ''
+        return re.sub(r'%(\.?\d*)([a-zA-Z])', field, fmt)
+
+    if header:
+        print(render(None))
+    for job in jobs:
+        print(render(job))
+    return 0
+
+
+def sacct_main(argv):
+    fields = ['JobID', 'JobName', 'Partition', 'State', 'ExitCode']
+    parsable = False
+    header = True
+    job_ids = None
+    i = 0
+    while i < len(argv):
+        if argv[i] in ['-n', '--noheader']:
+            header = False
+        elif argv[i] in ['-P', '--parsable2', '-p', '--parsable']:
+            parsable = True
+        elif argv[i] in ['-o', '--format']:
+            fields = argv[i + 1].split(',')
+            i += 1
+        elif argv[i].startswith('--format='):
+            fields = argv[i].split('=', 1)[1].split(',')
+        elif argv[i] in ['-j', '--jobs']:
+            job_ids = argv[i + 1].split(',')
+            i += 1
+        elif argv[i] in ['-S', '--starttime', '-E', '--endtime', '-u', '--user']:
+            i += 1
+        i += 1
+    jobs = EmulatedSlurm().jobs()
+    if job_ids is not None:
+        jobs = [j for j in jobs if j['job_id'] in job_ids]
+
+    def value(job, field):
+        elapsed = job_elapsed(job)
+        limit = job.get('time_limit')
+        return {'JobID': job['job_id'], 'JobName': job['name'], 'State': job['state'],
+                'Elapsed': seconds_to_hms(elapsed), 'ElapsedRaw': str(elapsed),
+                'NNodes': str(job['nodes']), 'NCPUS': str(job['tasks']),
+                'Submit': job['submit'], 'Start': job.get('start', 'Unknown'),
+                'End': job.get('end', 'Unknown'), 'WorkDir': job['cwd'],
+                'Timelimit': seconds_to_hms(limit) if limit else 'UNLIMITED',
+                'ExitCode': job.get('exit_code', '0') + ':0',
+                'Partition': job['partition'], 'User': job['user']}.get(field, '')
+
+    rows = []
+    if header:
+        rows.append(fields)
+    rows += [[value(job, f) for f in fields] for job in jobs]
+    for row in rows:
+        print('|'.join(row) if parsable else ' '.join('%-12s' % v for v in row))
+    return 0
+
+
+def scancel_main(argv):
+    slurm = EmulatedSlurm()
+    for job_id in argv:
+        if not job_id.startswith('-'):
+            slurm.cancel(job_id)
+    return 0
+
+
+def launcher_main(argv):
+    # mpirun -np N / srun [options] executable: run the executable once,
+    # telling the mock VASP how many ranks it was given
+    env = dict(os.environ)
+    ranks = env.get('SLURM_NTASKS', '1')
+    i = 0
+    while i < len(argv) and argv[i].startswith('-'):
+        if argv[i] in ['-np', '-n', '--ntasks']:
+            ranks = argv[i + 1]
+        elif argv[i].startswith('--ntasks='):
+            ranks = argv[i].split('=', 1)[1]
+        if argv[i] in LAUNCHER_VALUE_OPTIONS:
+            i += 1
+        i += 1
+    env['MOCK_VASP_RANKS'] = ranks
+    return subprocess.call(argv[i:], env=env)
+
+
+COMMANDS = {'sbatch': sbatch_main, 'squeue': squeue_main, 'sacct': sacct_main,
+            'scancel': scancel_main, 'mpirun': launcher_main, 'srun': launcher_main}
+
+
+if __name__ == '__main__':
+    # called through a bin/ symlink (bin/sbatch ...) or as emulator.py <command> ...
+    command = os.path.basename(sys.argv[0])
+    argv = sys.argv[1:]
+    if command not in COMMANDS:
+        command = argv.pop(0)
+    if command == 'run':
+        EmulatedSlurm(argv[0]).run_job(argv[1])
+    else:
+        sys.exit(COMMANDS[command](argv))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+Mock VASP binary. Reads INCAR and POSCAR from the working directory and
+writes a small but pymatgen-readable vasprun.xml together with OSZICAR,
+OUTCAR and CONTCAR, without doing any physics.
+
+The outcome of each run is random unless a MOCK_VASP_OUTCOME file in the
+directory (or the environment variable of the same name) fixes it:
+    converged:   electronic and ionic convergence
+    electronic:  final ionic step hits NELM
+    ionic:       relaxation runs out of NSW ionic steps
+    fizzled:     vasprun.xml is cut off mid-file
+Environment variables:
+    MOCK_VASP_CONVERGED_FRACTION: chance of a converged run (default 0.8)
+    MOCK_VASP_FIZZLE_FRACTION: chance of a fizzled run (default 0.05)
+    MOCK_VASP_SCF_TIME: seconds per SCF step on one rank reported in OUTCAR (default 2)
+    MOCK_VASP_SERIAL_FRACTION: Amdahl serial fraction for the reported timings (default 0.05)
+    MOCK_VASP_RANKS: MPI ranks, set by the emulator's mpirun/srun
+    OMP_NUM_THREADS: threads per rank, the reported timings scale with ranks * threads
+    MOCK_VASP_SLEEP: seconds to really sleep per ionic step (default 0)
+    MOCK_VASP_PAD_KB: kB of eigenvalue padding per ionic step, for realistic
+                      vasprun.xml sizes (default 0)
+"""
+
+import os
+import sys
+import time
+import random
+
+OUTCOMES = ['converged', 'electronic', 'ionic', 'fizzled']
+
+
+def read_incar(path='INCAR'):
+    # plain KEY = VALUE parsing, enough for the tags the mock cares about
+    incar = {}
+    if not os.path.exists(path):
+        return incar
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].split('!')[0]
+            for statement in line.split(';'):
+                if '=' in statement:
+                    key, value = statement.split('=', 1)
+                    incar[key.strip().upper()] = value.strip()
+    return incar
+
+
+def incar_int(incar, tag, default):
+    try:
+        return int(float(incar.get(tag, default)))
+    except ValueError:
+        return default
+
+
+def read_poscar(path='POSCAR'):
+    """
+    Returns: dict with comment, scale, lattice (3 strings), species, counts,
+             coordinate mode and position lines
+    """
+    with open(path) as f:
+        lines = [line.rstrip('\n') for line in f]
+    lattice = [' '.join(lines[i].split()[:3]) for i in range(2, 5)]
+    if lines[5].split()[0].isdigit():
+        # VASP 4 POSCAR, species only in the comment line
+        species = lines[0].split()
+        count_line = 5
+    else:
+        species = lines[5].split()
+        count_line = 6
+    counts = [int(c) for c in lines[count_line].split()]
+    index = count_line + 1
+    if lines[index].strip()[0] in 'sS':
+        index += 1
+    mode = lines[index].strip()
+    natoms = sum(counts)
+    positions = [' '.join(lines[i].split()[:3])
+                 for i in range(index + 1, index + 1 + natoms)]
+    if len(species) != len(counts):
+        species = ['H'] * len(counts)
+    return {'comment': lines[0], 'scale': lines[1].strip(), 'lattice': lattice,
+            'species': species, 'counts': counts, 'mode': mode,
+            'positions': positions}
+
+
+def write_contcar(poscar, path='CONTCAR'):
+    lines = [poscar['comment'], poscar['scale']] + poscar['lattice']
+    lines.append(' '.join(poscar['species']))
+    lines.append(' '.join(str(c) for c in poscar['counts']))
+    lines.append(poscar['mode'])
+    lines += poscar['positions']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def choose_outcome(incar, directory='.'):
+    forced = os.environ.get('MOCK_VASP_OUTCOME')
+    outcome_file = os.path.join(directory, 'MOCK_VASP_OUTCOME')
+    if os.path.exists(outcome_file):
+        with open(outcome_file) as f:
+            forced = f.read().strip()
+    if forced in OUTCOMES:
+        return forced
+    roll = random.random()
+    fizzle = float(os.environ.get('MOCK_VASP_FIZZLE_FRACTION', 0.05))
+    converged = float(os.environ.get('MOCK_VASP_CONVERGED_FRACTION', 0.8))
+    if roll < fizzle:
+        return 'fizzled'
+    if roll < fizzle + converged:
+        return 'converged'
+    if incar_int(incar, 'NSW', 0) > 1:
+        return random.choice(['electronic', 'ionic'])
+    return 'electronic'
+
+
+def plan_steps(incar, outcome):
+    # number of SCF steps for every ionic step
+    nelm = incar_int(incar, 'NELM', 60)
+    nsw = incar_int(incar, 'NSW', 0)
+    ionic = 1 if nsw <= 1 else min(nsw - 1, random.randint(2, 6))
+    if outcome == 'ionic':
+        ionic = nsw
+    most = min(25, max(nelm - 1, 1))
+    scf = [random.randint(min(8, most), most) for i in range(ionic)]
+    if outcome == 'electronic':
+        scf[-1] = nelm
+    return scf
+
+
+def varray(name, rows):
+    return ('<varray name="%s">\n' % name +
+            ''.join('<v>%s</v>\n' % row for row in rows) + '</varray>\n')
+
+
+def structure_xml(poscar, name=None):
+    scale = float(poscar['scale']) if float(poscar['scale']) > 0 else 1.0
+    basis = [' '.join('%.8f' % (float(x) * scale) for x in row.split())
+             for row in poscar['lattice']]
+    a, b, c = [[float(x) for x in row.split()] for row in basis]
+    volume = abs(a[0] * (b[1] * c[2] - b[2] * c[1]) -
+                 a[1] * (b[0] * c[2] - b[2] * c[0]) +
+                 a[2] * (b[0] * c[1] - b[1] * c[0]))
+    header = '<structure name="%s">\n' % name if name else '<structure>\n'
+    return (header + '<crystal>\n' + varray('basis', basis) +
+            '<i name="volume">%.8f</i>\n' % volume +
+            varray('rec_basis', ['0.0 0.0 0.0'] * 3) + '</crystal>\n' +
+            varray('positions', poscar['positions']) + '</structure>\n')
+
+
+def energy_xml(energy):
+    return ('<energy>\n<i name="e_fr_energy">%.8f</i>\n' % energy +
+            '<i name="e_wo_entrp">%.8f</i>\n' % energy +
+            '<i name="e_0_energy">%.8f</i>\n</energy>\n' % energy)
+
+
+def write_outputs(directory='.', outcome=None, ranks=None):
+    """
+    Args:
+        directory: VASP directory with INCAR and POSCAR
+        outcome: one of OUTCOMES, picked with choose_outcome if None
+        ranks: MPI ranks the run pretends to use
+    Returns: the outcome that was written
+    """
+    incar = read_incar(os.path.join(directory, 'INCAR'))
+    poscar = read_poscar(os.path.join(directory, 'POSCAR'))
+    if outcome is None:
+        outcome = choose_outcome(incar, directory)
+    if ranks is None:
+        ranks = int(os.environ.get('MOCK_VASP_RANKS', 1))
+    natoms = sum(poscar['counts'])
+    nelm = incar_int(incar, 'NELM', 60)
+    nsw = incar_int(incar, 'NSW', 0)
+    ibrion = incar_int(incar, 'IBRION', -1 if nsw <= 0 else 2)
+    scf_steps = plan_steps(incar, outcome)
+    scf_time = float(os.environ.get('MOCK_VASP_SCF_TIME', 2.0))
+    serial = float(os.environ.get('MOCK_VASP_SERIAL_FRACTION', 0.05))
+    threads = int(os.environ.get('OMP_NUM_THREADS', 1))
+    loop_time = scf_time * (serial + (1 - serial) / (ranks * threads))
+    pad_kb = int(os.environ.get('MOCK_VASP_PAD_KB', 0))
+    sleep = float(os.environ.get('MOCK_VASP_SLEEP', 0))
+
+    symbols = []
+    for species, count in zip(poscar['species'], poscar['counts']):
+        symbols += [species] * count
+    xml = ['<?xml version="1.0" encoding="ISO-8859-1"?>\n<modeling>\n',
+           '<generator>\n<i name="program" type="string">vasp </i>\n'
+           '<i name="version" type="string">6.4.2 </i>\n'
+           '<i name="subversion" type="string">mock</i>\n'
+           '<i name="platform" type="string">LinuxGNU </i>\n'
+           '<i name="date" type="string">%s </i>\n' % time.strftime('%Y %m %d') +
+           '<i name="time" type="string">%s </i>\n</generator>\n' % time.strftime('%H:%M:%S'),
+           '<incar>\n<i type="string" name="SYSTEM">%s</i>\n' % incar.get('SYSTEM', 'mock') +
+           '<i name="NELM">%d</i>\n<i name="NSW">%d</i>\n' % (nelm, nsw) +
+           '<i name="IBRION">%d</i>\n</incar>\n' % ibrion,
+           '<kpoints>\n<generation param="Gamma">\n'
+           '<v type="int" name="divisions">1 1 1</v>\n</generation>\n' +
+           varray('kpointlist', ['0.0 0.0 0.0']) + varray('weights', ['1.0']) +
+           '</kpoints>\n',
+           '<parameters>\n<separator name="electronic">\n'
+           '<i name="NELM" type="int">%d</i>\n' % nelm +
+           '<i name="ISPIN" type="int">1</i>\n</separator>\n'
+           '<separator name="ionic">\n<i name="NSW" type="int">%d</i>\n' % nsw +
+           '<i name="IBRION" type="int">%d</i>\n</separator>\n</parameters>\n' % ibrion,
+           '<atominfo>\n<atoms>%d</atoms>\n<types>%d</types>\n' % (natoms, len(poscar['counts'])) +
+           '<array name="atoms">\n<set>\n' +
+           ''.join('<rc><c>%s</c><c>%d</c></rc>\n' % (s, poscar['species'].index(s) + 1)
+                   for s in symbols) +
+           '</set>\n</array>\n<array name="atomtypes">\n<set>\n' +
+           ''.join('<rc><c>%d</c><c>%s</c><c>1.0</c><c>1.0</c><c> PAW_PBE %s 01Jan2000</c></rc>\n'
+                   % (count, species, species)
+                   for species, count in zip(poscar['species'], poscar['counts'])) +
+           '</set>\n</array>\n</atominfo>\n',
+           structure_xml(poscar, 'initialpos')]
+
+    oszicar = []
+    outcar = [' running on %5d total cores\n' % ranks,
+              ' distrk:  each k-point on %4d cores, %4d groups\n' % (ranks, 1),
+              ' distr:  one band on NCORE=%4d cores, %4d groups\n' % (1, ranks),
+              '   NBANDS= %7d\n' % (4 * natoms + 8),
+              '   NPLWV = %7d\n' % (1728 * natoms)]
+    energy = -5.0 * natoms
+    for ionic_step, steps in enumerate(scf_steps):
+        energy -= 0.1 / (ionic_step + 1)
+        xml.append('<calculation>\n')
+        for scf_step in range(steps):
+            scf_energy = energy + 10.0 / (scf_step + 1) ** 2
+            xml.append('<scstep>\n' + energy_xml(scf_energy) + '</scstep>\n')
+            oszicar.append('DAV: %3d    %.12E   %.5E   %.5E  %5d   %.3E\n'
+                           % (scf_step + 1, scf_energy, -10.0 / (scf_step + 1), -1.0 / (scf_step + 1), 64, 0.1))
+            outcar.append('      LOOP:  cpu time %11.4f: real time %11.4f\n' % (loop_time, loop_time))
+        xml.append(structure_xml(poscar))
+        xml.append(varray('forces', ['%.8f %.8f %.8f' % (0.01, -0.01, 0.0)] * natoms))
+        xml.append(varray('stress', ['1.0 0.0 0.0', '0.0 1.0 0.0', '0.0 0.0 1.0']))
+        xml.append(energy_xml(energy))
+        if pad_kb > 0:
+            xml.append('<!-- ' + 'x' * (1024 * pad_kb - 9) + ' -->\n')
+        xml.append('</calculation>\n')
+        oszicar.append('%4d F= %.8E E0= %.8E  d E =%.6E\n'
+                       % (ionic_step + 1, energy, energy, -0.1 / (ionic_step + 1)))
+        outcar.append('     LOOP+:  cpu time %11.4f: real time %11.4f\n'
+                      % (loop_time * steps + 1, loop_time * steps + 1))
+        if sleep > 0:
+            time.sleep(sleep)
+
+    xml.append(structure_xml(poscar, 'finalpos'))
+    xml.append('<dos>\n<i name="efermi">%.8f</i>\n<total>\n<array>\n'
+               '<dimension dim="1">gridpoints</dimension>\n'
+               '<dimension dim="2">spin</dimension>\n'
+               '<field>energy</field>\n<field>total</field>\n<field>integrated</field>\n'
+               '<set>\n<set comment="spin 1">\n' % 0.0 +
+               ''.join('<r>%.4f %.4f %.4f</r>\n' % (e * 0.5 - 5.0, 1.0, e * 1.0) for e in range(21)) +
+               '</set>\n</set>\n</array>\n</total>\n</dos>\n')
+    xml.append('</modeling>\n')
+
+    total = sum(scf_steps) * loop_time + len(scf_steps)
+    outcar.append('                   Maximum memory used (kb): %14.0f.\n' % (20000.0 * natoms + 100000))
+    outcar.append('                   Total CPU time used (sec): %14.3f\n' % total)
+    outcar.append('                             Elapsed time (sec): %14.3f\n' % total)
+
+    text = ''.join(xml)
+    if outcome == 'fizzled':
+        text = text[:len(text) // 2]
+    with open(os.path.join(directory, 'vasprun.xml'), 'w') as f:
+        f.write(text)
+    with open(os.path.join(directory, 'OSZICAR'), 'w') as f:
+        f.writelines(oszicar)
+    with open(os.path.join(directory, 'OUTCAR'), 'w') as f:
+        f.writelines(outcar)
+    write_contcar(poscar, os.path.join(directory, 'CONTCAR'))
+    return outcome
+
+
+if __name__ == '__main__':
+    outcome = write_outputs('.')
+    print('mock VASP finished:  ' + outcome)
+    sys.exit(0)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import time
+import tempfile
+import warnings
+import subprocess
+from pymatgen.io.vasp.outputs import Vasprun
+from vasp_run.schedulers import SlurmScheduler
+from slurm_emulator import mock_vasp
+from slurm_emulator.emulator import EmulatedSlurm
+
+BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
+POSCAR = '''CsPbBr3
+1.0
+5.9 0.0 0.0
+0.0 5.9 0.0
+0.0 0.0 5.9
+Cs Pb Br
+1 1 3
+Direct
+0.5 0.5 0.5
+0.0 0.0 0.0
+0.5 0.0 0.0
+0.0 0.5 0.0
+0.0 0.0 0.5
+'''
+SCRIPT = '''#!/bin/bash
+#SBATCH -J {name}
+#SBATCH --time=1:00:00
+#SBATCH --tasks 8
+#SBATCH -o {name}.o%j
+'''
+
+
+class TestEmulator(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = dict(os.environ)
+        self.env.update({'PATH': BIN + os.pathsep + os.environ['PATH'],
+                         'SLURM_EMULATOR_DIR': os.path.join(self.tmp.name, 'queue'),
+                         'SLURM_EMULATOR_WAIT': '0.3',
+                         'SLURM_EMULATOR_RUNTIME': '0.3',
+                         'SLURM_EMULATOR_SEED': '1'})
+        # SlurmScheduler is what vasp.py and rerun_workflow.py talk to
+        self.slurm = SlurmScheduler(runner=self.run_command)
+
+    def tearDown(self):
+        # stop the detached runners before their queue directory goes away
+        self.assertTrue(EmulatedSlurm(self.env['SLURM_EMULATOR_DIR']).shutdown(timeout=20))
+        self.tmp.cleanup()
+
+    def run_command(self, command, cwd=None, input=None):
+        return subprocess.run(command, cwd=cwd, input=input, env=self.env,
+                              capture_output=True, text=True)
+
+    def make_job(self, name, incar, outcome='converged', convergence=None):
+        job_dir = os.path.join(self.tmp.name, 'workflow', name)
+        os.makedirs(job_dir)
+        files = {'POSCAR': POSCAR, 'INCAR': incar, 'MOCK_VASP_OUTCOME': outcome,
+                 'vasp_standard.sh': SCRIPT.format(name=name)}
+        if convergence is not None:
+            files['CONVERGENCE'] = convergence
+        for file_name, text in files.items():
+            with open(os.path.join(job_dir, file_name), 'w') as f:
+                f.write(text)
+        return job_dir
+
+    def wait(self, job_id, timeout=20):
+        end = time.time() + timeout
+        while self.slurm.job_status(job_id) is not None:
+            self.assertLess(time.time(), end, 'emulated job never finished')
+            time.sleep(0.1)
+
+    def vasprun(self, job_dir):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return Vasprun(os.path.join(job_dir, 'vasprun.xml'))
+
+    def test_single_job(self):
+        job_dir = self.make_job('CsPbBr3', 'SYSTEM = CsPbBr3\nNSW = 99\nIBRION = 2\n')
+        job_id = self.slurm.submit('vasp_standard.sh', cwd=job_dir)
+        self.assertIn(self.slurm.status()[job_dir], ['PENDING', 'RUNNING'])
+        self.wait(job_id)
+        self.assertEqual(self.slurm.status(), {})
+        self.assertEqual(self.slurm.accounting([job_id])[0]['state'], 'COMPLETED')
+        self.assertTrue(self.vasprun(job_dir).converged)
+        self.assertTrue(os.path.exists(os.path.join(job_dir, 'CsPbBr3.o' + job_id)))
+
+    def test_multistep_job_walks_stages(self):
+        job_dir = self.make_job('multi', 'STAGE_NUMBER = 0\nNSW = 0\n',
+                                convergence='\n0 Step\n\nNSW = 0\n\n1 Step\n\nEDIFF = 1e-8\n')
+        self.wait(self.slurm.submit('vasp_standard.sh', cwd=job_dir))
+        self.assertEqual(mock_vasp.read_incar(os.path.join(job_dir, 'INCAR'))['STAGE_NUMBER'], '1')
+
+    def test_unconverged_and_fizzled_outputs(self):
+        electronic = self.make_job('electronic', 'NELM = 40\n', outcome='electronic')
+        fizzled = self.make_job('fizzled', 'NSW = 0\n', outcome='fizzled')
+        ids = [self.slurm.submit('vasp_standard.sh', cwd=d) for d in [electronic, fizzled]]
+        for job_id in ids:
+            self.wait(job_id)
+        self.assertFalse(self.vasprun(electronic).converged_electronic)
+        with self.assertRaises(Exception):
+            self.vasprun(fizzled)
+        states = [r['state'] for r in self.slurm.accounting(ids)]
+        self.assertEqual(states, ['COMPLETED', 'FAILED'])
+
+    def test_scancel(self):
+        self.env['SLURM_EMULATOR_WAIT'] = '60'
+        job_dir = self.make_job('slow', 'NSW = 0\n')
+        job_id = self.slurm.submit('vasp_standard.sh', cwd=job_dir)
+        self.assertEqual(self.slurm.job_status(job_id), 'PENDING')
+        self.slurm.cancel(job_id)
+        self.assertIsNone(self.slurm.job_status(job_id))
+        self.assertEqual(self.slurm.accounting([job_id])[0]['state'], 'CANCELLED')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+Core-hour accounting of a workflow tree. Every job id vasp.py recorded in
+job_state.json is looked up in the accounting of the scheduler it went to
+(sacct, qstat -x, or the federated cluster's sacct) for its state, elapsed
+time and cores. Records of finished jobs are cached in .vasp_accounting.json
+in the directory reported on and never asked for again, so only jobs that
+were still queued or running, or are new, cost a scheduler call.
+
+Each submission is split into the stages it finished (the elapsed time of
+its records in stages.jsonl) and the rest of the run, and the core-hours of
+each part are counted as useful or wasted. Finished stages are useful. The
+rest of the run is wasted when the job failed, timed out or was cancelled
+(unless it was preemptible and checkpointed), or when the next sweep found
+its vasprun.xml fizzled or raised NELM to converge it (from the workflow
+event log, see eventlog.py).
+
+    python -m vasp_run.accounting [workflow_dir] [--by job|stage|workflow] [--refresh] [--cached]
+"""
+
+import os
+import json
+import argparse
+from vasp_run import archive
+from vasp_run import backup_store
+from vasp_run import eventlog
+from vasp_run import probe
+from vasp_run import schedulers
+from vasp_run import stages
+from vasp_run import workflow_state
+
+CACHE_FILE = '.vasp_accounting.json'
+QUERY_BATCH = 200
+WASTED_STATES = {'TIMEOUT': 'timeout', 'DEADLINE': 'timeout', 'FAILED': 'failed',
+                 'NODE_FAIL': 'node_fail', 'OUT_OF_MEMORY': 'out_of_memory',
+                 'BOOT_FAIL': 'failed', 'CANCELLED': 'cancelled', 'PREEMPTED': 'preempted'}
+# preemptible runs checkpoint on these and carry on in the next submission
+CHECKPOINTED_STATES = ['TIMEOUT', 'PREEMPTED', 'CANCELLED']
+SKIP_DIRS = [probe.PROBE_DIR, backup_store.STORE_DIR, archive.ARCHIVE_DIR, stages.ARCHIVE_DIR, 'backup']
+
+
+def job_dirs(directory):
+    """
+    Returns: sorted directories under directory with a job_state.json,
+             archived ones included
+    """
+    found = set()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        if workflow_state.STATE_FILE in files:
+            found.add(root)
+    found.update(archive.archived_jobs(directory))
+    return sorted(found)
+
+
+def backend(submission):
+    """
+    Returns: name of the scheduler submission went to, e.g. slurm or
+             cluster:<federated cluster>
+    """
+    if submission.get('cluster'):
+        return 'cluster:' + submission['cluster']
+    return submission.get('scheduler') or 'slurm'
+
+
+def record_key(submission):
+    return backend(submission) + ':' + str(submission['job_id'])
+
+
+def get_backend(name):
+    if name.startswith('cluster:'):
+        from vasp_run import federation
+        return federation.get_federated_clusters([name[len('cluster:'):]])[0].scheduler
+    return schedulers.SCHEDULERS[name]()
+
+
+def load_cache(directory):
+    path = os.path.join(directory, CACHE_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        print('Unreadable ' + path + ', querying every job again')
+        return {}
+
+
+def write_cache(directory, cache):
+    path = os.path.join(directory, CACHE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def update_cache(submissions, cache, get_backend=get_backend):
+    """
+    Asks each scheduler, in batches, for the jobs not finished in the cache
+    Args:
+        submissions: submission records (with job ids)
+        cache: {record key: accounting record}, updated in place
+    Returns: number of jobs asked for
+    """
+    pending = {}
+    for submission in submissions:
+        key = record_key(submission)
+        if cache.get(key, {}).get('state') not in schedulers.FINISHED_STATES:
+            pending.setdefault(backend(submission), set()).add(str(submission['job_id']))
+    for (name, job_ids) in pending.items():
+        job_ids = sorted(job_ids)
+        try:
+            scheduler = get_backend(name)
+            for start in range(0, len(job_ids), QUERY_BATCH):
+                for record in scheduler.accounting(job_ids[start:start + QUERY_BATCH]):
+                    cache[name + ':' + record['job_id']] = record
+        except Exception as e:
+            print('No accounting from ' + name + ': ' + str(e))
+    return sum(len(job_ids) for job_ids in pending.values())
+
+
+def waste_events(directories):
+    """
+    Args:
+        directories: directories holding workflow event logs
+    Returns: {job directory: [(time, reason)]} of the sweeps that found a run
+             fizzled or raised its NELM
+    """
+    events = {}
+    for directory in directories:
+        for record in eventlog.read_events(directory, contains='"fizzled"'):
+            if record['event'] == 'decision' and record.get('decision') == 'fizzled':
+                events.setdefault(record['path'], []).append((record['time'], 'fizzled'))
+        for record in eventlog.read_events(directory, contains='"NELM"'):
+            if record['event'] == 'incar' and record.get('tag') == 'NELM':
+                events.setdefault(record['path'], []).append((record['time'], 'nelm_escalation'))
+    return {path: sorted(times) for (path, times) in events.items()}
+
+
+def submission_parts(path, submission, record, stage_records, events, until=None):
+    """
+    Args:
+        submission: the submission from job_state.json
+        record: its accounting record
+        stage_records: stage records of the job
+        events: (time, reason) of waste events of the job
+        until: time of the next submission of the job
+    Returns: list of dicts with the stage, core_hours and wasted (reason or None)
+             of the finished stages and the rest of the run
+    """
+    cores = record.get('cpus') or submission.get('cores') or 0
+    total = record.get('elapsed', 0) * cores / 3600.0
+    finished = [r for r in stage_records if str(r.get('job_id')) == str(submission['job_id'])]
+    hours = [float(r.get('elapsed_seconds') or 0) * cores / 3600.0 for r in finished]
+    if sum(hours) > total > 0:
+        hours = [h * total / sum(hours) for h in hours]
+    parts = [{'stage': r['stage'], 'core_hours': h, 'wasted': None} for (r, h) in zip(finished, hours)]
+
+    state = record.get('state', '')
+    # submissions are timed to the second and a sweep decides before it
+    # resubmits, so an event in the second of a submission is about the run before
+    reasons = [reason for (time, reason) in events
+               if time[:19] > submission['submitted'] and (until is None or time[:19] <= until)]
+    if reasons:
+        wasted = reasons[0]
+    elif state in CHECKPOINTED_STATES and submission.get('preemptible'):
+        wasted = None
+    else:
+        wasted = WASTED_STATES.get(state)
+    if finished:
+        stage = finished[-1]['stage'] if wasted is None else finished[-1]['stage'] + 1
+    else:
+        stage = submission.get('stage')
+    parts.append({'stage': stage, 'core_hours': max(total - sum(hours), 0.0), 'wasted': wasted})
+    for part in parts:
+        part.update({'path': path, 'job_id': submission['job_id'], 'state': state})
+    return parts
+
+
+def account(directory, refresh=False, query=True, get_backend=get_backend):
+    """
+    Args:
+        directory: workflow directory, the cache is kept here
+        refresh: ask the schedulers about every job again
+        query: False to report from the cache only
+    Returns: list of the parts of every submission (see submission_parts),
+             with the job name and workflow added
+    """
+    directory = os.path.abspath(directory)
+    cache = {} if refresh else load_cache(directory)
+    jobs = {path: workflow_state.read_job_state(path)['submissions'] for path in job_dirs(directory)}
+    submissions = [s for subs in jobs.values() for s in subs if s.get('job_id')]
+    if query and update_cache(submissions, cache, get_backend):
+        write_cache(directory, cache)
+
+    events = waste_events({directory} | {archive.workflow_root(path) for path in jobs})
+    parts = []
+    for (path, subs) in jobs.items():
+        subs = [s for s in subs if s.get('job_id')]
+        stage_records = [r for r in stages.read_stages(path) if 'stage' in r and not r.get('skipped')]
+        name = subs[-1].get('name') if subs else None
+        workflow = os.path.relpath(archive.workflow_root(path), directory)
+        for (n, submission) in enumerate(subs):
+            record = cache.get(record_key(submission))
+            if record is None:
+                continue
+            until = subs[n + 1]['submitted'] if n + 1 < len(subs) else None
+            for part in submission_parts(path, submission, record, stage_records,
+                                         events.get(path, []), until):
+                part.update({'job': name or os.path.basename(path), 'workflow': workflow})
+                parts.append(part)
+    return parts
+
+
+def totals(parts, by='job'):
+    """
+    Args:
+        by: 'job', 'stage' or 'workflow'
+    Returns: {key: {'core_hours', 'useful', 'wasted', 'reasons': {reason: core-hours}}}
+    """
+    keys = {'job': lambda p: p['path'],
+            'stage': lambda p: (p['path'], p['stage']),
+            'workflow': lambda p: p['workflow']}
+    result = {}
+    for part in parts:
+        total = result.setdefault(keys[by](part), {'core_hours': 0.0, 'useful': 0.0, 'wasted': 0.0,
+                                                   'reasons': {}})
+        total['core_hours'] += part['core_hours']
+        if part['wasted'] is None:
+            total['useful'] += part['core_hours']
+        else:
+            total['wasted'] += part['core_hours']
+            total['reasons'][part['wasted']] = total['reasons'].get(part['wasted'], 0.0) + part['core_hours']
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', nargs='?', default='.')
+    parser.add_argument('--by', choices=['job', 'stage', 'workflow'], default='job')
+    parser.add_argument('--refresh', action='store_true', help='ask about every job again')
+    parser.add_argument('--cached', action='store_true', help='report from the cache, no scheduler calls')
+    args = parser.parse_args()
+
+    parts = account(args.directory, args.refresh, not args.cached)
+    report = totals(parts, args.by)
+    print('%-50s %10s %10s %10s  %s' % (args.by, 'core-h', 'useful', 'wasted', 'wasted on'))
+    for (key, total) in sorted(report.items(), key=lambda item: str(item[0])):
+        if args.by == 'stage':
+            label = os.path.relpath(key[0], args.directory) + ' stage ' + str('-' if key[1] is None else key[1])
+        elif args.by == 'job':
+            label = os.path.relpath(key, args.directory)
+        else:
+            label = key
+        print('%-50s %10.1f %10.1f %10.1f  %s' % (
+            label, total['core_hours'], total['useful'], total['wasted'],
+            ', '.join('%s %.1f' % item for item in sorted(total['reasons'].items()))))
+    overall = totals(parts, 'workflow')
+    (core_hours, wasted) = (sum(t['core_hours'] for t in overall.values()),
+                            sum(t['wasted'] for t in overall.values()))
+    print('Total %.1f core-h, %.1f wasted (%.0f%%)' % (core_hours, wasted,
+                                                     100 * wasted / core_hours if core_hours else 0))
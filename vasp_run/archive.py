@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Indexed archives of converged jobs. `archive` packs job directories into
+one uncompressed tar per call in .vasp_archive at the workflow root (next to
+WORKFLOW_NAME) and removes them, so a finished workflow keeps a few files
+instead of tens of thousands and os.walk has nothing left to visit. Each
+tar has an index (<archive>.index.json) with, for every job (relative to
+the workflow root), its name and for every file the offset and size of its
+data, its mode and mtime. Single files are read by seeking to their offset,
+without unpacking; a file compacted to name.gz (compact.py) is read back
+decompressed under its plain name. Mode and mtime are kept in the tar, so
+`restore` brings a directory back as it was.
+
+Only jobs completed_jobs.yml lists as converged are archived.
+rerun_workflow.py counts archived jobs as converged and reads their
+vasprun.xml for the converged entries (skipping any without a readable one), read_job_state reads job_state.json
+of archived jobs and PmgStructureObjects.path_structures loads structures
+from them.
+
+    python -m vasp_run.archive archive [workflow_dir | job_dir ...]
+    python -m vasp_run.archive list [workflow_dir]
+    python -m vasp_run.archive cat job_dir file
+    python -m vasp_run.archive restore job_dir [destination]
+"""
+
+import os
+import io
+import json
+import gzip
+import shutil
+import tarfile
+import tempfile
+import argparse
+import contextlib
+from vasp_run import compact
+from vasp_run import schedulers
+from vasp_run import workflow_state
+
+ARCHIVE_DIR = '.vasp_archive'
+INDEX_SUFFIX = '.index.json'
+_indexes = {}
+
+
+def workflow_root(directory):
+    """
+    Returns: the closest directory above directory holding WORKFLOW_NAME or
+             an archive, the parent of directory if there is none
+    """
+    path = os.path.abspath(directory)
+    while True:
+        if os.path.isdir(os.path.join(path, ARCHIVE_DIR)) or \
+                os.path.exists(os.path.join(path, 'WORKFLOW_NAME')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return os.path.dirname(os.path.abspath(directory))
+        path = parent
+
+
+def load_index(root):
+    """
+    Returns: {job path relative to root: job entry with the archive path}
+             of every archive of the workflow at root
+    """
+    archive_dir = os.path.join(root, ARCHIVE_DIR)
+    if not os.path.isdir(archive_dir):
+        return {}
+    names = sorted(name for name in os.listdir(archive_dir) if name.endswith(INDEX_SUFFIX))
+    key = tuple((name, os.path.getmtime(os.path.join(archive_dir, name))) for name in names)
+    if _indexes.get(root, (None,))[0] != key:
+        jobs = {}
+        for name in names:
+            with open(os.path.join(archive_dir, name)) as f:
+                index = json.load(f)
+            for (job, entry) in index['jobs'].items():
+                jobs[job] = dict(entry, archive=os.path.join(archive_dir, index['archive']))
+        _indexes[root] = (key, jobs)
+    return _indexes[root][1]
+
+
+def lookup(job_dir):
+    """
+    Returns: index entry of an archived job directory, None if it is not archived
+    """
+    root = workflow_root(job_dir)
+    return load_index(root).get(os.path.relpath(os.path.abspath(job_dir), root))
+
+
+def is_archived(job_dir):
+    return not os.path.isdir(job_dir) and lookup(job_dir) is not None
+
+
+def archived_jobs(directory):
+    """
+    Returns: {job directory: job name} of the archived jobs under directory
+    """
+    root = workflow_root(directory)
+    directory = os.path.abspath(directory)
+    jobs = {}
+    for (job, entry) in load_index(root).items():
+        path = os.path.join(root, job)
+        if (path == directory or path.startswith(directory + os.sep)) and not os.path.isdir(path):
+            jobs[path] = entry['name']
+    return jobs
+
+
+def read_member(job_dir, name):
+    """
+    Returns: bytes of file name of an archived job, decompressed if it was
+             compacted to name.gz
+    """
+    entry = lookup(job_dir)
+    if entry is None:
+        raise FileNotFoundError(job_dir + ' is not archived')
+    compressed = name not in entry['files'] and name + '.gz' in entry['files']
+    (offset, size) = entry['files'][name + '.gz' if compressed else name][:2]
+    with open(entry['archive'], 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+    return gzip.decompress(data) if compressed else data
+
+
+def open_member(job_dir, name, mode='rt'):
+    data = read_member(job_dir, name)
+    return io.StringIO(data.decode()) if 't' in mode else io.BytesIO(data)
+
+
+@contextlib.contextmanager
+def member_path(job_dir, name):
+    """
+    Yields: path of a temporary copy of file name of an archived job, for
+            parsers that only take paths (Vasprun, Outcar)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, name)
+        with open(path, 'wb') as f:
+            f.write(read_member(job_dir, name))
+        yield path
+
+
+def archive_jobs(job_dirs, names=None, remove=True):
+    """
+    Args:
+        job_dirs: job directories of one workflow
+        names: {job directory: job name}, the directory name by default
+        remove: remove the directories once they are archived and indexed
+    Returns: path of the new archive
+    """
+    names = names or {}
+    root = workflow_root(job_dirs[0])
+    archive_dir = os.path.join(root, ARCHIVE_DIR)
+    os.makedirs(archive_dir, exist_ok=True)
+    number = len([name for name in os.listdir(archive_dir) if name.endswith(INDEX_SUFFIX)])
+    archive_name = 'jobs-%04d.tar' % number
+    archive_path = os.path.join(archive_dir, archive_name)
+    jobs = {os.path.relpath(os.path.abspath(d), root): d for d in job_dirs}
+    with tarfile.open(archive_path + '.tmp', 'w', format=tarfile.PAX_FORMAT) as tar:
+        for (job, directory) in sorted(jobs.items()):
+            tar.add(directory, arcname=job)
+
+    index = {'archive': archive_name, 'created': workflow_state.now(), 'jobs': {}}
+    for job in jobs:
+        index['jobs'][job] = {'name': names.get(jobs[job], os.path.basename(os.path.abspath(jobs[job]))),
+                              'files': {}}
+    with tarfile.open(archive_path + '.tmp', 'r') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            job = max((j for j in jobs if member.name.startswith(j + '/')), key=len)
+            index['jobs'][job]['files'][member.name[len(job) + 1:]] = \
+                [member.offset_data, member.size, member.mode, member.mtime]
+    os.replace(archive_path + '.tmp', archive_path)
+    with open(archive_path + INDEX_SUFFIX + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(archive_path + INDEX_SUFFIX + '.tmp', archive_path + INDEX_SUFFIX)
+    if remove:
+        for directory in jobs.values():
+            shutil.rmtree(directory)
+    return archive_path
+
+
+def restore(job_dir, destination=None):
+    """
+    Unpacks an archived job to destination (job_dir by default) with its
+    modes and mtimes
+    """
+    entry = lookup(job_dir)
+    if entry is None:
+        raise FileNotFoundError(job_dir + ' is not archived')
+    root = workflow_root(job_dir)
+    job = os.path.relpath(os.path.abspath(job_dir), root)
+    destination = destination or job_dir
+    # the tar filter (Python 3.11.4 and later) refuses paths leaving destination
+    options = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    with tarfile.open(entry['archive'], 'r') as tar:
+        for member in tar:
+            if member.name == job or member.name.startswith(job + '/'):
+                member.name = os.path.relpath(member.name, job)
+                tar.extract(member, destination, **options)
+    return destination
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    archive_parser = subparsers.add_parser('archive', help='archive converged jobs')
+    archive_parser.add_argument('paths', nargs='*', default=['.'],
+                                help='workflow directories (their converged jobs) or job directories')
+    archive_parser.add_argument('--keep', action='store_true', help='keep the job directories')
+    list_parser = subparsers.add_parser('list', help='list archived jobs')
+    list_parser.add_argument('path', nargs='?', default='.')
+    cat_parser = subparsers.add_parser('cat', help='print a file of an archived job')
+    cat_parser.add_argument('job_dir')
+    cat_parser.add_argument('file')
+    restore_parser = subparsers.add_parser('restore', help='unpack an archived job')
+    restore_parser.add_argument('job_dir')
+    restore_parser.add_argument('destination', nargs='?', default=None)
+    args = parser.parse_args()
+
+    if args.command == 'archive':
+        names = {}
+        for path in args.paths:
+            path = os.path.abspath(path)
+            if os.path.exists(os.path.join(path, compact.COMPLETED_FILE)):
+                names.update(compact.converged_jobs(path))
+                continue
+            # a job directory is only archived once its workflow lists it as converged
+            converged = compact.converged_jobs(workflow_root(path))
+            if path in converged:
+                names[path] = converged[path]
+            else:
+                print('%s is not listed as converged in %s, not archived' % (
+                    os.path.relpath(path), compact.COMPLETED_FILE))
+        queued = schedulers.get_scheduler(schedulers.computer_queue_type()).status()
+        job_dirs = [d for d in sorted(names) if os.path.isdir(d) and d not in queued]
+        if job_dirs:
+            print('Archived %d jobs to %s' % (len(job_dirs), archive_jobs(job_dirs, names, not args.keep)))
+    elif args.command == 'list':
+        for (job_dir, name) in sorted(archived_jobs(args.path).items()):
+            entry = lookup(job_dir)
+            print('%-50s %-20s %5d files  %s' % (os.path.relpath(job_dir), name, len(entry['files']),
+                                                os.path.basename(entry['archive'])))
+    elif args.command == 'cat':
+        print(read_member(args.job_dir, args.file).decode(errors='replace'), end='')
+    else:
+        print(restore(args.job_dir, args.destination))
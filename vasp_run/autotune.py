@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Parallel layout autotuner. Ranks the valid layouts of a job on a cluster
+(KPAR dividing the irreducible k-points, NCORE dividing the ranks per node,
+OpenMP threads dividing the cores of a socket) with a simple cost model and
+writes the best one into the INCAR: KPAR, NCORE and NSIM for VASP, and the
+AUTO_NODES, AUTO_CORES (ranks per node) and AUTO_OMP tags vasp.py turns
+into the submission script. NPAR is removed since vasp.py would otherwise
+read it as the node count and VASP would prefer it over NCORE.
+
+    python -m vasp_run.autotune [-c computer] [-o nodes] [--dry-run] job_dir ...
+    python -m vasp_run.autotune --tree workflow_dir    (every pending job)
+"""
+
+import os
+import math
+import argparse
+import yaml
+from pymatgen.io.vasp.inputs import Incar
+from vasp_run import resources
+from vasp_run import schedulers
+from vasp_run.cluster_profiles import get_cluster_profile
+
+# relative costs of the cost model, only their ratios matter
+OMP_OVERHEAD = 0.08
+BAND_COMMUNICATION = 0.02
+FFT_COMMUNICATION = 0.05
+NETWORK_FACTOR = 4.0
+MAX_THREADS = 8
+
+
+def divisors(n):
+    return [d for d in range(1, int(n) + 1) if n % d == 0]
+
+
+def choose_nsim(bands_per_group, threads):
+    # blocked BLAS3 pays off once each band group has enough bands,
+    # threaded runs want bigger blocks per rank
+    nsim = 8 if bands_per_group >= 32 else 4
+    if threads > 1:
+        nsim = min(32, nsim * 2)
+    return nsim
+
+
+def layout_cost(size, nodes, ranks_per_node, threads, kpar, ncore):
+    """
+    Args:
+        size: dict from resources.job_size
+        nodes, ranks_per_node, threads, kpar, ncore: the layout
+    Returns: relative time of one electronic step (lower is faster)
+    """
+    ranks = nodes * ranks_per_node
+    ranks_per_kgroup = ranks // kpar
+    band_groups = ranks_per_kgroup // ncore
+    kpoints_per_group = int(math.ceil(size['nkpts'] / float(kpar))) * size['ispin']
+    # VASP pads NBANDS up to a multiple of the band groups
+    nbands = int(math.ceil(size['nbands'] / float(band_groups))) * band_groups
+    npw = size['npw'] * (2 if size['noncollinear'] else 1)
+    work = kpoints_per_group * nbands * npw * math.log(npw, 2)
+    omp_efficiency = 1.0 / (1 + OMP_OVERHEAD * (threads - 1))
+    compute = work / (ranks_per_kgroup * threads * omp_efficiency)
+    # orthogonalisation exchanges the coefficients between band groups,
+    # FFTs exchange them between the ncore ranks sharing a band
+    band_communication = (kpoints_per_group * nbands * npw / ncore *
+                          math.log(band_groups + 1, 2) * BAND_COMMUNICATION)
+    if ranks_per_kgroup > ranks_per_node:
+        band_communication *= NETWORK_FACTOR
+    fft_communication = (kpoints_per_group * nbands / band_groups * npw *
+                         (ncore - 1) / ncore * math.log(ncore + 1, 2) * FFT_COMMUNICATION)
+    return compute + band_communication + fft_communication
+
+
+def rank_layouts(size, profile, nodes=1):
+    """
+    Args:
+        size: dict from resources.job_size
+        profile: cluster profile with cores_per_node (sockets and
+                 memory_per_node_mb are used when present)
+        nodes: node count to lay the job out on
+    Returns: list of layout dicts (nodes, ranks_per_node, threads, kpar, ncore,
+             nsim, memory_mb, cost), fastest first; layouts whose ranks do not
+             fit in node memory are left out
+    """
+    cores = profile['cores_per_node']
+    cores_per_socket = cores // profile.get('sockets', 1)
+    layouts = []
+    for threads in divisors(cores_per_socket):
+        if threads > MAX_THREADS:
+            break
+        ranks_per_node = cores // threads
+        ranks = nodes * ranks_per_node
+        for kpar in divisors(size['nkpts']):
+            if ranks % kpar != 0:
+                continue
+            ranks_per_kgroup = ranks // kpar
+            for ncore in divisors(ranks_per_node):
+                if ranks_per_kgroup % ncore != 0:
+                    continue
+                memory = resources.estimate_rank_memory(size, ranks, kpar, ncore)
+                memory = int(math.ceil(memory * resources.MEMORY_MARGIN))
+                if memory * ranks_per_node > profile.get('memory_per_node_mb', float('inf')):
+                    continue
+                bands_per_group = size['nbands'] // max(1, ranks_per_kgroup // ncore)
+                layouts.append({'nodes': nodes,
+                                'ranks_per_node': ranks_per_node,
+                                'threads': threads,
+                                'kpar': kpar,
+                                'ncore': ncore,
+                                'nsim': choose_nsim(bands_per_group, threads),
+                                'memory_mb': memory,
+                                'cost': layout_cost(size, nodes, ranks_per_node,
+                                                    threads, kpar, ncore)})
+    layouts.sort(key=lambda layout: layout['cost'])
+    return layouts
+
+
+def current_nodes(incar):
+    # the node count vasp.py would use for this INCAR
+    if 'AUTO_NODES' in incar:
+        return int(incar['AUTO_NODES'])
+    if 'NPAR' in incar:
+        return int(incar['NPAR']) * int(incar.get('KPAR', 1))
+    return 1
+
+
+def write_layout(layout, incar_path='INCAR'):
+    """
+    Args:
+        layout: layout dict from rank_layouts
+        incar_path: INCAR to update
+    Returns: None
+    """
+    incar = Incar.from_file(incar_path)
+    if 'NPAR' in incar:
+        del incar['NPAR']
+    incar['KPAR'] = layout['kpar']
+    incar['NCORE'] = layout['ncore']
+    incar['NSIM'] = layout['nsim']
+    incar['AUTO_NODES'] = layout['nodes']
+    incar['AUTO_CORES'] = layout['ranks_per_node']
+    incar['AUTO_OMP'] = layout['threads']
+    incar.write_file(incar_path)
+
+
+def tune_job(directory, profile, nodes=None, write=True):
+    """
+    Args:
+        directory: job directory with INCAR, POSCAR (and KPOINTS, POTCAR)
+        profile: cluster profile of the cluster the job will run on
+        nodes: node count, the job's own (or the memory minimum) if None
+        write: write the best layout into the INCAR
+    Returns: ranked layouts, empty if none fits the cluster
+    """
+    incar_path = os.path.join(directory, 'INCAR')
+    incar = Incar.from_file(incar_path)
+    size = resources.job_size(directory, incar)
+    if nodes is None:
+        nodes = current_nodes(incar)
+    layouts = []
+    while not layouts and nodes <= 64:
+        layouts = rank_layouts(size, profile, nodes)
+        nodes += 1
+    if layouts and write:
+        write_layout(layouts[0], incar_path)
+    return layouts
+
+
+def pending_jobs(pwd, computer=None):
+    """
+    Args:
+        pwd: workflow directory
+        computer: cluster whose queue is checked, this one if None
+    Returns: job directories of pwd that have not converged (per the
+             completed_jobs.yml of rerun_workflow.py) and are not in the queue
+    """
+    completed = {}
+    completed_path = os.path.join(pwd, 'completed_jobs.yml')
+    if os.path.exists(completed_path):
+        with open(completed_path) as f:
+            completed = (yaml.safe_load(f) or {}).get('PATHs', {}) or {}
+    queued = schedulers.get_scheduler(schedulers.computer_queue_type(computer)).status()
+    jobs = []
+    for root, dirs, files in os.walk(pwd):
+        dirs[:] = sorted(d for d in dirs if d not in ['backup', 'probe'])
+        if all(f in files for f in ['INCAR', 'KPOINTS', 'POTCAR', 'POSCAR']):
+            if root not in completed and root not in queued:
+                jobs.append(root)
+    return jobs
+
+
+def print_layouts(directory, layouts, show=5):
+    print(directory)
+    print('  %5s %5s %7s %4s %5s %4s %9s %8s' % ('nodes', 'ranks', 'threads', 'KPAR',
+                                              'NCORE', 'NSIM', 'MB/rank', 'relative'))
+    for layout in layouts[:show]:
+        print('  %5d %5d %7d %4d %5d %4d %9d %8.2f' % (
+            layout['nodes'], layout['ranks_per_node'], layout['threads'], layout['kpar'],
+            layout['ncore'], layout['nsim'], layout['memory_mb'],
+            layout['cost'] / layouts[0]['cost']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=['.'])
+    parser.add_argument('-c', '--computer',
+                        help='cluster profile to tune for (default: this cluster)')
+    parser.add_argument('-o', '--nodes', type=int, help='node count to lay jobs out on')
+    parser.add_argument('--tree', help='tune every pending job below the paths',
+                        action='store_true')
+    parser.add_argument('--dry-run', help='only print the ranked layouts',
+                        action='store_true')
+    parser.add_argument('--show', type=int, default=5, help='layouts to print per job')
+    args = parser.parse_args()
+
+    if args.computer is None:
+        from Helpers import getComputerName
+        args.computer = getComputerName()
+    profile = get_cluster_profile(args.computer)
+    if 'cores_per_node' not in profile:
+        raise Exception('No cores_per_node in cluster profile for ' + args.computer)
+    directories = []
+    for path in args.paths:
+        if args.tree:
+            directories.extend(pending_jobs(os.path.abspath(path), args.computer))
+        else:
+            directories.append(path)
+    for directory in directories:
+        layouts = tune_job(directory, profile, args.nodes, write=not args.dry_run)
+        if layouts:
+            print_layouts(directory, layouts, args.show)
+        else:
+            print(directory + '\n  no layout fits in the memory of ' + args.computer)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Deduplicating backups. backup_vasp (vasp.py) no longer copies the files of a
+resubmitted job into backup/N; each file is hashed (sha256) and stored once
+in the workflow's object store, and backup/N only holds manifest.json:
+    created, store (relative to backup/N)
+    files: {path: {sha256, size, mode}}
+The store is .vasp_objects at the workflow root (the directory holding
+WORKFLOW_NAME, or VASP_OBJECT_STORE) with one blob per unique content under
+<first two hex digits>/<sha256>, gzip compressed (.gz) unless that saves
+less than MIN_SAVING. Uncompressed blobs are copied in and out with a
+reflink where the filesystem supports it. Blobs are never hardlinked to job
+files, since VASP rewrites its outputs in place.
+
+    python -m vasp_run.backup_store restore job_dir N [destination]
+    python -m vasp_run.backup_store list job_dir
+    python -m vasp_run.backup_store gc workflow_dir
+"""
+
+import os
+import gzip
+import json
+import fcntl
+import shutil
+import hashlib
+import argparse
+from vasp_run import workflow_state
+
+STORE_DIR = '.vasp_objects'
+MANIFEST_FILE = 'manifest.json'
+CHUNK = 1 << 20
+GZIP_LEVEL = 1
+# fraction of the size gzip has to save for a blob to be kept compressed
+MIN_SAVING = 0.1
+# ioctl cloning a file on filesystems with reflinks (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def find_store(directory):
+    """
+    Returns: object store of the workflow directory belongs to
+    """
+    if 'VASP_OBJECT_STORE' in os.environ:
+        return os.environ['VASP_OBJECT_STORE']
+    path = os.path.abspath(directory)
+    while True:
+        if os.path.isdir(os.path.join(path, STORE_DIR)) or \
+                os.path.exists(os.path.join(path, 'WORKFLOW_NAME')):
+            return os.path.join(path, STORE_DIR)
+        parent = os.path.dirname(path)
+        if parent == path:
+            return os.path.join(os.path.dirname(os.path.abspath(directory)), STORE_DIR)
+        path = parent
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def clone_file(source, destination):
+    """
+    Copies source to destination as a reflink where the filesystem supports
+    it, a plain copy otherwise
+    """
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst, CHUNK)
+
+
+def blob_path(store, sha):
+    """
+    Returns: path of the blob holding sha, None if the store lacks it
+    """
+    base = os.path.join(store, sha[:2], sha)
+    for path in [base + '.gz', base]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def add_blob(store, path, sha=None):
+    """
+    Stores the content of path unless the store already has it
+    Returns: sha256 of the content
+    """
+    sha = sha or file_hash(path)
+    if blob_path(store, sha) is not None:
+        return sha
+    base = os.path.join(store, sha[:2], sha)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    tmp = '%s.%d.tmp' % (base, os.getpid())
+    with open(path, 'rb') as src, gzip.open(tmp, 'wb', compresslevel=GZIP_LEVEL) as dst:
+        shutil.copyfileobj(src, dst, CHUNK)
+    if os.path.getsize(tmp) <= (1 - MIN_SAVING) * os.path.getsize(path):
+        os.replace(tmp, base + '.gz')
+    else:
+        os.remove(tmp)
+        clone_file(path, tmp)
+        os.replace(tmp, base)
+    return sha
+
+
+def extract_blob(store, sha, destination):
+    path = blob_path(store, sha)
+    if path is None:
+        raise FileNotFoundError('no object ' + sha + ' in ' + store)
+    tmp = destination + '.tmp'
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK)
+    else:
+        clone_file(path, tmp)
+    os.replace(tmp, destination)
+
+
+def next_backup(backup_dir):
+    runs = [int(d) for d in os.listdir(backup_dir) if d.isdigit()] if os.path.isdir(backup_dir) else []
+    return os.path.join(backup_dir, str(max(runs) + 1 if runs else 0))
+
+
+def backup(directory, files, backup_dir=None, store=None):
+    """
+    Args:
+        directory: job directory
+        files: paths, relative to directory, to back up
+        backup_dir: backup/N to write the manifest to, the next free one if None
+        store: object store, find_store(directory) if None
+    Returns: path of the manifest; files that do not exist are left out
+    """
+    backup_dir = backup_dir or next_backup(os.path.join(directory, 'backup'))
+    store = store or find_store(directory)
+    manifest = {'created': workflow_state.now(),
+                'store': os.path.relpath(store, os.path.abspath(backup_dir)),
+                'files': {}}
+    for name in files:
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            print('Could not backup file at:  ' + name)
+            continue
+        manifest['files'][name] = {'sha256': add_blob(store, path),
+                                   'size': os.path.getsize(path),
+                                   'mode': os.stat(path).st_mode & 0o777}
+    os.makedirs(backup_dir, exist_ok=True)
+    manifest_path = os.path.join(backup_dir, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest_path
+
+
+def read_manifest(backup_dir):
+    """
+    Reads backup_dir/manifest.json, from the workflow archive (see
+    archive.py) once the job it belongs to was archived
+    """
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        from vasp_run import archive
+        job_dir = os.path.dirname(os.path.dirname(os.path.abspath(backup_dir)))
+        if archive.is_archived(job_dir):
+            name = os.path.relpath(path, job_dir)
+            return json.loads(archive.read_member(job_dir, name).decode())
+    with open(path) as f:
+        return json.load(f)
+
+
+def manifest_store(backup_dir, manifest):
+    store = os.path.normpath(os.path.join(os.path.abspath(backup_dir), manifest['store']))
+    return store if os.path.isdir(store) else find_store(backup_dir)
+
+
+def restore(backup_dir, destination=None):
+    """
+    Rebuilds the files of a backup/N from its manifest
+    Args:
+        backup_dir: backup/N holding manifest.json
+        destination: directory to write the files to, backup_dir if None
+    Returns: list of the restored paths
+    """
+    manifest = read_manifest(backup_dir)
+    store = manifest_store(backup_dir, manifest)
+    destination = destination or backup_dir
+    restored = []
+    for (name, entry) in sorted(manifest['files'].items()):
+        path = os.path.join(destination, name)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        extract_blob(store, entry['sha256'], path)
+        os.chmod(path, entry.get('mode', 0o644))
+        restored.append(path)
+    return restored
+
+
+def manifests(root):
+    for path, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d != STORE_DIR)
+        if MANIFEST_FILE in files and os.path.basename(os.path.dirname(path)) == 'backup':
+            yield path
+
+
+def archived_manifests(root):
+    """
+    Yields: backup/N of the jobs under root that were archived (see
+            archive.py), whose manifests only live in the archive
+    """
+    from vasp_run import archive
+    for job_dir in sorted(archive.archived_jobs(root)):
+        for name in sorted(archive.lookup(job_dir)['files']):
+            parts = name.split('/')
+            if len(parts) == 3 and parts[0] == 'backup' and parts[2] == MANIFEST_FILE:
+                yield os.path.join(job_dir, parts[0], parts[1])
+
+
+def collect_garbage(directory, store=None):
+    """
+    Removes the blobs that no manifest of the workflow (everything under the
+    directory holding the store, archived jobs included) refers to
+    Returns: (blobs removed, bytes freed)
+    """
+    store = store or find_store(directory)
+    root = os.path.dirname(os.path.abspath(store))
+    used = set()
+    for backup_dir in list(manifests(root)) + list(archived_manifests(root)):
+        used.update(entry['sha256'] for entry in read_manifest(backup_dir)['files'].values())
+    (removed, freed) = (0, 0)
+    for (path, dirs, files) in os.walk(store):
+        for name in files:
+            # .tmp files are blobs being written
+            if not name.endswith('.tmp') and name.split('.')[0] not in used:
+                freed += os.path.getsize(os.path.join(path, name))
+                os.remove(os.path.join(path, name))
+                removed += 1
+    return (removed, freed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    restore_parser = subparsers.add_parser('restore', help='rebuild the files of backup/N')
+    restore_parser.add_argument('job_dir')
+    restore_parser.add_argument('run', help='N of backup/N')
+    restore_parser.add_argument('destination', nargs='?', default=None)
+    list_parser = subparsers.add_parser('list', help='list the backups of a job')
+    list_parser.add_argument('job_dir')
+    gc_parser = subparsers.add_parser('gc', help='remove objects no backup refers to')
+    gc_parser.add_argument('workflow_dir')
+    args = parser.parse_args()
+
+    if args.command == 'restore':
+        for path in restore(os.path.join(args.job_dir, 'backup', args.run), args.destination):
+            print(path)
+    elif args.command == 'list':
+        backup_dir = os.path.join(args.job_dir, 'backup')
+        for run in sorted((d for d in os.listdir(backup_dir) if d.isdigit()), key=int):
+            if not os.path.exists(os.path.join(backup_dir, run, MANIFEST_FILE)):
+                print('%4s  (plain copies)' % run)
+                continue
+            manifest = read_manifest(os.path.join(backup_dir, run))
+            print('%4s  %s  %s' % (run, manifest['created'], ' '.join(sorted(manifest['files']))))
+    else:
+        (removed, freed) = collect_garbage(args.workflow_dir)
+        print('Removed %d objects, %.1f MB' % (removed, freed / 1e6))
@@ -0,0 +1,115 @@
+"""
+CPU binding and process placement for the job scripts. Settings come from
+the cluster profile's "binding" dict, overridden by the AUTO_ tags of the
+INCAR and then by vasp.py options:
+    cpu_bind       (AUTO_CPU_BIND, --cpu-bind): cores, sockets, threads, none...
+    distribution   (AUTO_DISTRIBUTION, --distribution): block:block, cyclic...
+    hint           (AUTO_HINT, --hint): nomultithread, compute_bound...
+    omp_places     (AUTO_OMP_PLACES): OMP_PLACES, cores when threads > 1
+    omp_proc_bind  (AUTO_OMP_PROC_BIND): OMP_PROC_BIND, close when threads > 1
+    mpi_flavor     (AUTO_MPI_FLAVOR): openmpi, intelmpi or mpich, how mpirun
+                   is told the same thing srun is (default openmpi)
+and are turned into #SBATCH lines, environment variables and launcher
+options that both job templates render.
+"""
+
+SETTINGS = ['cpu_bind', 'distribution', 'hint', 'omp_places', 'omp_proc_bind', 'mpi_flavor']
+OPENMPI_BIND = {'cores': 'core', 'threads': 'hwthread', 'sockets': 'socket',
+                'ldoms': 'numa', 'none': 'none'}
+INTELMPI_DOMAIN = {'cores': 'core', 'threads': 'core', 'sockets': 'socket',
+                   'ldoms': 'numa'}
+
+
+def binding_settings(profile, incar=None, overrides=None, threads=1):
+    """
+    Args:
+        profile: cluster profile, may hold a binding dict
+        incar: Incar (or dict) with AUTO_ binding tags
+        overrides: dict of settings given on the command line (None values ignored)
+        threads: OpenMP threads per rank
+    Returns: dict of the binding settings that are set
+    """
+    settings = dict(profile.get('binding', {}))
+    for setting in SETTINGS:
+        tag = 'AUTO_' + setting.upper()
+        if incar is not None and tag in incar:
+            settings[setting] = str(incar[tag]).lower()
+    for (setting, value) in (overrides or {}).items():
+        if value:
+            settings[setting] = value
+    if threads > 1:
+        settings.setdefault('omp_places', 'cores')
+        settings.setdefault('omp_proc_bind', 'close')
+    return settings
+
+
+def sbatch_options(settings):
+    """
+    Returns: #SBATCH options for settings, srun inherits them from the allocation
+    """
+    options = []
+    for (setting, option) in [('cpu_bind', '--cpu-bind'), ('distribution', '--distribution'),
+                              ('hint', '--hint')]:
+        if setting in settings:
+            options.append(option + '=' + settings[setting])
+    return options
+
+
+def environment(settings, mpi, threads=1):
+    """
+    Returns: list of NAME=value to export before VASP starts
+    """
+    variables = []
+    if 'omp_places' in settings:
+        variables.append('OMP_PLACES=' + settings['omp_places'])
+    if 'omp_proc_bind' in settings:
+        variables.append('OMP_PROC_BIND=' + settings['omp_proc_bind'])
+    if mpi != 'srun' and settings.get('mpi_flavor') == 'intelmpi' and \
+            settings.get('cpu_bind', 'cores') != 'none':
+        variables.append('I_MPI_PIN=1')
+        if threads > 1:
+            variables.append('I_MPI_PIN_DOMAIN=omp')
+        else:
+            variables.append('I_MPI_PIN_DOMAIN=' +
+                             INTELMPI_DOMAIN.get(settings.get('cpu_bind', 'cores'), 'core'))
+        if settings.get('distribution', '').startswith('cyclic'):
+            variables.append('I_MPI_PIN_ORDER=scatter')
+        elif 'distribution' in settings:
+            variables.append('I_MPI_PIN_ORDER=compact')
+    return variables
+
+
+def launcher_options(settings, mpi, threads=1):
+    """
+    Args:
+        settings: dict from binding_settings
+        mpi: launcher (srun, mpirun...)
+        threads: OpenMP threads per rank
+    Returns: options to put between the launcher (and -np) and VASP
+    """
+    options = []
+    if mpi == 'srun':
+        # srun no longer inherits --cpus-per-task from the allocation
+        if threads > 1:
+            options.append('--cpus-per-task=%d' % threads)
+        for (setting, option) in [('cpu_bind', '--cpu-bind'), ('distribution', '--distribution')]:
+            if setting in settings:
+                options.append(option + '=' + settings[setting])
+        return options
+    flavor = settings.get('mpi_flavor', 'openmpi')
+    if 'cpu_bind' not in settings and 'distribution' not in settings:
+        return options
+    bind = settings.get('cpu_bind', 'cores')
+    cyclic = settings.get('distribution', '').startswith('cyclic')
+    if flavor == 'openmpi':
+        if threads > 1:
+            options += ['--map-by', ('socket' if cyclic else 'slot') + ':PE=%d' % threads]
+        elif cyclic:
+            options += ['--map-by', 'socket']
+        options += ['--bind-to', OPENMPI_BIND.get(bind, 'core')]
+    elif flavor == 'mpich':
+        options += ['-bind-to', OPENMPI_BIND.get(bind, 'core') +
+                    (':%d' % threads if threads > 1 else '')]
+        if cyclic:
+            options += ['-map-by', 'socket']
+    return options
@@ -0,0 +1,35 @@
+"""
+Per-cluster settings (ssh host, cores per node, template keyword overrides...)
+read from configuration/cluster_profiles.json, or from the json file named by
+the VASP_CLUSTER_PROFILES environment variable if it is set
+"""
+
+import os
+import json
+
+
+def get_profiles_path():
+    if 'VASP_CLUSTER_PROFILES' in os.environ:
+        return os.environ['VASP_CLUSTER_PROFILES']
+    workflow_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(workflow_path, 'configuration', 'cluster_profiles.json')
+
+
+def load_cluster_profiles():
+    """
+    Returns: Dict of {computer name: profile dict}, empty if no profile file exists
+    """
+    profiles_path = get_profiles_path()
+    if not os.path.exists(profiles_path):
+        return {}
+    with open(profiles_path) as f:
+        return json.load(f)
+
+
+def get_cluster_profile(computer):
+    """
+    Args:
+        computer: name returned by getComputerName()
+    Returns: profile dict for computer, empty dict if the cluster has no profile
+    """
+    return load_cluster_profiles().get(computer, {})
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Compaction of finished jobs. The large outputs of converged jobs
+(COMPACT_FILES, in the job directory and the stages/<N>/ archives) are gzip
+compressed in place, several directories at a time, and WAVECAR is deleted
+unless --keep-wavecar or AUTO_KEEP_WAVECAR = True asks to keep it. By
+default the converged jobs are the ones rerun_workflow.py listed in
+completed_jobs.yml; jobs still in the queue are left alone.
+
+Readers find outputs with output_path, which falls back to the compressed
+file, and open them with open_output; pymatgen's Vasprun and Outcar read the
+.gz files themselves.
+
+    python -m vasp_run.compact [--keep-wavecar] [-j workers] [workflow_dir | job_dir ...]
+"""
+
+import os
+import bz2
+import gzip
+import lzma
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import yaml
+from pymatgen.io.vasp.inputs import Incar
+from vasp_run import schedulers
+
+COMPACT_FILES = ['vasprun.xml', 'OUTCAR', 'PROCAR', 'DOSCAR', 'CHGCAR']
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+GZIP_LEVEL = 3
+CHUNK = 1 << 20
+COMPLETED_FILE = 'completed_jobs.yml'
+
+
+def output_path(directory, name):
+    """
+    Returns: path of the output name in directory, the compressed one if only
+             that exists, the plain path if neither does
+    """
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        return path
+    for suffix in COMPRESSED_OPENERS:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+
+def open_output(path, mode='rt'):
+    """
+    Opens path, or its compressed version when only that exists
+    """
+    path = output_path(os.path.dirname(path), os.path.basename(path))
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1], open)
+    return opener(path, mode)
+
+
+def compress_file(path, level=GZIP_LEVEL):
+    """
+    Replaces path by path.gz, keeping its timestamps
+    Returns: bytes saved
+    """
+    tmp = path + '.gz.tmp'
+    with open(path, 'rb') as src, gzip.open(tmp, 'wb', compresslevel=level) as dst:
+        shutil.copyfileobj(src, dst, CHUNK)
+    shutil.copystat(path, tmp)
+    os.replace(tmp, path + '.gz')
+    saved = os.path.getsize(path) - os.path.getsize(path + '.gz')
+    os.remove(path)
+    return saved
+
+
+def compact_dir(directory, keep_wavecar=False):
+    """
+    Args:
+        directory: converged job directory
+        keep_wavecar: keep WAVECAR, also kept with AUTO_KEEP_WAVECAR = True
+    Returns: dict of the compressed and deleted files and the bytes saved
+    """
+    result = {'directory': directory, 'compressed': [], 'deleted': [], 'saved': 0}
+    incar_path = os.path.join(directory, 'INCAR')
+    if os.path.exists(incar_path):
+        keep_wavecar = keep_wavecar or bool(Incar.from_file(incar_path).get('AUTO_KEEP_WAVECAR', False))
+    stage_dir = os.path.join(directory, 'stages')
+    dirs = [directory] + ([os.path.join(stage_dir, d) for d in sorted(os.listdir(stage_dir))]
+                          if os.path.isdir(stage_dir) else [])
+    for d in dirs:
+        for name in COMPACT_FILES:
+            path = os.path.join(d, name)
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                result['saved'] += compress_file(path)
+                result['compressed'].append(path)
+    wavecar = os.path.join(directory, 'WAVECAR')
+    if not keep_wavecar and os.path.isfile(wavecar):
+        result['saved'] += os.path.getsize(wavecar)
+        os.remove(wavecar)
+        result['deleted'].append(wavecar)
+    return result
+
+
+def compact(directories, keep_wavecar=False, workers=None):
+    """
+    Compacts directories, workers (default: CPU count) at a time
+    Returns: list of the compact_dir results
+    """
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return list(pool.map(lambda d: compact_dir(d, keep_wavecar), directories))
+
+
+def converged_jobs(workflow_dir):
+    """
+    Returns: {job directory: job name} of the jobs completed_jobs.yml of
+             workflow_dir lists as converged
+    """
+    path = os.path.join(workflow_dir, COMPLETED_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        completed = yaml.safe_load(f) or {}
+    return completed.get('PATHs') or {}
+
+
+def converged_dirs(workflow_dir):
+    return sorted(converged_jobs(workflow_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=['.'],
+                        help='workflow directories (their converged jobs) or job directories')
+    parser.add_argument('--keep-wavecar', action='store_true')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    directories = []
+    for path in args.paths:
+        path = os.path.abspath(path)
+        directories.extend(converged_dirs(path) if os.path.exists(os.path.join(path, COMPLETED_FILE))
+                           else [path])
+    queued = schedulers.get_scheduler(schedulers.computer_queue_type()).status()
+    for directory in [d for d in directories if d in queued]:
+        print('%s is in the queue, not compacted' % os.path.relpath(directory))
+    results = compact([d for d in directories if d not in queued], args.keep_wavecar, args.workers)
+    for result in results:
+        print('%-50s %3d compressed %d deleted %8.1f MB saved' % (
+            os.path.relpath(result['directory']), len(result['compressed']), len(result['deleted']),
+            result['saved'] / 1e6))
+    print('Total %.1f MB saved' % (sum(result['saved'] for result in results) / 1e6))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Event log of rerun_workflow.py sweeps. Every sweep appends one JSON line per
+event to workflow_events.jsonl in the workflow directory: job discoveries,
+vasprun.xml parses, decisions, INCAR changes, submissions (with the job id
+and resources vasp.py recorded) and errors, each with its time and, where
+it took any, its duration. The console lines of a sweep are the messages of
+its events, so the log holds everything the sweep printed and more.
+
+Once the log grows past VASP_EVENT_LOG_MB (default 10) MB it is gzip
+compressed to workflow_events.1.jsonl.gz, shifting older logs up; the
+VASP_EVENT_LOG_KEEP (default 5) most recent are kept. read_events and query
+read the rotated logs too, oldest first.
+
+    python -m vasp_run.eventlog [workflow_dir] [--event E] [--job J] [--since TIME] [--console | --summary]
+"""
+
+import os
+import json
+import gzip
+import shutil
+import argparse
+import datetime
+from contextlib import contextmanager
+from time import perf_counter
+
+LOG_FILE = 'workflow_events.jsonl'
+DEFAULT_MAX_MB = 10
+DEFAULT_KEEP = 5
+
+
+def now():
+    return datetime.datetime.now().isoformat(timespec='milliseconds')
+
+
+def rotated_path(path, n):
+    return path[:-len('.jsonl')] + '.%d.jsonl.gz' % n
+
+
+class EventLog(object):
+    """
+    Writes events to LOG_FILE in directory, or only prints their messages
+    until open() is given a directory
+    """
+    def __init__(self, directory=None, max_bytes=None, keep=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get('VASP_EVENT_LOG_MB', DEFAULT_MAX_MB)) * 1e6)
+        if keep is None:
+            keep = int(os.environ.get('VASP_EVENT_LOG_KEEP', DEFAULT_KEEP))
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.path = None
+        if directory is not None:
+            self.open(directory)
+
+    def open(self, directory):
+        self.path = os.path.join(os.path.abspath(directory), LOG_FILE)
+
+    def emit(self, event, message=None, **fields):
+        """
+        Args:
+            event: event type (discover, parse, decision, incar, submit, error, ...)
+            message: console line of the event, printed once it is logged
+            fields: anything else worth keeping (job, path, duration, ...)
+        Returns: the record that was logged
+        """
+        record = {'time': now(), 'event': event}
+        record.update(fields)
+        if message is not None:
+            record['message'] = message
+        if self.path is not None:
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self.rotate()
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        line = console_line(record)
+        if line is not None:
+            print(line)
+        return record
+
+    @contextmanager
+    def timed(self, event, **fields):
+        """
+        Logs event with the duration of the block once it finishes. The
+        block can add fields to the dict it is given. An exception is logged
+        as an error event and raised again
+        """
+        start = perf_counter()
+        record = dict(fields)
+        try:
+            yield record
+        except Exception as e:
+            self.emit('error', during=event, error=repr(e),
+                      duration=round(perf_counter() - start, 4),
+                      **{k: v for (k, v) in fields.items() if k in ['job', 'path']})
+            raise
+        record['duration'] = round(perf_counter() - start, 4)
+        self.emit(event, **record)
+
+    def rotate(self):
+        for n in range(self.keep, 0, -1):
+            if os.path.exists(rotated_path(self.path, n)):
+                if n == self.keep:
+                    os.remove(rotated_path(self.path, n))
+                else:
+                    os.replace(rotated_path(self.path, n), rotated_path(self.path, n + 1))
+        if self.keep > 0:
+            tmp_path = rotated_path(self.path, 1) + '.tmp'
+            with open(self.path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, rotated_path(self.path, 1))
+        os.remove(self.path)
+
+
+def console_line(record):
+    """
+    Returns: what a sweep prints for record, None for silent events
+    """
+    return record.get('message')
+
+
+def log_paths(directory):
+    """
+    Returns: paths of the event logs of directory, oldest first
+    """
+    path = os.path.join(directory, LOG_FILE)
+    (rotated, n) = ([], 1)
+    while os.path.exists(rotated_path(path, n)):
+        rotated.insert(0, rotated_path(path, n))
+        n += 1
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def read_events(directory='.', contains=None):
+    """
+    Args:
+        contains: only the lines holding this text are parsed, which is much
+                  faster for rare events in a long history
+    Yields: the records of the event logs of directory, oldest first
+    """
+    for path in log_paths(directory):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            for line in f:
+                if contains is not None and contains not in line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a sweep killed mid-write leaves a partial last line
+                    continue
+
+
+def query(directory='.', event=None, job=None, since=None, until=None):
+    """
+    Args:
+        event: event type or list of event types
+        job: job name
+        since, until: ISO times bounding the records
+    Returns: list of the matching records, oldest first
+    """
+    events = [event] if isinstance(event, str) else event
+    return [record for record in read_events(directory)
+            if (events is None or record['event'] in events)
+            and (job is None or record.get('job') == job)
+            and (since is None or record['time'] >= since)
+            and (until is None or record['time'] <= until)]
+
+
+def job_summary(records):
+    """
+    Returns: {job directory: job name, submissions, resubmits, errors, INCAR
+             changes, last decision and the hours from each submission until
+             a sweep found the job out of the queue}
+    """
+    (jobs, submitted) = ({}, {})
+    for record in records:
+        job = record.get('path')
+        if record.get('job') is None or job is None:
+            continue
+        summary = jobs.setdefault(job, {'job': record['job'], 'submissions': 0, 'resubmits': 0, 'errors': 0,
+                                        'incar_changes': 0, 'decision': None, 'turnaround_h': []})
+        if record['event'] == 'submit':
+            summary['submissions'] += 1
+            summary['resubmits'] = summary['submissions'] - 1
+            submitted[job] = record['time']
+        elif record['event'] == 'error':
+            summary['errors'] += 1
+        elif record['event'] == 'incar':
+            summary['incar_changes'] += 1
+        elif record['event'] == 'decision':
+            summary['decision'] = record['decision']
+            if record['decision'] != 'in_queue' and job in submitted:
+                elapsed = datetime.datetime.fromisoformat(record['time']) - \
+                    datetime.datetime.fromisoformat(submitted.pop(job))
+                summary['turnaround_h'].append(round(elapsed.total_seconds() / 3600, 2))
+    return jobs
+
+
+def durations(records):
+    """
+    Returns: {event type: (count, total seconds)} of the records with a duration
+    """
+    totals = {}
+    for record in records:
+        if 'duration' in record:
+            (count, seconds) = totals.get(record['event'], (0, 0.0))
+            totals[record['event']] = (count + 1, seconds + record['duration'])
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', nargs='?', default='.')
+    parser.add_argument('--event', action='append', default=None)
+    parser.add_argument('--job', default=None)
+    parser.add_argument('--since', default=None, help='ISO time, e.g. 2024-05-01T12:00')
+    parser.add_argument('--console', action='store_true', help='print the console lines only')
+    parser.add_argument('--summary', action='store_true',
+                        help='print resubmits, errors and turnaround per job and time per event type')
+    args = parser.parse_args()
+
+    records = query(args.directory, args.event, args.job, args.since)
+    if args.summary:
+        for (path, summary) in sorted(job_summary(records).items()):
+            print('%-40s %-30s %3d submitted %3d resubmits %3d errors %3d INCAR changes  %-10s  turnaround %s h' % (
+                os.path.relpath(path, args.directory), summary['job'], summary['submissions'], summary['resubmits'], summary['errors'],
+                summary['incar_changes'], summary['decision'],
+                ', '.join(str(hours) for hours in summary['turnaround_h']) or '-'))
+        print()
+        for (event, (count, seconds)) in sorted(durations(records).items()):
+            print('%-12s %5d events %10.2f s' % (event, count, seconds))
+    elif args.console:
+        for record in records:
+            line = console_line(record)
+            if line is not None:
+                print(record['time'] + '  ' + line)
+    else:
+        for record in records:
+            print(json.dumps(record))
@@ -0,0 +1,302 @@
+"""
+Federated submission across several clusters. The job script is rendered for
+every cluster listed in VASP_FEDERATION, each cluster is asked when it would
+start the job (sbatch --test-only), and the directory is staged to and
+submitted on whichever cluster is expected to finish first.
+rerun_workflow.py syncs the results back once the cluster's accounting
+confirms the remote job has finished; while the cluster cannot be reached
+the job keeps its last known state and is checked again on the next sweep.
+
+Clusters are described in the cluster profiles (see cluster_profiles.py):
+    ssh_host: login node to run commands on, leave out to run them locally
+    remote_root: where job directories are staged, {user} is filled in
+    relative_speed: runtime on this cluster is walltime / relative_speed
+    queue_type: scheduler of the cluster, slurm by default; only Slurm
+                clusters can be federated, since the choice between clusters
+                needs sbatch --test-only
+    shared_partition, memory_per_node_mb: where --shared jobs go and how much
+        memory each of their tasks gets (see resources.py)
+    binding: CPU binding and placement settings (see binding.py)
+    scratch: node-local scratch root, copy-back lists and walltime signal
+             lead time (see scratch.py)
+    preemptible: partition and walltime signal lead time of --preemptible
+                 jobs (see preempt.py)
+    keywords: template keyword overrides (queue, cores, account, vasp paths...)
+    commands: replacement sbatch/squeue executables (e.g. for test clusters)
+"""
+
+import os
+import shlex
+import shutil
+import getpass
+import datetime
+import subprocess
+from vasp_run.cluster_profiles import load_cluster_profiles
+from vasp_run.schedulers import SCHEDULERS, FINISHED_STATES
+from vasp_run import binding
+from vasp_run import preempt
+from vasp_run import resources
+from vasp_run import scratch
+from vasp_run import workflow_state
+
+STAGE_EXCLUDE = ['backup', workflow_state.STATE_FILE]
+SYNC_EXCLUDE = [workflow_state.STATE_FILE]
+
+
+class FederatedCluster:
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+        self.ssh_host = profile.get('ssh_host')
+        self.user = profile.get('user', getpass.getuser())
+        self.remote_root = profile.get(
+            'remote_root', os.path.join('vasp_workflow', name)).format(user=self.user)
+        self.relative_speed = float(profile.get('relative_speed', 1.0))
+        self.queue_type = profile.get('queue_type', 'slurm')
+        if self.queue_type not in SCHEDULERS:
+            raise Exception('Unrecognized scheduler for ' + name + ':  ' + self.queue_type)
+        self.scheduler = SCHEDULERS[self.queue_type](runner=self.run,
+                                                     commands=profile.get('commands'))
+
+    def run(self, command, cwd=None, input=None):
+        # runs on the login node over ssh, or locally for clusters without ssh_host
+        if self.ssh_host:
+            remote_command = shlex.join(command)
+            if cwd is not None:
+                remote_command = 'cd ' + shlex.quote(cwd) + ' && ' + remote_command
+            command = ['ssh', '-o', 'BatchMode=yes', self.ssh_host, remote_command]
+            cwd = None
+        return subprocess.run(command, cwd=cwd, input=input,
+                              capture_output=True, text=True)
+
+    def remote_dir(self, path):
+        # mirror the absolute local path below remote_root so staged dirs never collide
+        return os.path.join(self.remote_root,
+                            os.path.abspath(path).lstrip(os.sep))
+
+    def render_keywords(self, keywords):
+        """
+        Args:
+            keywords: template keywords determined by vasp.py for this host,
+                      mem_estimate (MB per task) sizes shared jobs
+        Returns: copy of keywords with this cluster's overrides applied
+        """
+        cluster_keywords = dict(keywords)
+        cluster_keywords['computer'] = self.name
+        # the script is for this cluster's scheduler, not the one vasp.py runs under
+        cluster_keywords['queue_type'] = self.queue_type
+        cluster_keywords.update(self.profile.get('keywords', {}))
+        cluster_keywords['ppn'] = cluster_keywords['cores']
+        if cluster_keywords.get('shared') and \
+                'shared_partition' in self.profile and \
+                cluster_keywords['tasks'] < self.profile['cores_per_node']:
+            cluster_keywords['partition'] = self.profile['shared_partition']
+            cluster_keywords['mem_per_cpu'] = resources.shared_mem_per_cpu(
+                self.profile, cluster_keywords['tasks'], cluster_keywords['mem'],
+                cluster_keywords.get('mem_estimate', 0))
+        else:
+            cluster_keywords['shared'] = False
+            cluster_keywords['tasks'] = int(cluster_keywords['nodes'] *
+                                            cluster_keywords['cores'])
+        openmp = cluster_keywords.get('openmp', 1)
+        placement = binding.binding_settings(
+            self.profile, overrides=cluster_keywords.get('job_binding'),
+            threads=openmp)
+        cluster_keywords['binding_sbatch'] = binding.sbatch_options(placement)
+        cluster_keywords['binding_env'] = binding.environment(
+            placement, cluster_keywords.get('mpi'), openmp)
+        cluster_keywords['mpi_options'] = binding.launcher_options(
+            placement, cluster_keywords.get('mpi'), openmp)
+        if cluster_keywords.get('scratch') and int(cluster_keywords['nodes']) > 1 and \
+                not cluster_keywords.get('shared'):
+            print('Not running in node-local scratch on ' + self.name + ', the job spans ' +
+                  str(cluster_keywords['nodes']) + ' nodes')
+            cluster_keywords['scratch'] = False
+        if cluster_keywords.get('scratch'):
+            settings = self.profile.get('scratch', {})
+            cluster_keywords['scratch_root'] = settings.get('root', scratch.SCRATCH_ROOT)
+            cluster_keywords['scratch_signal'] = int(settings.get('signal_seconds',
+                                                                  scratch.SIGNAL_SECONDS))
+        if cluster_keywords.get('preemptible'):
+            cluster_keywords.update(preempt.preempt_settings(self.profile, enabled=True))
+        return cluster_keywords
+
+    def expected_start(self, script_text):
+        """
+        Args:
+            script_text: rendered submission script for this cluster
+        Returns: datetime the scheduler expects to start the job, None if it
+                 would not accept it
+        """
+        return self.scheduler.expected_start(script_text)
+
+    def expected_finish(self, script_text, hours):
+        start = self.expected_start(script_text)
+        if start is None:
+            return None
+        return start + datetime.timedelta(hours=hours / self.relative_speed)
+
+    def stage(self, path):
+        remote_dir = self.remote_dir(path)
+        if self.ssh_host:
+            self.run(['mkdir', '-p', remote_dir])
+            subprocess.run(['rsync', '-a'] +
+                           ['--exclude=' + e for e in STAGE_EXCLUDE] +
+                           [os.path.abspath(path) + os.sep,
+                            self.ssh_host + ':' + remote_dir + os.sep],
+                           check=True)
+        else:
+            shutil.copytree(path, remote_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns(*STAGE_EXCLUDE))
+        return remote_dir
+
+    def sync_back(self, path, remote_dir):
+        if self.ssh_host:
+            subprocess.run(['rsync', '-a'] +
+                           ['--exclude=' + e for e in SYNC_EXCLUDE] +
+                           [self.ssh_host + ':' + remote_dir + os.sep,
+                            os.path.abspath(path) + os.sep],
+                           check=True)
+        else:
+            shutil.copytree(remote_dir, path, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns(*SYNC_EXCLUDE))
+
+    def submit(self, path, script):
+        """
+        Args:
+            path: local VASP directory, already containing script
+            script: name of the submission script
+        Returns: (job id, remote directory)
+        """
+        remote_dir = self.stage(path)
+        return self.scheduler.submit(script, cwd=remote_dir), remote_dir
+
+    def status(self, job_id):
+        """
+        Returns: queue state of job_id, its final state (one of
+                 FINISHED_STATES) once the accounting confirms it has
+                 finished, None when the cluster could not tell
+        """
+        state = self.scheduler.job_status(job_id)
+        if state is not None:
+            return state
+        # not in the queue, or squeue/ssh failed: only the accounting tells
+        for record in self.scheduler.accounting([job_id]):
+            if str(record['job_id']) == str(job_id) and record['state'] in FINISHED_STATES:
+                return record['state']
+        return None
+
+
+def get_federated_clusters(names=None):
+    """
+    Args:
+        names: cluster names, defaults to the comma separated VASP_FEDERATION
+    Returns: list of FederatedCluster
+    """
+    if names is None:
+        names = [n.strip() for n in os.environ.get('VASP_FEDERATION', '').split(',')
+                 if n.strip() != '']
+    if len(names) == 0:
+        raise Exception('Set VASP_FEDERATION to a comma separated list of clusters')
+    profiles = load_cluster_profiles()
+    clusters = []
+    for name in names:
+        if name not in profiles:
+            raise Exception('No cluster profile for federated cluster ' + name)
+        cluster = FederatedCluster(name, profiles[name])
+        if not hasattr(cluster.scheduler, 'expected_start'):
+            raise Exception('Federated cluster ' + name + ' runs ' + cluster.queue_type +
+                            ', only Slurm clusters (sbatch --test-only) can be federated')
+        clusters.append(cluster)
+    return clusters
+
+
+def choose_cluster(clusters, scripts, hours):
+    """
+    Args:
+        clusters: list of FederatedCluster
+        scripts: {cluster name: rendered script}
+        hours: requested walltime
+    Returns: (cluster expected to finish first, expected finish datetime)
+    """
+    best = None
+    for cluster in clusters:
+        finish = cluster.expected_finish(scripts[cluster.name], hours)
+        if finish is None:
+            continue
+        print(cluster.name + ' expected to finish at ' + finish.isoformat())
+        if best is None or finish < best[1]:
+            best = (cluster, finish)
+    if best is None:
+        raise Exception('No federated cluster accepted the job')
+    return best
+
+
+def submit_federated(path, scripts, hours, script, clusters=None):
+    """
+    Args:
+        path: local VASP directory
+        scripts: {cluster name: rendered script}
+        hours: requested walltime
+        script: file name to write the winning script to
+        clusters: list of FederatedCluster, defaults to VASP_FEDERATION
+    Returns: (cluster submitted to, job id)
+    """
+    if clusters is None:
+        clusters = get_federated_clusters()
+    cluster, finish = choose_cluster(clusters, scripts, hours)
+    with open(os.path.join(path, script), 'w') as f:
+        f.write(scripts[cluster.name])
+    job_id, remote_dir = cluster.submit(path, script)
+    workflow_state.record_submission(path, job_id, cluster=cluster.name,
+                                     remote_dir=remote_dir,
+                                     expected_finish=finish.isoformat(),
+                                     synced=False)
+    return cluster, job_id
+
+
+def update_submission(path, **fields):
+    state = workflow_state.read_job_state(path)
+    state['submissions'][-1].update(fields)
+    workflow_state.write_job_state(state, path)
+
+
+def federated_status(path):
+    """
+    Checks the remote queue for the last federated submission of path and
+    syncs the results back once the job has finished
+    Args:
+        path: local VASP directory
+    Returns: remote queue status while the job is queued or running, the
+             last known status while the cluster cannot be asked or the
+             results cannot be synced, None once they are synced back
+    """
+    submission = workflow_state.last_submission(path)
+    if submission is None or 'remote_dir' not in submission or submission.get('synced'):
+        return None
+    profile = load_cluster_profiles().get(submission['cluster'], {})
+    cluster = FederatedCluster(submission['cluster'], profile)
+    try:
+        status = cluster.status(submission['job_id'])
+    except Exception as e:
+        print('Could not ask ' + cluster.name + ' about job ' + str(submission['job_id']) + ':  ' + str(e))
+        status = None
+    if status is None:
+        last_state = submission.get('remote_state', 'UNKNOWN')
+        print('No state for job ' + str(submission['job_id']) + ' on ' + cluster.name +
+              ', last known ' + last_state)
+        return last_state
+    if status not in FINISHED_STATES:
+        if status != submission.get('remote_state'):
+            update_submission(path, remote_state=status)
+        return status
+
+    try:
+        cluster.sync_back(path, submission['remote_dir'])
+    except (subprocess.CalledProcessError, OSError) as e:
+        print('Could not sync ' + path + ' back from ' + cluster.name + ':  ' + str(e))
+        return 'SYNC_FAILED'
+    update_submission(path, remote_state=status, final_state=status,
+                                          synced=workflow_state.now())
+    print('Synced ' + path + ' back from ' + cluster.name)
+    return None
@@ -0,0 +1,202 @@
+"""
+Custodian handlers used by the job templates on top of the ones from
+custodian and Classes_Custodian.
+"""
+
+import os
+import time
+import shutil
+from custodian.custodian import ErrorHandler
+from vasp_run import preempt
+from vasp_run import probe
+from vasp_run import progress
+from vasp_run import workflow_state
+
+__all__ = ['PreemptionHandler', 'HangHandler', 'ProgressHandler']
+
+# a run is hung once its outputs stop growing for HANG_FACTOR times its
+# average SCF step, but never sooner than HANG_MIN_SECONDS, or
+# HANG_STARTUP_SECONDS before the first SCF step is done
+HANG_FACTOR = 10
+HANG_MIN_SECONDS = 30 * 60
+HANG_STARTUP_SECONDS = 60 * 60
+HANG_RESTARTS = 2
+HANG_WINDOW = 10
+WATCHED_FILES = ['OUTCAR', 'OSZICAR']
+HANG_TAGS = {'AUTO_HANG_FACTOR': 'factor', 'AUTO_HANG_MINUTES': 'min_seconds',
+             'AUTO_HANG_RESTARTS': 'restarts'}
+
+
+def hang_settings(incar):
+    """
+    Returns: HangHandler arguments set by the AUTO_HANG_ tags of incar
+    """
+    settings = {}
+    for (tag, argument) in HANG_TAGS.items():
+        if tag in incar:
+            settings[argument] = int(incar[tag]) * (60 if tag == 'AUTO_HANG_MINUTES' else 1)
+    return settings
+
+
+def record_event(directory, event):
+    """
+    Appends event to the events of job_state.json, in the job directory
+    when the run is in node-local scratch
+    """
+    job_dir = os.environ.get('VASP_SCRATCH_JOB_DIR', directory)
+    event = dict(event, time=workflow_state.now(),
+                 job_id=os.environ.get('SLURM_JOB_ID', os.environ.get('PBS_JOBID')))
+    state = workflow_state.read_job_state(job_dir)
+    state.setdefault('events', []).append(event)
+    workflow_state.write_job_state(state, job_dir)
+    return event
+
+
+class PreemptionHandler(ErrorHandler):
+    """
+    Ends the Custodian run once the job script has marked it as preempted
+    (see preempt.py), so no correction or next stage is started while the
+    job checkpoints.
+    """
+    is_monitor = False
+    raises_runtime_error = False
+
+    def check(self, directory='./'):
+        return preempt.preempted(directory)
+
+    def correct(self, directory='./'):
+        return {'errors': ['Preempted'], 'actions': None}
+
+
+class HangHandler(ErrorHandler):
+    """
+    Kills and restarts a VASP run whose OUTCAR and OSZICAR (of every image
+    for NEB) have stopped growing for much longer than its own SCF steps
+    take, as after an MPI deadlock or on a stuck filesystem. The run
+    restarts from its CONTCAR (of every image). A hang after restarts
+    restarts of one stage, or in a run without a CONTCAR to restart from,
+    returns no actions: Custodian kills the run and stops the job
+    (NonRecoverableError) instead of burning the rest of the walltime. The
+    limit is kept here rather than with max_num_corrections, since the
+    templates run Custodian with skip_over_errors, which swallows
+    MaxCorrectionsPerHandlerError and leaves the hung run going. Every hang
+    is recorded in the events of job_state.json.
+    """
+    is_monitor = True
+
+    def __init__(self, factor=HANG_FACTOR, min_seconds=HANG_MIN_SECONDS,
+                 startup_seconds=HANG_STARTUP_SECONDS, restarts=HANG_RESTARTS,
+                 window=HANG_WINDOW):
+        """
+        Args:
+            factor: multiple of the moving average SCF step time without
+                    output growth that counts as a hang
+            min_seconds: shortest time without output growth that counts as a hang
+            startup_seconds: time without output growth that counts as a hang
+                             before the first SCF step is done
+            restarts: restarts per stage before giving up
+            window: number of recent SCF steps in the moving average
+        """
+        self.factor = factor
+        self.min_seconds = min_seconds
+        self.startup_seconds = startup_seconds
+        self.restarts = restarts
+        self.window = window
+        self.n_applied_corrections = 0
+        self.reset()
+
+    def reset(self):
+        self.steps = []
+        self.offset = 0
+        self.sizes = None
+        self.last_change = time.time()
+
+    def watched(self, directory):
+        folders = [''] + preempt.image_dirs(directory)
+        return [os.path.join(directory, folder, name) for folder in folders for name in WATCHED_FILES]
+
+    def read_steps(self, directory):
+        # only the part of the OUTCAR written since the last check is read
+        outcar = os.path.join(directory, 'OUTCAR')
+        if not os.path.exists(outcar):
+            return
+        if os.path.getsize(outcar) < self.offset:
+            # a new run started
+            (self.steps, self.offset) = ([], 0)
+        with open(outcar) as f:
+            f.seek(self.offset)
+            for line in f:
+                match = probe.LOOP_PATTERN.search(line)
+                if match:
+                    self.steps.append(float(match.group(1)))
+            self.offset = f.tell()
+        self.steps = self.steps[-self.window:]
+
+    def threshold(self):
+        if not self.steps:
+            return self.startup_seconds
+        return max(self.min_seconds, self.factor * sum(self.steps) / len(self.steps))
+
+    def check(self, directory='./'):
+        sizes = [(os.path.getsize(path), os.path.getmtime(path)) if os.path.exists(path) else None
+                 for path in self.watched(directory)]
+        if sizes != self.sizes:
+            (self.sizes, self.last_change) = (sizes, time.time())
+            self.read_steps(directory)
+            return False
+        return time.time() - self.last_change >= self.threshold()
+
+    def correct(self, directory='./'):
+        """
+        Returns: the CONTCAR copies the run restarts from, actions None (the
+                 job stops) once the restarts of the stage are used up or
+                 when there is no CONTCAR to restart from
+        """
+        idle = time.time() - self.last_change
+        event = {'idle_seconds': int(idle), 'threshold_seconds': int(self.threshold())}
+        if self.n_applied_corrections >= self.restarts:
+            self.reset()
+            record_event(directory, dict(event, event='hang_abandoned', reason='restarts used up',
+                                         restarts=self.n_applied_corrections))
+            return {'errors': ['Hung'], 'actions': None}
+        actions = []
+        for folder in [''] + preempt.image_dirs(directory):
+            contcar = os.path.join(directory, folder, 'CONTCAR')
+            if os.path.exists(contcar) and os.path.getsize(contcar) > 0:
+                shutil.copy(contcar, os.path.join(directory, folder, 'POSCAR'))
+                actions.append({'file': os.path.join(folder, 'CONTCAR'),
+                                'action': {'_file_copy': {'dest': os.path.join(folder, 'POSCAR')}}})
+        self.reset()
+        if not actions:
+            record_event(directory, dict(event, event='hang_abandoned', reason='no CONTCAR',
+                                         restarts=self.n_applied_corrections))
+            return {'errors': ['Hung'], 'actions': None}
+        record_event(directory, dict(event, event='hang_restart', restart=self.n_applied_corrections + 1))
+        return {'errors': ['Hung'], 'actions': actions}
+
+
+class ProgressHandler(ErrorHandler):
+    """
+    Never finds an error, it only keeps progress.json (see progress.py) up
+    to date at every monitor check and once more when each run ends
+    """
+    is_monitor = True
+
+    def __init__(self, walltime=None):
+        """
+        Args:
+            walltime: walltime of the job in seconds, bounds the remaining time
+        """
+        self.walltime = walltime
+        self.started = time.time()
+        self.reader = None
+
+    def check(self, directory='./'):
+        if self.reader is None or self.reader.directory != directory:
+            self.reader = progress.OutputReader(directory)
+        progress.write_progress(progress.job_progress(self.reader, self.started, self.walltime),
+                                os.environ.get('VASP_SCRATCH_JOB_DIR', directory))
+        return False
+
+    def correct(self, directory='./'):
+        return {'errors': [], 'actions': []}
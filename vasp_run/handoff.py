@@ -0,0 +1,194 @@
+"""
+WAVECAR and CHGCAR handoff between the stages of a multistep run. Before
+get_runs starts the next stage it works out the INCAR and KPOINTS that stage
+will run with and checks what the finished stage left behind:
+    WAVECAR  same ENCUT (PREC when neither sets ENCUT), k-mesh, number of
+             atoms, ISPIN and noncollinear/SOC setting, and a header that
+             agrees with them
+    CHGCAR   same number of atoms, ISPIN and noncollinear/SOC setting
+The next stage then starts from the wavefunctions (ISTART = 1, ICHARG = 0),
+from the charge density (ISTART = 0, ICHARG = 1) or from scratch
+(ISTART = 0, ICHARG = 2). A stage that sets ISTART or ICHARG in the
+CONVERGENCE file keeps them, as does an INCAR that sets them to anything
+but what the last handoff chose, and a fixed charge density (ICHARG >= 10)
+is never replaced. AUTO_HANDOFF = False turns the handoff off. Each
+decision is recorded as a handoff event in job_state.json.
+"""
+
+import os
+import struct
+from custodian.ansible.interpreter import Modder
+from pymatgen.io.vasp.inputs import Poscar
+from vasp_run import handlers
+from vasp_run import workflow_state
+
+START_TAGS = ['ISTART', 'ICHARG']
+FROM_WAVECAR = {'ISTART': 1, 'ICHARG': 0}
+FROM_CHGCAR = {'ISTART': 0, 'ICHARG': 1}
+FROM_SCRATCH = {'ISTART': 0, 'ICHARG': 2}
+STARTS = {'WAVECAR': FROM_WAVECAR, 'CHGCAR': FROM_CHGCAR, None: FROM_SCRATCH}
+
+
+def next_inputs(incar, kpoints, settings):
+    """
+    Returns: (Incar, Kpoints) after the dict actions of settings, as
+             Custodian applies them when the stage starts
+    """
+    inputs = {'INCAR': incar, 'KPOINTS': kpoints}
+    for setting in settings:
+        if setting.get('dict') in inputs:
+            current = inputs[setting['dict']]
+            d = current.as_dict()
+            Modder().modify(setting['action'], d)
+            inputs[setting['dict']] = current.__class__.from_dict(d)
+    return (inputs['INCAR'], inputs['KPOINTS'])
+
+
+def sets_start(settings):
+    # the stage asks for its own ISTART/ICHARG
+    for setting in settings:
+        if setting.get('dict') == 'INCAR':
+            for change in setting['action'].values():
+                if isinstance(change, dict) and any(tag in change for tag in START_TAGS):
+                    return True
+    return False
+
+
+def explicit_start(directory, incar):
+    """
+    Returns: True if incar has ISTART/ICHARG that the last handoff recorded
+             for directory did not set, or a fixed charge density (ICHARG >= 10)
+    """
+    present = {tag: int(incar[tag]) for tag in START_TAGS if tag in incar}
+    if not present:
+        return False
+    if present.get('ICHARG', 0) >= 10:
+        return True
+    job_dir = os.environ.get('VASP_SCRATCH_JOB_DIR', directory)
+    handoffs = [event for event in workflow_state.read_job_state(job_dir).get('events', [])
+                if event.get('event') == 'handoff']
+    if not handoffs:
+        return True
+    start = STARTS[handoffs[-1]['source']]
+    return any(start[tag] != value for (tag, value) in present.items())
+
+
+def wavecar_header(path):
+    """
+    Returns: (spin components, k-points, ENCUT) from the header of a WAVECAR,
+             None if it cannot be read
+    """
+    try:
+        with open(path, 'rb') as f:
+            (record_length, spins, _) = struct.unpack('3d', f.read(24))
+            if record_length < 24:
+                return None
+            f.seek(int(record_length))
+            (nkpts, _, encut) = struct.unpack('3d', f.read(24))
+    except (OSError, struct.error):
+        return None
+    return (int(spins), int(nkpts), encut)
+
+
+def run_dirs(directory, incar):
+    # NEB runs keep their outputs in the image directories
+    images = int(incar.get('IMAGES', 0))
+    if images:
+        return [os.path.join(directory, '%02d' % i) for i in range(1, images + 1)]
+    return [directory]
+
+
+def natoms(path):
+    try:
+        return sum(Poscar.from_file(path, check_for_potcar=False).natoms)
+    except Exception:
+        return None
+
+
+def spin(incar):
+    return (int(incar.get('ISPIN', 1)), bool(incar.get('LNONCOLLINEAR', False) or incar.get('LSORBIT', False)),
+            bool(incar.get('LSORBIT', False)))
+
+
+def basis(incar):
+    if 'ENCUT' in incar:
+        return (float(incar['ENCUT']), None)
+    return (None, str(incar.get('PREC', 'Normal')).lower())
+
+
+def kmesh(kpoints):
+    d = kpoints.as_dict()
+    return (str(d['generation_style']).lower()[0], [[float(k) for k in kpt] for kpt in d['kpoints']],
+            [float(s) for s in d.get('usershift') or [0, 0, 0]])
+
+
+def output(directory, name, incar, tag):
+    path = os.path.join(directory, name)
+    if not incar.get(tag, True) or not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    return path
+
+
+def check_handoff(directory, previous_incar, incar, previous_kpoints, kpoints):
+    """
+    Args:
+        directory: run directory of the finished stage
+        previous_incar, previous_kpoints: inputs of the finished stage
+        incar, kpoints: inputs of the next stage
+    Returns: {'WAVECAR': reason, 'CHGCAR': reason}, a reason being None when
+             the next stage can read the file
+    """
+    common = []
+    if spin(previous_incar) != spin(incar):
+        common.append('ISPIN/noncollinear/SOC %s -> %s' % (spin(previous_incar), spin(incar)))
+    dirs = run_dirs(directory, incar)
+    for d in dirs:
+        if natoms(os.path.join(d, 'POSCAR')) != natoms(os.path.join(d, 'CONTCAR')):
+            common.append('number of atoms in ' + os.path.relpath(d, directory))
+    wavecar = list(common)
+    if basis(previous_incar) != basis(incar):
+        wavecar.append('ENCUT/PREC %s -> %s' % (basis(previous_incar), basis(incar)))
+    if kmesh(previous_kpoints) != kmesh(kpoints):
+        wavecar.append('k-mesh')
+    chgcar = list(common)
+    for d in dirs:
+        path = output(d, 'WAVECAR', previous_incar, 'LWAVE')
+        header = wavecar_header(path) if path else None
+        if path is None:
+            wavecar.append('no WAVECAR')
+        elif header is None:
+            wavecar.append('unreadable WAVECAR')
+        elif header[0] != (1 if spin(incar)[1] else spin(incar)[0]):
+            wavecar.append('WAVECAR has %d spin components' % header[0])
+        elif 'ENCUT' in incar and abs(header[2] - float(incar['ENCUT'])) > 1e-3:
+            wavecar.append('WAVECAR ENCUT %g' % header[2])
+        if output(d, 'CHGCAR', previous_incar, 'LCHARG') is None:
+            chgcar.append('no CHGCAR')
+    return {'WAVECAR': '; '.join(dict.fromkeys(wavecar)) or None,
+            'CHGCAR': '; '.join(dict.fromkeys(chgcar)) or None}
+
+
+def handoff_settings(directory, incar, kpoints, settings, stage=None):
+    """
+    Args:
+        directory: run directory of the finished stage
+        incar, kpoints: inputs of the finished stage
+        settings: Custodian settings that start the next stage
+        stage: next stage, for the event
+    Returns: settings setting ISTART and ICHARG for the next stage
+    """
+    (next_incar, next_kpoints) = next_inputs(incar, kpoints, settings)
+    if not next_incar.get('AUTO_HANDOFF', True) or sets_start(settings) or \
+            explicit_start(directory, next_incar):
+        return []
+    reasons = check_handoff(directory, incar, next_incar, kpoints, next_kpoints)
+    if reasons['WAVECAR'] is None:
+        (start, source) = (FROM_WAVECAR, 'WAVECAR')
+    elif reasons['CHGCAR'] is None:
+        (start, source) = (FROM_CHGCAR, 'CHGCAR')
+    else:
+        (start, source) = (FROM_SCRATCH, None)
+    handlers.record_event(directory, {'event': 'handoff', 'stage': stage, 'source': source,
+                                      'incompatible': {name: reason for (name, reason) in reasons.items()
+                                                       if reason is not None}})
+    return [{'dict': 'INCAR', 'action': {'_set': dict(start)}}]
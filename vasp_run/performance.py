@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Performance records of finished runs, read from the timing data VASP writes
+to its OUTCAR. The OUTCAR (plain or compressed, see compact.py) is streamed
+once for the parallel layout (MPI ranks, OpenMP threads, KPAR, NCORE), the
+size (NBANDS, NPLWV, NKPTS), the real time of every SCF step (LOOP:) and
+ionic step (LOOP+:), the memory high-water mark and the elapsed and CPU time.
+The record keeps the per-ionic-step times and SCF counts with summary
+figures, not the per-SCF times.
+
+flag_anomalies compares jobs with the same layout by their SCF time per unit
+of work (NBANDS * NPLWV * NKPTS) and flags the ones SLOW_FACTOR times slower
+than their peers, as well as runs whose CPU time is well below their wall
+time (waiting on communication or I/O) and runs whose SCF steps slowed down
+over the run.
+
+    python -m vasp_run.performance [-j workers] [--json] [workflow_dir | job_dir ...]
+"""
+
+import os
+import re
+import json
+import argparse
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+from vasp_run import archive
+from vasp_run import backup_store
+from vasp_run import compact
+from vasp_run import probe
+from vasp_run import stages
+
+LOOP_PLUS_PATTERN = re.compile(r'LOOP\+:\s+cpu time\s+[\d.]+:\s+real time\s+([\d.]+)')
+# (marker checked before the regex, pattern, key)
+PATTERNS = [('running on', re.compile(r'running on\s+(\d+) total cores'), 'ranks'),
+            ('mpi-ranks', re.compile(r'running\s+(\d+) mpi-ranks'), 'ranks'),
+            ('threads/rank', re.compile(r'with\s+(\d+) threads/rank'), 'threads'),
+            ('distrk', re.compile(r'distrk:.*cores,\s+(\d+) groups'), 'kpar'),
+            ('NCORE', re.compile(r'distr:\s+one band on NCORE=\s*(\d+)'), 'ncore'),
+            # the array dimensions line, not the INCAR echo VASP may round up
+            ('NBANDS=', re.compile(r'NBANDS=\s*(\d+)'), 'nbands'),
+            ('NPLWV', re.compile(r'NPLWV\s*=\s*(\d+)'), 'nplwv'),
+            ('NKPTS', re.compile(r'NKPTS\s*=\s*(\d+)'), 'nkpts'),
+            ('Maximum memory', re.compile(r'Maximum memory used \(kb\):\s+([\d.]+)'), 'max_memory_kb'),
+            ('Total CPU', re.compile(r'Total CPU time used \(sec\):\s+([\d.]+)'), 'cpu_seconds'),
+            ('Elapsed', re.compile(r'Elapsed time \(sec\):\s+([\d.]+)'), 'elapsed_seconds')]
+LAYOUT_KEYS = ['ranks', 'threads', 'kpar', 'ncore']
+SLOW_FACTOR = 2.0
+MIN_PEERS = 3
+LOW_CPU_RATIO = 0.8
+SLOWDOWN_FACTOR = 1.5
+SKIP_DIRS = [probe.PROBE_DIR, backup_store.STORE_DIR, archive.ARCHIVE_DIR, stages.ARCHIVE_DIR, 'backup']
+
+
+def read_outcar(path):
+    """
+    Args:
+        path: OUTCAR, read from OUTCAR.gz (or .bz2, .xz) when it was compacted
+    Returns: dict of the layout and size, max_memory_kb, cpu_seconds,
+             elapsed_seconds, ionic_times (LOOP+ real time of every ionic step)
+             and scf_times (lists of LOOP real times, one per ionic step)
+    """
+    path = compact.output_path(os.path.dirname(path), os.path.basename(path))
+    found = {'ionic_times': [], 'scf_times': [[]]}
+    with compact.open_output(path) as f:
+        for line in f:
+            if 'LOOP' in line:
+                match = probe.LOOP_PATTERN.search(line)
+                if match:
+                    found['scf_times'][-1].append(float(match.group(1)))
+                    continue
+                match = LOOP_PLUS_PATTERN.search(line)
+                if match:
+                    found['ionic_times'].append(float(match.group(1)))
+                    found['scf_times'].append([])
+                continue
+            for (marker, pattern, key) in PATTERNS:
+                if marker in line and key not in found:
+                    match = pattern.search(line)
+                    if match:
+                        found[key] = float(match.group(1))
+    if found['scf_times'][-1] == [] and len(found['scf_times']) > 1:
+        found['scf_times'].pop()
+    return found
+
+
+def job_record(directory):
+    """
+    Returns: compact performance record of the last run in directory, None
+             if it has no OUTCAR with SCF timings
+    """
+    outcar = compact.output_path(directory, 'OUTCAR')
+    if not os.path.exists(outcar):
+        return None
+    found = read_outcar(outcar)
+    scf = [t for steps in found['scf_times'] for t in steps]
+    if not scf:
+        return None
+    record = {'directory': directory}
+    for key in LAYOUT_KEYS + ['nbands', 'nplwv', 'nkpts']:
+        record[key] = int(found.get(key, 1 if key in ['threads', 'kpar', 'ncore', 'nkpts'] else 0))
+    record['scf_steps'] = len(scf)
+    record['first_scf_seconds'] = scf[0]
+    # the first SCF step also sets up the run, leave it out when possible
+    record['scf_seconds'] = statistics.median(scf[1:] if len(scf) > 1 else scf)
+    record['max_scf_seconds'] = max(scf)
+    record['ionic_steps'] = len(found['ionic_times'])
+    record['ionic_seconds'] = [round(t, 3) for t in found['ionic_times']]
+    record['scf_per_ionic'] = [len(steps) for steps in found['scf_times']]
+    record['max_memory_mb'] = round(found['max_memory_kb'] / 1024.0, 1) if 'max_memory_kb' in found else None
+    record['elapsed_seconds'] = found.get('elapsed_seconds')
+    record['cpu_ratio'] = round(found['cpu_seconds'] / found['elapsed_seconds'], 3) \
+        if found.get('elapsed_seconds') and 'cpu_seconds' in found else None
+    work = record['nbands'] * record['nplwv'] * record['nkpts']
+    record['seconds_per_unit'] = record['scf_seconds'] / work if work else None
+    # SCF steps of the last ionic step against those of the first, without the setup step
+    (first, last) = (found['scf_times'][0][1:] or found['scf_times'][0], found['scf_times'][-1])
+    record['scf_slowdown'] = round(statistics.median(last) / statistics.median(first), 3) \
+        if len(found['scf_times']) > 1 and first and last and statistics.median(first) > 0 else None
+    return record
+
+
+def job_dirs(directory):
+    """
+    Returns: sorted directories under directory with an OUTCAR (or a compacted one)
+    """
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        if any(f == 'OUTCAR' or f.startswith('OUTCAR.') and f[len('OUTCAR'):] in compact.COMPRESSED_OPENERS
+               for f in files):
+            found.append(root)
+    return sorted(found)
+
+
+def profile_jobs(directories, workers=None):
+    """
+    Reads the job directories in parallel
+    Returns: list of the performance records (see job_record) of the
+             directories that have one
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [record for record in executor.map(job_record, directories, chunksize=8)
+                if record is not None]
+
+
+def layout_key(record):
+    return tuple(record[key] for key in LAYOUT_KEYS)
+
+
+def flag_anomalies(records, slow_factor=SLOW_FACTOR, min_peers=MIN_PEERS):
+    """
+    Adds 'flags' to every record: slow_scf when its SCF time per unit of
+    work is slow_factor times the median of at least min_peers other jobs
+    with the same layout, low_cpu_ratio and scf_slowdown
+    Returns: records
+    """
+    by_layout = {}
+    for record in records:
+        if record['seconds_per_unit']:
+            by_layout.setdefault(layout_key(record), []).append(record)
+    for record in records:
+        record['flags'] = []
+        peers = [r['seconds_per_unit'] for r in by_layout.get(layout_key(record), []) if r is not record]
+        if record['seconds_per_unit'] and len(peers) >= min_peers:
+            record['peer_ratio'] = round(record['seconds_per_unit'] / statistics.median(peers), 2)
+            if record['peer_ratio'] >= slow_factor:
+                record['flags'].append('slow_scf')
+        if record['cpu_ratio'] is not None and record['cpu_ratio'] < LOW_CPU_RATIO:
+            record['flags'].append('low_cpu_ratio')
+        if record['scf_slowdown'] is not None and record['scf_slowdown'] >= SLOWDOWN_FACTOR:
+            record['flags'].append('scf_slowdown')
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=['.'], help='workflow or job directories')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='print the records as JSON lines')
+    parser.add_argument('--flagged', action='store_true', help='only the jobs with anomalies')
+    args = parser.parse_args()
+
+    directories = sorted(set(d for path in args.paths for d in job_dirs(os.path.abspath(path))))
+    records = flag_anomalies(profile_jobs(directories, args.workers))
+    if args.flagged:
+        records = [r for r in records if r['flags']]
+    if args.json:
+        for record in records:
+            print(json.dumps(record))
+    else:
+        print('%-40s %14s %6s %7s %6s %8s %8s %6s  %s' % (
+            'job', 'ranks/thr/k/nc', 'NBANDS', 'NPLWV', 'SCF', 's/SCF', 'mem MB', 'peers', 'flags'))
+        for r in records:
+            print('%-40s %14s %6d %7d %6d %8.2f %8s %6s  %s' % (
+                os.path.relpath(r['directory']), '%d/%d/%d/%d' % layout_key(r), r['nbands'], r['nplwv'],
+                r['scf_steps'], r['scf_seconds'], r['max_memory_mb'] or '-', r.get('peer_ratio', '-'),
+                ' '.join(r['flags'])))
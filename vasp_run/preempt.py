@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Preemption-safe runs (vasp.py --preemptible or AUTO_PREEMPTIBLE). The job
+asks for USR1 some time before its walltime (--signal=B:USR1@N) and is
+marked requeueable. On USR1, or on the SIGTERM of a preemption, the job
+script writes STOPCAR with LABORT so VASP stops after its current electronic
+step, and PreemptionHandler stops Custodian from starting anything else.
+Once Custodian is done the job checkpoints: CONTCAR, WAVECAR and the
+current stage are saved to the job directory (copied back from scratch
+first), CONTCAR becomes the POSCAR and a resume record is left in
+job_state.json. After USR1 the job requeues itself, after a preemption
+Slurm does. A job that was cancelled instead is resumed by rerun_workflow
+from the resume record, without treating the stop as a failed run.
+
+    python -m vasp_run.preempt start job_dir
+    python -m vasp_run.preempt stop run_dir signal
+    python -m vasp_run.preempt checkpoint run_dir job_dir
+"""
+
+import os
+import json
+import shutil
+import argparse
+from pymatgen.io.vasp.inputs import Incar
+from vasp_run import scratch
+from vasp_run import workflow_state
+
+PREEMPT_FILE = 'PREEMPTED'
+STOP_FILE = 'STOPCAR'
+SIGNAL_SECONDS = 120
+# saved from scratch even when the copy-back lists leave them out
+RESTART_FILES = ['CONTCAR', 'WAVECAR', 'CHGCAR', 'NEWMODECAR']
+
+
+def preempt_settings(profile, incar=None, enabled=False):
+    """
+    Args:
+        profile: cluster profile, may hold a preemptible dict with partition
+                 and signal_seconds
+        incar: Incar (or dict) with AUTO_PREEMPTIBLE
+        enabled: preemptible was asked for on the command line
+    Returns: dict of the preemption template keywords
+    """
+    incar = incar or {}
+    settings = profile.get('preemptible', {})
+    return {'preemptible': bool(enabled or incar.get('AUTO_PREEMPTIBLE', False)),
+            'preempt_partition': settings.get('partition', ''),
+            'preempt_signal': int(settings.get('signal_seconds', SIGNAL_SECONDS))}
+
+
+def image_dirs(path):
+    return sorted(d for d in os.listdir(path) if d.isdigit() and os.path.isdir(os.path.join(path, d)))
+
+
+def start(job_dir):
+    # a (re)started job has nothing left to resume
+    workflow_state.update_job_state(job_dir, resume=None)
+
+
+def stop(run_dir, signal_name):
+    """
+    Asks VASP to stop after the current electronic step and marks the run
+    as preempted
+    """
+    with open(os.path.join(run_dir, STOP_FILE), 'w') as f:
+        f.write('LABORT = .TRUE.\n')
+    with open(os.path.join(run_dir, PREEMPT_FILE), 'w') as f:
+        json.dump({'signal': signal_name, 'time': workflow_state.now()}, f)
+
+
+def preempted(run_dir):
+    return os.path.exists(os.path.join(run_dir, PREEMPT_FILE))
+
+
+def checkpoint(run_dir, job_dir=None):
+    """
+    Args:
+        run_dir: directory VASP ran in (node-local scratch or the job directory)
+        job_dir: job directory, run_dir if None
+    Returns: the preemption record added to job_state.json
+    """
+    job_dir = job_dir or run_dir
+    with open(os.path.join(run_dir, PREEMPT_FILE)) as f:
+        record = json.load(f)
+    if os.path.abspath(run_dir) != os.path.abspath(job_dir):
+        scratch.copy_back(run_dir, job_dir)
+        for folder in [''] + image_dirs(run_dir):
+            for name in RESTART_FILES:
+                source = os.path.join(run_dir, folder, name)
+                if os.path.isfile(source):
+                    scratch.copy_file(source, os.path.join(job_dir, folder, name))
+    for folder in [''] + image_dirs(job_dir):
+        contcar = os.path.join(job_dir, folder, 'CONTCAR')
+        if os.path.exists(contcar) and os.path.getsize(contcar) > 0:
+            shutil.copy(contcar, os.path.join(job_dir, folder, 'POSCAR'))
+    for path in set([run_dir, job_dir]):
+        for name in [STOP_FILE, PREEMPT_FILE]:
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+
+    incar = Incar.from_file(os.path.join(job_dir, 'INCAR'))
+    record['stage'] = incar.get('STAGE_NUMBER')
+    record['job_id'] = os.environ.get('SLURM_JOB_ID', os.environ.get('PBS_JOBID'))
+    state = workflow_state.read_job_state(job_dir)
+    state.setdefault('preemptions', []).append(record)
+    state['resume'] = record
+    workflow_state.write_job_state(state, job_dir)
+    return record
+
+
+def resume_pending(job_dir):
+    """
+    Returns: the preemption record of a checkpointed job that has not been
+             restarted yet, None otherwise
+    """
+    return workflow_state.read_job_state(job_dir).get('resume')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=['start', 'stop', 'checkpoint'])
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    if args.action == 'start':
+        start(args.paths[0])
+    elif args.action == 'stop':
+        stop(args.paths[0], args.paths[1] if len(args.paths) > 1 else 'TERM')
+    else:
+        record = checkpoint(args.paths[0], args.paths[1] if len(args.paths) > 1 else None)
+        print('Checkpointed stage ' + str(record['stage']) + ' after ' + record['signal'])
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""
+Scaling probes. For a representative job, a handful of short runs (NELM = 3,
+NSW = 0, no WAVECAR/CHGCAR) at the best autotuner layouts for a few node
+counts are submitted from job_dir/probe/<n>. Once they have left the queue
+the per-SCF LOOP timings in their OUTCARs give a measured time per
+electronic step for each layout, a strong-scaling curve
+t(cores) = serial + parallel / cores is fitted through the fastest layout
+of every core count, and the fastest layout whose parallel efficiency
+stays above PROBE_EFFICIENCY is chosen.
+
+The choice is stored in probe_layouts.json at the workflow root (the
+directory holding WORKFLOW_NAME, or VASP_PROBE_CACHE) under a signature of
+the job's size, so every structurally similar job of the workflow reuses it
+(see cached_layout) without probing again.
+
+    python -m vasp_run.probe [-c computer] start|collect|show job_dir
+"""
+
+import os
+import re
+import json
+import shutil
+import argparse
+from pymatgen.io.vasp.inputs import Incar
+from vasp_run import autotune
+from vasp_run import binding
+from vasp_run import resources
+from vasp_run import schedulers
+from vasp_run import workflow_state
+from vasp_run.cluster_profiles import get_cluster_profile
+
+PROBE_DIR = 'probe'
+PROBE_FILE = 'probes.json'
+CACHE_FILE = 'probe_layouts.json'
+PROBE_TAGS = {'NELM': 3, 'NSW': 0, 'IBRION': -1, 'LWAVE': False, 'LCHARG': False,
+              'ISTART': 0, 'ICHARG': 2}
+PROBE_INPUTS = ['INCAR', 'POSCAR', 'KPOINTS', 'POTCAR']
+PROBE_NODES = [1, 2, 4]
+LAYOUTS_PER_NODE_COUNT = 2
+PROBE_HOURS = 0.25
+PROBE_EFFICIENCY = 0.7
+LOOP_PATTERN = re.compile(r'LOOP:\s+cpu time\s+[\d.]+:\s+real time\s+([\d.]+)')
+
+
+def signature(size, incar):
+    """
+    Args:
+        size: dict from resources.job_size
+        incar: Incar of the job
+    Returns: string shared by jobs whose layouts can be reused for each other:
+             same atom, k-point and band counts, spin, SOC and hybrid settings,
+             ENCUT to 10 eV and volume per atom to 10%
+    """
+    hybrid = bool('LHFCALC' in incar and incar['LHFCALC'])
+    volume_bucket = int(round(10 * (size['volume'] / size['natoms']) ** (1 / 3.0)))
+    return '-'.join(str(x) for x in [
+        size['natoms'], size['nkpts'], size['nbands'], size['ispin'],
+        'soc' if size['noncollinear'] else 'col', 'hf' if hybrid else 'dft',
+        int(round(size['encut'] / 10.0)) * 10, volume_bucket])
+
+
+def find_cache(directory):
+    """
+    Returns: path of probe_layouts.json for the workflow directory belongs to
+    """
+    if 'VASP_PROBE_CACHE' in os.environ:
+        return os.environ['VASP_PROBE_CACHE']
+    path = os.path.abspath(directory)
+    while True:
+        if os.path.exists(os.path.join(path, CACHE_FILE)) or \
+                os.path.exists(os.path.join(path, 'WORKFLOW_NAME')):
+            return os.path.join(path, CACHE_FILE)
+        parent = os.path.dirname(path)
+        if parent == path:
+            return os.path.join(os.path.dirname(os.path.abspath(directory)), CACHE_FILE)
+        path = parent
+
+
+def read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(data, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+def loop_times(outcar):
+    """
+    Args:
+        outcar: OUTCAR path
+    Returns: real time of every electronic step (LOOP: lines) in seconds
+    """
+    times = []
+    if not os.path.exists(outcar):
+        return times
+    with open(outcar) as f:
+        for line in f:
+            match = LOOP_PATTERN.search(line)
+            if match:
+                times.append(float(match.group(1)))
+    return times
+
+
+def step_time(times):
+    # the first electronic step also sets up the run, leave it out when possible
+    if len(times) > 1:
+        times = times[1:]
+    return sum(times) / len(times)
+
+
+def choose_probe_layouts(size, profile, nodes=None):
+    """
+    Returns: layouts to probe, the best LAYOUTS_PER_NODE_COUNT of each node count
+             from the smallest that fits in memory
+    """
+    nodes = nodes or PROBE_NODES
+    layouts = []
+    for count in nodes:
+        layouts.extend(autotune.rank_layouts(size, profile, count)[:LAYOUTS_PER_NODE_COUNT])
+    return layouts
+
+
+def probe_script(layout, incar, name, queue_type, profile=None):
+    """
+    Returns: text of a submission script running VASP once with layout,
+             placed like the job would be (see binding.py)
+    """
+    if 'LSORBIT' in incar and incar['LSORBIT']:
+        vasp = os.environ['VASP_NCL']
+    elif 'AUTO_GAMMA' in incar and incar['AUTO_GAMMA']:
+        vasp = os.environ['VASP_GAMMA']
+    else:
+        vasp = os.environ['VASP_KPTS']
+    mpi = os.environ.get('VASP_MPI', 'mpirun')
+    ranks = layout['nodes'] * layout['ranks_per_node']
+    placement = binding.binding_settings(profile or {}, incar, threads=layout['threads'])
+    lines = ['#!/bin/bash']
+    if queue_type == 'pbs':
+        lines += ['#PBS -N ' + name,
+                  '#PBS -l nodes=%d:ppn=%d' % (layout['nodes'], layout['ranks_per_node']),
+                  '#PBS -l walltime=00:%02d:00' % int(PROBE_HOURS * 60),
+                  'cd $PBS_O_WORKDIR']
+    else:
+        lines += ['#SBATCH -J ' + name,
+                  '#SBATCH --time=00:%02d:00' % int(PROBE_HOURS * 60),
+                  '#SBATCH --nodes %d' % layout['nodes'],
+                  '#SBATCH --ntasks-per-node %d' % layout['ranks_per_node'],
+                  '#SBATCH --cpus-per-task %d' % layout['threads']]
+        lines += ['#SBATCH ' + option for option in binding.sbatch_options(placement)]
+        if 'VASP_DEFAULT_ALLOCATION' in os.environ:
+            lines.append('#SBATCH --account=' + os.environ['VASP_DEFAULT_ALLOCATION'])
+    lines.append('export OMP_NUM_THREADS=%d' % layout['threads'])
+    lines += ['export ' + variable for variable in
+              binding.environment(placement, mpi, layout['threads'])]
+    launcher = [mpi]
+    if mpi != 'srun':
+        launcher += ['-np', str(ranks)]
+    launcher += binding.launcher_options(placement, mpi, layout['threads'])
+    lines.append('%s %s > vasp.out 2>&1' % (' '.join(launcher), vasp))
+    return '\n'.join(lines) + '\n'
+
+
+def start_probes(directory, profile, scheduler=None, queue_type='slurm', nodes=None):
+    """
+    Args:
+        directory: representative job directory
+        profile: cluster profile of the cluster to probe
+        scheduler: Scheduler to submit with, get_scheduler(queue_type) if None
+        nodes: node counts to probe, PROBE_NODES if None
+    Returns: list of probe dicts (dir, job_id, layout) also written to probe/probes.json
+    """
+    if scheduler is None:
+        scheduler = schedulers.get_scheduler(queue_type)
+    incar = Incar.from_file(os.path.join(directory, 'INCAR'))
+    size = resources.job_size(directory, incar)
+    probe_root = os.path.join(os.path.abspath(directory), PROBE_DIR)
+    if os.path.exists(probe_root):
+        shutil.rmtree(probe_root)
+    probes = []
+    for i, layout in enumerate(choose_probe_layouts(size, profile, nodes)):
+        probe_dir = os.path.join(probe_root, str(i))
+        os.makedirs(probe_dir)
+        for f in PROBE_INPUTS:
+            if os.path.exists(os.path.join(directory, f)):
+                shutil.copy(os.path.join(directory, f), os.path.join(probe_dir, f))
+        probe_incar = Incar(incar)
+        probe_incar.update(PROBE_TAGS)
+        probe_incar.write_file(os.path.join(probe_dir, 'INCAR'))
+        autotune.write_layout(layout, os.path.join(probe_dir, 'INCAR'))
+        with open(os.path.join(probe_dir, 'probe.sh'), 'w') as f:
+            f.write(probe_script(layout, incar, 'probe_' + str(i), queue_type, profile))
+        job_id = scheduler.submit('probe.sh', cwd=probe_dir)
+        probes.append({'dir': probe_dir, 'job_id': job_id, 'layout': layout})
+    write_json({'signature': signature(size, incar), 'submitted': workflow_state.now(),
+                'probes': probes}, os.path.join(probe_root, PROBE_FILE))
+    return probes
+
+
+def read_probes(directory):
+    return read_json(os.path.join(directory, PROBE_DIR, PROBE_FILE), None)
+
+
+def probes_running(directory, scheduler):
+    """
+    Returns: number of probes of directory still in the queue
+    """
+    probes = read_probes(directory)
+    if probes is None:
+        return 0
+    return len([p for p in probes['probes'] if scheduler.job_status(p['job_id']) is not None])
+
+
+def fit_scaling(points):
+    """
+    Args:
+        points: list of (cores, seconds per electronic step)
+    Returns: (serial, parallel) of the least squares fit seconds = serial + parallel / cores
+    """
+    if len(points) == 1:
+        return (0.0, points[0][0] * points[0][1])
+    xs = [1.0 / cores for (cores, t) in points]
+    ys = [t for (cores, t) in points]
+    n = float(len(points))
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if sxx == 0:
+        return (mean_y, 0.0)
+    parallel = sum((x - mean_x) * (y - mean_y) for (x, y) in zip(xs, ys)) / sxx
+    serial = mean_y - parallel * mean_x
+    return (serial, parallel)
+
+
+def collect_probes(directory):
+    """
+    Args:
+        directory: job directory whose probes have left the queue
+    Returns: cache entry (layout, fit, probes, source), None if no probe
+             produced timings
+    """
+    probes = read_probes(directory)
+    if probes is None:
+        return None
+    measured = []
+    for probe in probes['probes']:
+        times = loop_times(os.path.join(probe['dir'], 'OUTCAR'))
+        if times:
+            layout = dict(probe['layout'])
+            layout['cores'] = layout['nodes'] * layout['ranks_per_node'] * layout['threads']
+            layout['seconds'] = step_time(times)
+            measured.append(layout)
+    if not measured:
+        return None
+    fastest = {}
+    for layout in measured:
+        if layout['cores'] not in fastest or layout['seconds'] < fastest[layout['cores']]['seconds']:
+            fastest[layout['cores']] = layout
+    cores = sorted(fastest)
+    (serial, parallel) = fit_scaling([(c, fastest[c]['seconds']) for c in cores])
+    # parallel efficiency against the smallest core count probed
+    base = fastest[cores[0]]
+    chosen = base
+    for c in cores:
+        efficiency = base['seconds'] * base['cores'] / (fastest[c]['seconds'] * c)
+        fastest[c]['efficiency'] = efficiency
+        if efficiency >= PROBE_EFFICIENCY and fastest[c]['seconds'] < chosen['seconds']:
+            chosen = fastest[c]
+    layout = dict((k, chosen[k]) for k in ['nodes', 'ranks_per_node', 'threads',
+                                             'kpar', 'ncore', 'nsim'])
+    return {'layout': layout,
+            'fit': {'serial': serial, 'parallel': parallel},
+            'probes': measured,
+            'source': os.path.abspath(directory),
+            'date': workflow_state.now()}
+
+
+def store_layout(directory, entry, cache=None):
+    """
+    Stores entry in the workflow cache under the signature the probes were made for
+    """
+    cache = cache or find_cache(directory)
+    layouts = read_json(cache, {})
+    layouts[read_probes(directory)['signature']] = entry
+    write_json(layouts, cache)
+
+
+def cached_layout(directory, incar=None, cache=None):
+    """
+    Args:
+        directory: job directory
+        incar: Incar of the job, read from directory if None
+        cache: probe_layouts.json, found with find_cache if None
+    Returns: layout probed for a job like this one, None if there is none
+    """
+    cache = cache or find_cache(directory)
+    if not os.path.exists(cache):
+        return None
+    if incar is None:
+        incar = Incar.from_file(os.path.join(directory, 'INCAR'))
+    entry = read_json(cache, {}).get(signature(resources.job_size(directory, incar), incar))
+    if entry is None:
+        return None
+    return entry['layout']
+
+
+def probe_layout(directory, profile, queue_type='slurm', scheduler=None):
+    """
+    One step of probe mode, called by vasp.py --probe on every pass
+    Returns: layout to run the job with, None while probes are queued (they
+             are started on the first call)
+    """
+    layout = cached_layout(directory)
+    if layout is not None:
+        return layout
+    if scheduler is None:
+        scheduler = schedulers.get_scheduler(queue_type)
+    if read_probes(directory) is None:
+        probes = start_probes(directory, profile, scheduler, queue_type)
+        print('Submitted ' + str(len(probes)) + ' scaling probes from ' +
+              os.path.join(directory, PROBE_DIR))
+        return None
+    running = probes_running(directory, scheduler)
+    if running:
+        print(str(running) + ' scaling probes still in the queue')
+        return None
+    entry = collect_probes(directory)
+    if entry is None:
+        raise Exception('No scaling probe in ' + os.path.join(directory, PROBE_DIR) +
+                        ' wrote LOOP timings to its OUTCAR')
+    store_layout(directory, entry)
+    return entry['layout']
+
+
+def print_entry(entry):
+    print('  %5s %5s %7s %4s %5s %8s %10s' % ('nodes', 'ranks', 'threads', 'KPAR',
+                                             'NCORE', 's/step', 'efficiency'))
+    for p in sorted(entry['probes'], key=lambda p: (p['cores'], p['seconds'])):
+        print('  %5d %5d %7d %4d %5d %8.3f %10s' % (
+            p['nodes'], p['ranks_per_node'], p['threads'], p['kpar'], p['ncore'],
+            p['seconds'], '%.2f' % p['efficiency'] if 'efficiency' in p else ''))
+    print('  fit: %.4g + %.4g / cores s per electronic step' % (
+        entry['fit']['serial'], entry['fit']['parallel']))
+    print('  chosen: ' + json.dumps(entry['layout']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=['start', 'collect', 'show'])
+    parser.add_argument('path', nargs='?', default='.')
+    parser.add_argument('-c', '--computer',
+                        help='cluster profile to probe (default: this cluster)')
+    args = parser.parse_args()
+
+    if args.action == 'start':
+        if args.computer is None:
+            from Helpers import getComputerName
+            args.computer = getComputerName()
+        profile = get_cluster_profile(args.computer)
+        queue_type = schedulers.computer_queue_type(args.computer)
+        for p in start_probes(args.path, profile, queue_type=queue_type):
+            print(p['job_id'] + '  ' + p['dir'])
+    elif args.action == 'collect':
+        entry = collect_probes(args.path)
+        if entry is None:
+            exit('No probe timings in ' + os.path.join(args.path, PROBE_DIR))
+        store_layout(args.path, entry)
+        print_entry(entry)
+    else:
+        cache = find_cache(args.path)
+        for key, entry in read_json(cache, {}).items():
+            print(key + '  (' + entry['source'] + ')')
+            print_entry(entry)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Live progress of running jobs. ProgressHandler (handlers.py) runs in both
+job templates and keeps a small progress.json in the job directory up to
+date at every Custodian monitor check. It holds the stage, the ionic step,
+the SCF steps of the latest ionic step, the latest energy and largest force,
+the elapsed and estimated remaining time and the scheduler job id. The file
+is replaced atomically, so it can be read at any time, and reading it is
+all the status command and rerun_workflow.py do. The status command marks
+running jobs whose heartbeat is older than STALE_SECONDS as STALE.
+
+    python -m vasp_run.progress [workflow_dir ...]
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import argparse
+from pymatgen.io.vasp.inputs import Incar
+from vasp_run import schedulers
+from vasp_run import workflow_state
+
+PROGRESS_FILE = 'progress.json'
+# a running job whose heartbeat is older than this has stopped making progress
+STALE_SECONDS = 30 * 60
+STEP_WINDOW = 10
+SCF_PATTERN = re.compile(r'^\s*[A-Z]{2,3}\s?:\s+\d+\s')
+ENERGY_PATTERN = re.compile(r'F=\s*(\S+)\s+E0=\s*(\S+)')
+IONIC_LOOP_PATTERN = re.compile(r'LOOP\+:\s+cpu time\s+[\d.]+:\s+real time\s+([\d.]+)')
+
+
+class OutputReader(object):
+    """
+    Follows OSZICAR and OUTCAR of a running job, reading only what was
+    written since the last update and starting over when a new run
+    truncates them
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.offsets = {}
+        self.reset_oszicar()
+        self.reset_outcar()
+
+    def reset_oszicar(self):
+        self.ionic_step = 0
+        self.scf_steps = 0
+        self.current_scf = 0
+        self.energy = None
+
+    def reset_outcar(self):
+        self.step_times = []
+        self.max_force = None
+        self.force_lines = None
+        self.block_force = 0.0
+
+    def new_lines(self, name):
+        """
+        Returns: (complete lines written since the last call, whether the
+                 file started over)
+        """
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return ([], False)
+        offset = self.offsets.get(name, 0)
+        restarted = os.path.getsize(path) < offset
+        if restarted:
+            offset = 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # an unfinished last line is left for the next call
+        end = data.rfind(b'\n') + 1
+        self.offsets[name] = offset + end
+        return (data[:end].decode(errors='replace').splitlines(), restarted)
+
+    def update(self):
+        (lines, restarted) = self.new_lines('OSZICAR')
+        if restarted:
+            self.reset_oszicar()
+        for line in lines:
+            match = ENERGY_PATTERN.search(line)
+            if match:
+                self.ionic_step += 1
+                self.energy = float(match.group(2))
+                (self.scf_steps, self.current_scf) = (self.current_scf, 0)
+            elif SCF_PATTERN.match(line):
+                self.current_scf += 1
+        (lines, restarted) = self.new_lines('OUTCAR')
+        if restarted:
+            self.reset_outcar()
+        for line in lines:
+            if self.force_lines is not None:
+                # TOTAL-FORCE block: dashes, one line per atom, dashes
+                if line.strip().startswith('---'):
+                    self.force_lines += 1
+                    if self.force_lines == 2:
+                        (self.max_force, self.force_lines) = (self.block_force, None)
+                else:
+                    force = [float(value) for value in line.split()[3:6]]
+                    self.block_force = max(self.block_force, sum(f * f for f in force) ** 0.5)
+            elif 'TOTAL-FORCE' in line:
+                (self.force_lines, self.block_force) = (0, 0.0)
+            else:
+                match = IONIC_LOOP_PATTERN.search(line)
+                if match:
+                    self.step_times.append(float(match.group(1)))
+                    self.step_times = self.step_times[-STEP_WINDOW:]
+
+    @property
+    def current_scf_steps(self):
+        return self.current_scf or self.scf_steps
+
+
+def remaining_seconds(reader, nsw, elapsed, walltime=None):
+    """
+    Returns: seconds the remaining ionic steps (up to NSW) take at the
+             recent pace, never more than the walltime left; None if unknown
+    """
+    left = walltime - elapsed if walltime else None
+    if nsw and reader.step_times:
+        estimate = sum(reader.step_times) / len(reader.step_times) * max(nsw - reader.ionic_step, 0)
+        left = estimate if left is None else min(estimate, left)
+    return None if left is None else max(int(left), 0)
+
+
+def job_progress(reader, started, walltime=None):
+    """
+    Args:
+        reader: OutputReader of the run directory
+        started: time.time() the run started
+        walltime: walltime of the job in seconds
+    Returns: progress dict
+    """
+    reader.update()
+    incar_path = os.path.join(reader.directory, 'INCAR')
+    incar = Incar.from_file(incar_path) if os.path.exists(incar_path) else {}
+    elapsed = time.time() - started
+    return {'job_id': os.environ.get('SLURM_JOB_ID', os.environ.get('PBS_JOBID')),
+            'host': socket.gethostname(),
+            'updated': workflow_state.now(),
+            'stage': incar.get('STAGE_NUMBER'),
+            'ionic_step': reader.ionic_step,
+            'nsw': incar.get('NSW', 0),
+            'scf_steps': reader.current_scf_steps,
+            'energy': reader.energy,
+            'max_force': reader.max_force,
+            'elapsed_seconds': int(elapsed),
+            'remaining_seconds': remaining_seconds(reader, incar.get('NSW', 0), elapsed, walltime)}
+
+
+def write_progress(progress, path='.'):
+    # write to a temporary file and rename so readers never see a partial file
+    progress_path = os.path.join(path, PROGRESS_FILE)
+    with open(progress_path + '.tmp', 'w') as f:
+        json.dump(progress, f, indent=1)
+    os.replace(progress_path + '.tmp', progress_path)
+
+
+def read_progress(path='.'):
+    """
+    Returns: progress dict of the job in path, None if it has none
+    """
+    try:
+        with open(os.path.join(path, PROGRESS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def summary(progress):
+    """
+    Returns: one line description of a progress dict
+    """
+    parts = []
+    if progress.get('stage') is not None:
+        parts.append('stage ' + str(progress['stage']))
+    parts.append('ionic step ' + str(progress['ionic_step']) +
+                 ('/' + str(progress['nsw']) if progress.get('nsw') else ''))
+    parts.append(str(progress['scf_steps']) + ' SCF')
+    if progress.get('energy') is not None:
+        parts.append('E0 %.4f eV' % progress['energy'])
+    if progress.get('max_force') is not None:
+        parts.append('max force %.3f eV/A' % progress['max_force'])
+    if progress.get('remaining_seconds') is not None:
+        parts.append('~%.1f h left' % (progress['remaining_seconds'] / 3600))
+    return ', '.join(parts)
+
+
+def job_dirs(pwd):
+    for root, dirs, files in os.walk(pwd):
+        dirs[:] = sorted(d for d in dirs if d not in ['backup', 'probe'])
+        if PROGRESS_FILE in files:
+            yield root
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=['.'])
+    args = parser.parse_args()
+
+    queued = schedulers.get_scheduler(schedulers.computer_queue_type()).status()
+    for path in args.paths:
+        for directory in job_dirs(os.path.abspath(path)):
+            progress = read_progress(directory)
+            if progress is None:
+                continue
+            status = queued.get(directory, 'FINISHED')
+            age = time.time() - os.path.getmtime(os.path.join(directory, PROGRESS_FILE))
+            if status == 'RUNNING' and age > STALE_SECONDS:
+                status = 'STALE'
+            print('%-50s %-10s %-9s %s' % (os.path.relpath(directory), progress['job_id'],
+                                          status, summary(progress)))
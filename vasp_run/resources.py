@@ -0,0 +1,306 @@
+"""
+Resource requests for the submission script that depend on the job itself
+rather than only on the cluster: task counts and memory for jobs that share
+a node with other jobs instead of taking whole nodes, and an estimate of the
+memory a job needs so it is given enough nodes before it waits in the queue
+"""
+
+import os
+import math
+import re
+from pymatgen.io.vasp.inputs import Incar, Kpoints, Poscar
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from vasp_run import compact
+
+# a few ranks per atom keeps small cells efficient, VASP gains little beyond that
+TASKS_PER_ATOM = 4
+MIN_SHARED_TASKS = 4
+
+
+def incar_int(incar, tag, default=1):
+    if tag in incar:
+        return int(incar[tag])
+    return default
+
+
+def parallel_group_size(incar):
+    # ranks must split evenly into KPAR k-point groups of NPAR (or NCORE) ranks
+    kpar = incar_int(incar, 'KPAR')
+    if 'NPAR' in incar:
+        group = incar_int(incar, 'NPAR')
+    else:
+        group = incar_int(incar, 'NCORE')
+    return kpar * group
+
+
+def memory_to_mb(memory):
+    """
+    Args:
+        memory: SLURM style memory (int MB, '4000', '4000M', '64G', '1T')
+    Returns: memory in MB as an int
+    """
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?)B?\s*$', str(memory).upper())
+    if match is None:
+        raise Exception('Could not read memory request:  ' + str(memory))
+    scale = {'K': 1.0 / 1024, '': 1, 'M': 1, 'G': 1024, 'T': 1024 * 1024}[match.group(2)]
+    return int(math.ceil(float(match.group(1)) * scale))
+
+
+def shared_task_count(natoms, incar, cores_per_node):
+    """
+    Args:
+        natoms: atoms in POSCAR
+        incar: Incar (or dict) of the job
+        cores_per_node: cores on one node of the cluster
+    Returns: MPI tasks for a shared-node run, None if the job needs a whole node
+    """
+    group = parallel_group_size(incar)
+    tasks = max(MIN_SHARED_TASKS, TASKS_PER_ATOM * natoms, group)
+    tasks = int(math.ceil(tasks / float(group)) * group)
+    if tasks >= cores_per_node:
+        return None
+    return tasks
+
+
+def shared_mem_per_cpu(profile, tasks, mem=0, estimate=0):
+    """
+    Args:
+        profile: cluster profile with memory_per_node_mb and cores_per_node
+        tasks: MPI tasks of the job
+        mem: total memory the job asked for (AUTO_MEM), 0 if it did not
+        estimate: MB per task from MemoryEstimate, 0 if there is none
+    Returns: --mem-per-cpu in MB; a requested total is split over the tasks,
+             then the estimate, otherwise every task gets one core's share of
+             the node memory
+    """
+    if mem not in [0, '0', None, '']:
+        return int(math.ceil(memory_to_mb(mem) / float(tasks)))
+    if estimate:
+        return int(estimate)
+    return int(profile['memory_per_node_mb'] // profile['cores_per_node'])
+
+
+# Memory model. Per rank VASP holds its share of the plane-wave coefficients
+# (several copies for the iterative diagonalisers), its share of the FFT grids
+# and a full copy of the subspace matrices, on top of a fixed overhead
+HBAR2_2M = 3.80998  # hbar^2 / 2m_e in eV A^2
+RANK_OVERHEAD_MB = 150.0
+WAVEFUNCTION_COPIES = 3
+GRID_ARRAYS = 12
+SUBSPACE_COPIES = 3
+MEMORY_MARGIN = 1.2
+DEFAULT_ENMAX = 400.0
+DEFAULT_ZVAL = 8.0
+
+
+def read_potcar(path='POTCAR'):
+    """
+    Args:
+        path: POTCAR (species in the same order as POSCAR)
+    Returns: list of (ENMAX, ZVAL) per species, empty if there is no POTCAR
+    """
+    if not os.path.exists(path):
+        return []
+    enmax = []
+    zval = []
+    with open(path) as f:
+        for line in f:
+            match = re.search(r'ENMAX\s*=\s*([\d.]+)', line)
+            if match:
+                enmax.append(float(match.group(1)))
+            match = re.search(r'ZVAL\s*=\s*([\d.]+)', line)
+            if match:
+                zval.append(float(match.group(1)))
+    return list(zip(enmax, zval))
+
+
+def count_kpoints(structure, incar, directory='.'):
+    """
+    Args:
+        structure: pymatgen Structure of the job
+        incar: Incar (or dict) of the job, for KSPACING when there is no KPOINTS
+        directory: job directory
+    Returns: number of irreducible k-points (IBZKPT of a previous run if there is one)
+    """
+    ibzkpt = os.path.join(directory, 'IBZKPT')
+    if os.path.exists(ibzkpt):
+        with open(ibzkpt) as f:
+            f.readline()
+            return int(f.readline().split()[0])
+    kpoints_path = os.path.join(directory, 'KPOINTS')
+    shift = (0, 0, 0)
+    reciprocal = structure.lattice.reciprocal_lattice_crystallographic.abc
+    if os.path.exists(kpoints_path):
+        kpoints = Kpoints.from_file(kpoints_path)
+        style = kpoints.style.name.lower()
+        if style in ['gamma', 'monkhorst']:
+            mesh = kpoints.kpts[0]
+            if style == 'monkhorst':
+                shift = tuple(0.5 if n % 2 == 0 else 0 for n in mesh)
+        elif style == 'automatic':
+            length = kpoints.kpts[0][0]
+            mesh = [max(1, int(length * b + 0.5)) for b in reciprocal]
+        else:
+            return kpoints.num_kpts
+    else:
+        kspacing = float(incar['KSPACING']) if 'KSPACING' in incar else 0.5
+        mesh = [max(1, int(math.ceil(2 * math.pi * b / kspacing))) for b in reciprocal]
+    return len(SpacegroupAnalyzer(structure).get_ir_reciprocal_mesh(mesh, shift))
+
+
+def job_size(directory='.', incar=None):
+    """
+    Args:
+        directory: job directory with POSCAR (POTCAR, KPOINTS and IBZKPT if present)
+        incar: Incar of the job, read from directory if None
+    Returns: dict of the quantities the memory model needs
+             (natoms, volume, encut, nelect, nkpts, nbands, ispin, noncollinear, npw, nplwv)
+    """
+    if incar is None:
+        incar = Incar.from_file(os.path.join(directory, 'INCAR'))
+    poscar = Poscar.from_file(os.path.join(directory, 'POSCAR'), check_for_potcar=False)
+    structure = poscar.structure
+    natoms = len(structure)
+    potcar = read_potcar(os.path.join(directory, 'POTCAR'))
+    if len(potcar) != len(poscar.natoms):
+        potcar = [(DEFAULT_ENMAX, DEFAULT_ZVAL)] * len(poscar.natoms)
+    nelect = sum(count * zval for (count, (enmax, zval)) in zip(poscar.natoms, potcar))
+    if 'NELECT' in incar:
+        nelect = float(incar['NELECT'])
+    encut = float(incar['ENCUT']) if 'ENCUT' in incar else max(p[0] for p in potcar)
+    noncollinear = bool('LSORBIT' in incar and incar['LSORBIT']) or \
+        bool('LNONCOLLINEAR' in incar and incar['LNONCOLLINEAR'])
+    ispin = incar_int(incar, 'ISPIN')
+    if 'NBANDS' in incar:
+        nbands = int(incar['NBANDS'])
+    else:
+        # VASP's default
+        nbands = max(int(nelect + 2) // 2 + max(natoms // 2, 3), int(0.6 * nelect))
+        if noncollinear:
+            nbands *= 2
+    kmax = math.sqrt(encut / HBAR2_2M)
+    volume = structure.volume
+    return {'natoms': natoms,
+            'volume': volume,
+            'encut': encut,
+            'nelect': nelect,
+            'nkpts': count_kpoints(structure, incar, directory),
+            'nbands': nbands,
+            'ispin': ispin,
+            'noncollinear': noncollinear,
+            'npw': volume * kmax ** 3 / (6 * math.pi ** 2),
+            'nplwv': volume * (3 * kmax / (2 * math.pi)) ** 3}
+
+
+def layout(incar, ranks):
+    """
+    Args:
+        incar: Incar (or dict) with KPAR and NPAR or NCORE
+        ranks: MPI ranks of the run
+    Returns: (KPAR, NCORE) the run will use
+    """
+    kpar = min(incar_int(incar, 'KPAR'), ranks)
+    if 'NCORE' in incar:
+        ncore = incar_int(incar, 'NCORE')
+    elif 'NPAR' in incar:
+        ncore = max(1, ranks // kpar // incar_int(incar, 'NPAR'))
+    else:
+        ncore = 1
+    return (kpar, ncore)
+
+
+def estimate_rank_memory(size, ranks, kpar=1, ncore=1):
+    """
+    Args:
+        size: dict from job_size
+        ranks: MPI ranks of the run
+        kpar: k-point groups
+        ncore: ranks sharing one band
+    Returns: estimated memory of one rank in MB
+    """
+    ranks_per_kgroup = max(1, ranks // kpar)
+    kpoints_per_group = int(math.ceil(size['nkpts'] / float(kpar)))
+    spinor = 2 if size['noncollinear'] else 1
+    components = 4 if size['noncollinear'] else size['ispin']
+    wavefunctions = (kpoints_per_group * size['ispin'] * size['nbands'] * size['npw'] *
+                     spinor * 16.0 * WAVEFUNCTION_COPIES / ranks_per_kgroup)
+    grids = size['nplwv'] * 16.0 * GRID_ARRAYS * components / max(1, min(ncore, ranks_per_kgroup))
+    subspace = size['nbands'] ** 2 * 16.0 * SUBSPACE_COPIES
+    return RANK_OVERHEAD_MB + (wavefunctions + grids + subspace) / 1024.0 ** 2
+
+
+def read_outcar_memory(path='OUTCAR'):
+    """
+    Args:
+        path: OUTCAR of a previous run
+    Returns: dict of ranks, kpar, ncore and max_memory_mb (per rank), None if the
+             OUTCAR does not record its memory use
+    """
+    path = compact.output_path(os.path.dirname(path), os.path.basename(path))
+    if not os.path.exists(path):
+        return None
+    found = {'ranks': 1, 'kpar': 1, 'ncore': 1}
+    patterns = {'ranks': r'running on\s+(\d+) total cores',
+                'kpar': r'distrk:.*cores,\s+(\d+) groups',
+                'ncore': r'distr:\s+one band on NCORE=\s*(\d+)',
+                'max_memory_mb': r'Maximum memory used \(kb\):\s+([\d.]+)'}
+    with compact.open_output(path) as f:
+        for line in f:
+            for key, pattern in patterns.items():
+                match = re.search(pattern, line)
+                if match:
+                    found[key] = float(match.group(1))
+    if 'max_memory_mb' not in found:
+        return None
+    found['max_memory_mb'] = found['max_memory_mb'] / 1024.0
+    for key in ['ranks', 'kpar', 'ncore']:
+        found[key] = int(found[key])
+    return found
+
+
+class MemoryEstimate:
+    """
+    Memory model of one job, calibrated against the memory its last OUTCAR
+    recorded when there is one
+    """
+
+    def __init__(self, directory='.', incar=None):
+        if incar is None:
+            incar = Incar.from_file(os.path.join(directory, 'INCAR'))
+        self.incar = incar
+        self.size = job_size(directory, incar)
+        self.calibration = 1.0
+        previous = read_outcar_memory(os.path.join(directory, 'OUTCAR'))
+        if previous is not None and previous['max_memory_mb'] > 0:
+            self.calibration = previous['max_memory_mb'] / estimate_rank_memory(
+                self.size, previous['ranks'], previous['kpar'], previous['ncore'])
+
+    def per_rank(self, ranks):
+        """
+        Returns: MB one of ranks MPI ranks needs, with the safety margin
+        """
+        (kpar, ncore) = layout(self.incar, ranks)
+        return int(math.ceil(estimate_rank_memory(self.size, ranks, kpar, ncore) *
+                             self.calibration * MEMORY_MARGIN))
+
+    def per_node(self, nodes, cores):
+        """
+        Returns: MB needed on each of nodes nodes running cores ranks each
+        """
+        return self.per_rank(nodes * cores) * cores
+
+    def minimum_nodes(self, profile, cores, nodes=1, max_nodes=64):
+        """
+        Args:
+            profile: cluster profile with memory_per_node_mb
+            cores: ranks per node
+            nodes: node count to start from
+            max_nodes: largest node count to try
+        Returns: smallest node count >= nodes whose ranks fit in node memory,
+                 None if no count up to max_nodes fits (the replicated part of
+                 every rank alone exceeds the node)
+        """
+        for n in range(max(1, int(nodes)), max_nodes + 1):
+            if self.per_node(n, cores) <= profile['memory_per_node_mb']:
+                return n
+        return None
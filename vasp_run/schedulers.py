@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+"""
+Scheduler backends used by vasp.py to submit jobs and by rerun_workflow.py to
+check on them. Every backend implements submit, status, job_status, cancel
+and accounting, and reports job states with SLURM's names (PENDING, RUNNING,
+COMPLETED, FAILED, ...) whatever the underlying scheduler calls them.
+
+    slurm: sbatch/squeue/scancel/sacct
+    pbs:   qsub/qstat/qdel (qstat -x for finished jobs)
+    local: runs job scripts on this machine, at most VASP_LOCAL_WORKERS at a
+           time, with the queue kept in VASP_LOCAL_QUEUE_DIR
+
+The backend is chosen with the VASP_SCHEDULER environment variable, falling
+back to the one of the computer (see computer_queue_type)
+"""
+
+import os
+import re
+import sys
+import json
+import fcntl
+import time
+import signal
+import shlex
+import argparse
+import datetime
+import subprocess
+from vasp_run import cluster_profiles
+
+FINISHED_STATES = ['COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'NODE_FAIL',
+                   'OUT_OF_MEMORY', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE']
+PBS_STATES = {'Q': 'PENDING', 'H': 'PENDING', 'W': 'PENDING', 'T': 'PENDING',
+              'R': 'RUNNING', 'B': 'RUNNING', 'E': 'COMPLETING',
+              'C': 'COMPLETED', 'F': 'COMPLETED', 'X': 'COMPLETED',
+              'S': 'SUSPENDED', 'U': 'SUSPENDED'}
+
+
+def run_command(command, cwd=None, input=None):
+    return subprocess.run(command, cwd=cwd, input=input, capture_output=True,
+                          text=True)
+
+
+def hms_to_seconds(hms):
+    # [D-]HH:MM:SS or MM:SS
+    days = 0
+    if '-' in hms:
+        days, hms = hms.split('-')
+    seconds = 0
+    for part in hms.split(':'):
+        seconds = seconds * 60 + int(float(part))
+    return int(days) * 86400 + seconds
+
+
+class Scheduler:
+    """
+    Args:
+        runner: function(command, cwd=None, input=None) returning a
+                CompletedProcess, used to run scheduler commands (e.g. over ssh)
+        commands: replacement executables, e.g. {'sbatch': '/path/to/sbatch'}
+        submit_options: extra arguments for every submission
+    """
+    name = None
+    default_commands = {}
+
+    def __init__(self, runner=None, commands=None, submit_options=None):
+        self.runner = runner if runner is not None else run_command
+        self.commands = dict(self.default_commands)
+        if commands is not None:
+            self.commands.update(commands)
+        self.submit_options = submit_options if submit_options is not None else []
+
+    def run(self, command, cwd=None, input=None):
+        return self.runner(command, cwd=cwd, input=input)
+
+    def submit(self, script, cwd='.'):
+        """
+        Returns: job id of the submitted script
+        """
+        raise NotImplementedError
+
+    def status(self):
+        """
+        Returns: {job directory: state} for every job still queued or running
+        """
+        raise NotImplementedError
+
+    def job_status(self, job_id):
+        """
+        Returns: state of job_id, None once it has left the queue
+        """
+        raise NotImplementedError
+
+    def cancel(self, job_id):
+        raise NotImplementedError
+
+    def accounting(self, job_ids):
+        """
+        Returns: list of dicts with job_id, name, state, elapsed (seconds),
+                 nodes, cpus, submit, start, end and workdir
+        """
+        raise NotImplementedError
+
+
+class SlurmScheduler(Scheduler):
+    name = 'slurm'
+    default_commands = {'sbatch': 'sbatch', 'squeue': 'squeue',
+                        'scancel': 'scancel', 'sacct': 'sacct'}
+    accounting_fields = ['JobID', 'JobName', 'State', 'ElapsedRaw', 'NNodes',
+                         'NCPUS', 'Submit', 'Start', 'End', 'WorkDir']
+
+    def submit(self, script, cwd='.'):
+        result = self.run([self.commands['sbatch']] + self.submit_options + [script],
+                          cwd=cwd)
+        match = re.search(r'Submitted batch job (\d+)', result.stdout)
+        if match is None:
+            raise Exception('sbatch failed:  ' + result.stderr.strip())
+        return match.group(1)
+
+    def expected_start(self, script_text):
+        # datetime sbatch --test-only expects the job to start, None if rejected
+        result = self.run([self.commands['sbatch'], '--test-only'] + self.submit_options,
+                          input=script_text)
+        match = re.search(r'to start at (\S+)', result.stderr + result.stdout)
+        if result.returncode != 0 or match is None:
+            print('sbatch --test-only failed:  ' + result.stderr.strip())
+            return None
+        return datetime.datetime.fromisoformat(match.group(1))
+
+    def status(self):
+        result = self.run([self.commands['squeue'], '-h', '-o', '%Z %T'])
+        all_jobs_dict = {}
+        for line in result.stdout.splitlines():
+            line = line.replace('"', '').split()
+            if len(line) == 2:
+                all_jobs_dict[line[0]] = line[1]
+        return all_jobs_dict
+
+    def job_status(self, job_id):
+        result = self.run([self.commands['squeue'], '-h', '-j', str(job_id),
+                           '-o', '%T'])
+        state = result.stdout.strip()
+        if result.returncode != 0 or state == '':
+            return None
+        return state.split()[0]
+
+    def cancel(self, job_id):
+        self.run([self.commands['scancel'], str(job_id)])
+
+    def accounting(self, job_ids):
+        if len(job_ids) == 0:
+            return []
+        result = self.run([self.commands['sacct'], '-n', '-P', '-X', '-j',
+                           ','.join(str(j) for j in job_ids),
+                           '-o', ','.join(self.accounting_fields)])
+        records = []
+        for line in result.stdout.splitlines():
+            fields = line.split('|')
+            if len(fields) != len(self.accounting_fields):
+                continue
+            row = dict(zip(self.accounting_fields, fields))
+            records.append({'job_id': row['JobID'],
+                            'name': row['JobName'],
+                            # sacct reports e.g. "CANCELLED by 1234"
+                            'state': row['State'].split()[0] if row['State'] else '',
+                            'elapsed': int(row['ElapsedRaw'] or 0),
+                            'nodes': int(row['NNodes'] or 0),
+                            'cpus': int(row['NCPUS'] or 0),
+                            'submit': row['Submit'],
+                            'start': row['Start'],
+                            'end': row['End'],
+                            'workdir': row['WorkDir']})
+        return records
+
+
+class PbsScheduler(Scheduler):
+    name = 'pbs'
+    default_commands = {'qsub': 'qsub', 'qstat': 'qstat', 'qdel': 'qdel'}
+
+    def submit(self, script, cwd='.'):
+        result = self.run([self.commands['qsub']] + self.submit_options + [script],
+                          cwd=cwd)
+        job_id = result.stdout.strip()
+        if result.returncode != 0 or job_id == '':
+            raise Exception('qsub failed:  ' + result.stderr.strip())
+        return job_id
+
+    def parse_qstat(self, text):
+        # qstat -f prints "Job Id: X" followed by indented "key = value" lines,
+        # long values continue on lines starting with a tab
+        jobs = []
+        job = None
+        key = None
+        for line in text.splitlines():
+            if line.startswith('Job Id:'):
+                job = {'job_id': line.split(':', 1)[1].strip()}
+                jobs.append(job)
+            elif job is not None and ' = ' in line:
+                key, value = line.strip().split(' = ', 1)
+                job[key] = value
+            elif job is not None and key is not None and line.startswith('\t'):
+                job[key] += line.strip()
+        for job in jobs:
+            workdir = job.get('init_work_dir')
+            if workdir is None:
+                match = re.search(r'PBS_O_WORKDIR=([^,]+)', job.get('Variable_List', ''))
+                workdir = match.group(1) if match else None
+            job['workdir'] = workdir
+            job['state'] = PBS_STATES.get(job.get('job_state', ''), 'UNKNOWN')
+        return jobs
+
+    def status(self):
+        result = self.run([self.commands['qstat'], '-f'])
+        return {job['workdir']: job['state'] for job in self.parse_qstat(result.stdout)
+                if job['workdir'] is not None and job['state'] not in FINISHED_STATES}
+
+    def job_status(self, job_id):
+        result = self.run([self.commands['qstat'], '-f', str(job_id)])
+        jobs = self.parse_qstat(result.stdout)
+        if result.returncode != 0 or len(jobs) == 0:
+            return None
+        if jobs[0]['state'] in FINISHED_STATES:
+            return None
+        return jobs[0]['state']
+
+    def cancel(self, job_id):
+        self.run([self.commands['qdel'], str(job_id)])
+
+    def accounting(self, job_ids):
+        if len(job_ids) == 0:
+            return []
+        result = self.run([self.commands['qstat'], '-x', '-f'] + [str(j) for j in job_ids])
+        records = []
+        for job in self.parse_qstat(result.stdout):
+            nodes = job.get('Resource_List.nodect', '0')
+            records.append({'job_id': job['job_id'],
+                            'name': job.get('Job_Name', ''),
+                            'state': 'COMPLETED' if job.get('Exit_status', '0') == '0'
+                                     else 'FAILED',
+                            'elapsed': hms_to_seconds(job.get('resources_used.walltime', '0')),
+                            'nodes': int(nodes),
+                            'cpus': int(job.get('Resource_List.ncpus', '0')),
+                            'submit': job.get('qtime', ''),
+                            'start': job.get('stime', job.get('start_time', '')),
+                            'end': job.get('mtime', ''),
+                            'workdir': job['workdir']})
+        return records
+
+
+class LocalScheduler(Scheduler):
+    """
+    Runs job scripts on this machine with at most max_workers running at once.
+    There is no daemon: pending jobs are started whenever the queue is touched
+    (submit, status, ...) and by every job as it finishes, so the queue drains
+    on its own
+    Args:
+        queue_dir: where the queue file, logs and exit codes are kept
+        max_workers: number of jobs allowed to run at the same time
+    """
+    name = 'local'
+
+    def __init__(self, queue_dir=None, max_workers=None, **kwargs):
+        super().__init__(**kwargs)
+        if queue_dir is None:
+            queue_dir = os.environ.get('VASP_LOCAL_QUEUE_DIR',
+                                       os.path.join(os.path.expanduser('~'),
+                                                    '.vasp_local_queue'))
+        if max_workers is None:
+            max_workers = int(os.environ.get('VASP_LOCAL_WORKERS', 1))
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.max_workers = max_workers
+        self.queue_file = os.path.join(self.queue_dir, 'queue.json')
+        os.makedirs(self.queue_dir, exist_ok=True)
+
+    def locked(self):
+        lock = open(os.path.join(self.queue_dir, 'queue.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def read_queue(self):
+        if not os.path.exists(self.queue_file):
+            return {'next_id': 1, 'jobs': []}
+        with open(self.queue_file) as f:
+            return json.load(f)
+
+    def write_queue(self, queue):
+        with open(self.queue_file + '.tmp', 'w') as f:
+            json.dump(queue, f, indent=1)
+        os.replace(self.queue_file + '.tmp', self.queue_file)
+
+    def exit_file(self, job_id):
+        return os.path.join(self.queue_dir, str(job_id) + '.exit')
+
+    def is_alive(self, pid):
+        try:
+            # reap the job if this process started it, otherwise it lingers as a zombie
+            os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            pass
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def start(self, job):
+        # the wrapper records the exit code, then starts the next pending job
+        workflow_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        dispatch = (shlex.quote(sys.executable) + ' -m vasp_run.schedulers local ' +
+                    '--queue-dir ' + shlex.quote(self.queue_dir) + ' --max-workers ' +
+                    str(self.max_workers) + ' dispatch')
+        name = os.path.splitext(os.path.basename(job['script']))[0]
+        wrapper = ('bash ' + shlex.quote(job['script']) +
+                   ' > ' + shlex.quote(name + '.o' + str(job['job_id'])) +
+                   ' 2> ' + shlex.quote(name + '.e' + str(job['job_id'])) +
+                   '; echo $? > ' + shlex.quote(self.exit_file(job['job_id'])) +
+                   '; cd ' + shlex.quote(workflow_path) + ' && ' + dispatch +
+                   ' > /dev/null 2>&1')
+        env = dict(os.environ)
+        env['LOCAL_JOB_ID'] = str(job['job_id'])
+        env['PYTHONPATH'] = workflow_path + os.pathsep + env.get('PYTHONPATH', '')
+        process = subprocess.Popen(['bash', '-c', wrapper], cwd=job['cwd'], env=env,
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, start_new_session=True)
+        job['pid'] = process.pid
+        job['state'] = 'RUNNING'
+        job['start'] = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def refresh(self, queue):
+        # marks finished jobs, then fills free worker slots with pending jobs
+        for job in queue['jobs']:
+            if job['state'] != 'RUNNING':
+                continue
+            if os.path.exists(self.exit_file(job['job_id'])):
+                with open(self.exit_file(job['job_id'])) as f:
+                    exit_code = f.read().strip()
+                job['state'] = 'COMPLETED' if exit_code == '0' else 'FAILED'
+                job['exit_code'] = exit_code
+            elif not self.is_alive(job['pid']):
+                job['state'] = 'FAILED'
+            else:
+                continue
+            job['end'] = datetime.datetime.now().isoformat(timespec='seconds')
+        running = len([job for job in queue['jobs'] if job['state'] == 'RUNNING'])
+        for job in queue['jobs']:
+            if running >= self.max_workers:
+                break
+            if job['state'] == 'PENDING':
+                self.start(job)
+                running += 1
+
+    def dispatch(self):
+        with self.locked():
+            queue = self.read_queue()
+            self.refresh(queue)
+            self.write_queue(queue)
+        return queue
+
+    def submit(self, script, cwd='.'):
+        with self.locked():
+            queue = self.read_queue()
+            job_id = str(queue['next_id'])
+            queue['next_id'] += 1
+            queue['jobs'].append({'job_id': job_id,
+                                  'script': os.path.abspath(os.path.join(cwd, script)),
+                                  'cwd': os.path.abspath(cwd),
+                                  'state': 'PENDING',
+                                  'submit': datetime.datetime.now().isoformat(timespec='seconds')})
+            self.refresh(queue)
+            self.write_queue(queue)
+        return job_id
+
+    def status(self):
+        queue = self.dispatch()
+        return {job['cwd']: job['state'] for job in queue['jobs']
+                if job['state'] not in FINISHED_STATES}
+
+    def job_status(self, job_id):
+        for job in self.dispatch()['jobs']:
+            if job['job_id'] == str(job_id) and job['state'] not in FINISHED_STATES:
+                return job['state']
+        return None
+
+    def cancel(self, job_id):
+        with self.locked():
+            queue = self.read_queue()
+            for job in queue['jobs']:
+                if job['job_id'] != str(job_id) or job['state'] in FINISHED_STATES:
+                    continue
+                if job['state'] == 'RUNNING':
+                    try:
+                        os.killpg(job['pid'], signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                job['state'] = 'CANCELLED'
+                job['end'] = datetime.datetime.now().isoformat(timespec='seconds')
+            self.refresh(queue)
+            self.write_queue(queue)
+
+    def wait(self, timeout=None, interval=0.2):
+        """
+        Waits until the queue has drained: every job finished and every
+        process started for one (which dispatches the next job once its own
+        is done) has exited
+        Returns: True if the queue drained, False if timeout (s) passed first
+        """
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            jobs = self.dispatch()['jobs']
+            if all(job['state'] in FINISHED_STATES and not ('pid' in job and self.is_alive(job['pid']))
+                   for job in jobs):
+                return True
+            if end is not None and time.time() > end:
+                return False
+            time.sleep(interval)
+
+    def shutdown(self, timeout=None):
+        """
+        Cancels every job still pending or running, then waits for their
+        processes to exit (see wait)
+        Returns: True if the queue drained within timeout
+        """
+        # newest first, so cancelling a running job does not start a pending one
+        for job in reversed(self.read_queue()['jobs']):
+            if job['state'] not in FINISHED_STATES:
+                self.cancel(job['job_id'])
+        return self.wait(timeout)
+
+    def accounting(self, job_ids):
+        job_ids = [str(j) for j in job_ids]
+        records = []
+        for job in self.dispatch()['jobs']:
+            if job['job_id'] not in job_ids:
+                continue
+            elapsed = 0
+            if 'start' in job and 'end' in job:
+                elapsed = int((datetime.datetime.fromisoformat(job['end']) -
+                               datetime.datetime.fromisoformat(job['start'])).total_seconds())
+            records.append({'job_id': job['job_id'],
+                            'name': os.path.basename(job['script']),
+                            'state': job['state'],
+                            'elapsed': elapsed,
+                            'nodes': 1,
+                            'cpus': os.cpu_count(),
+                            'submit': job['submit'],
+                            'start': job.get('start', ''),
+                            'end': job.get('end', ''),
+                            'workdir': job['cwd']})
+        return records
+
+
+SCHEDULERS = {'slurm': SlurmScheduler, 'pbs': PbsScheduler, 'local': LocalScheduler}
+# clusters without a queue_type in their profile that run Slurm, the rest run PBS
+SLURM_COMPUTERS = ['kestrel', 'janus', 'rapunzel', 'eagle', 'summit']
+
+
+def computer_queue_type(computer=None):
+    """
+    Args:
+        computer: cluster name, getComputerName() (Helpers) if None
+    Returns: scheduler of computer: VASP_SCHEDULER if set, then the
+             queue_type of its cluster profile, then slurm for
+             SLURM_COMPUTERS and pbs otherwise
+    """
+    if 'VASP_SCHEDULER' in os.environ:
+        return os.environ['VASP_SCHEDULER']
+    if computer is None:
+        from Helpers import getComputerName
+        computer = getComputerName()
+    profile = cluster_profiles.get_cluster_profile(computer)
+    if 'queue_type' in profile:
+        return profile['queue_type']
+    return 'slurm' if computer in SLURM_COMPUTERS else 'pbs'
+
+
+def get_scheduler(queue_type=None, **kwargs):
+    """
+    Args:
+        queue_type: 'slurm', 'pbs' or 'local'; VASP_SCHEDULER overrides it and
+                    slurm is used if neither is given
+    Returns: Scheduler instance
+    """
+    if 'VASP_SCHEDULER' in os.environ:
+        queue_type = os.environ['VASP_SCHEDULER']
+    elif queue_type is None:
+        queue_type = 'slurm'
+    if queue_type not in SCHEDULERS:
+        raise Exception('Unrecognized scheduler:  ' + queue_type)
+    return SCHEDULERS[queue_type](**kwargs)
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Manage the local job queue')
+    parser.add_argument('scheduler', choices=['local'])
+    parser.add_argument('--queue-dir', type=str)
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('action', choices=['dispatch', 'status', 'cancel', 'wait', 'shutdown'])
+    parser.add_argument('job_id', nargs='?')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = argument_parser()
+    scheduler = LocalScheduler(args.queue_dir, args.max_workers)
+    if args.action == 'dispatch':
+        scheduler.dispatch()
+    elif args.action == 'status':
+        for job in scheduler.dispatch()['jobs']:
+            print(job['job_id'], job['state'], job['cwd'])
+    elif args.action == 'cancel':
+        scheduler.cancel(args.job_id)
+    elif args.action == 'wait':
+        scheduler.wait()
+    elif args.action == 'shutdown':
+        scheduler.shutdown()
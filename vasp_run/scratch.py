@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Node-local scratch staging. With scratch on (vasp.py --scratch, AUTO_SCRATCH
+in the INCAR, or the cluster profile's scratch settings) the job script
+stages the inputs of the job directory to node-local storage, runs
+Custodian there and copies the results back when each stage of a multi-step
+run ends, when the scheduler sends the walltime signal and when the job
+ends. The inputs are only staged on the node running the job script, so
+scratch is turned off for jobs on more than one node.
+
+Copy-back goes through include and exclude lists of shell patterns matched
+against paths relative to the job directory (VASP_SCRATCH_INCLUDE and
+VASP_SCRATCH_EXCLUDE in the job, AUTO_SCRATCH_INCLUDE/AUTO_SCRATCH_EXCLUDE
+in the INCAR or include/exclude in the profile), so e.g. WAVECAR can be
+left behind.
+
+    python -m vasp_run.scratch stage job_dir scratch_dir
+    python -m vasp_run.scratch copy-back scratch_dir job_dir [--include ...] [--exclude ...]
+    python -m vasp_run.scratch cleanup scratch_dir
+"""
+
+import os
+import shutil
+import socket
+import fnmatch
+import argparse
+from vasp_run import workflow_state
+
+# inputs of every job type, plus restart files worth carrying into scratch
+STAGE_FILES = ['INCAR', 'POSCAR', 'KPOINTS', 'POTCAR', 'CONVERGENCE', 'WAVECAR', 'CHGCAR',
+               'MODECAR', 'inpfileq', 'restart.xyz0000', 'MOCK_VASP_OUTCOME']
+SKIP_DIRS = ['backup', 'probe']
+SCRATCH_ROOT = '${TMPDIR:-/tmp}'
+SIGNAL_SECONDS = 300
+
+
+def patterns(value):
+    """
+    Returns: list of patterns from a space separated string or a list
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return value.split()
+    return list(value)
+
+
+def scratch_settings(profile, incar=None, enabled=False, nodes=1):
+    """
+    Args:
+        profile: cluster profile, may hold a scratch dict with root, include,
+                 exclude and signal_seconds
+        incar: Incar (or dict) with AUTO_SCRATCH, AUTO_SCRATCH_INCLUDE and
+               AUTO_SCRATCH_EXCLUDE
+        enabled: scratch was asked for on the command line
+        nodes: nodes of the job, scratch is off for more than one
+    Returns: dict of the scratch template keywords
+    """
+    incar = incar or {}
+    settings = profile.get('scratch', {})
+    include = patterns(incar.get('AUTO_SCRATCH_INCLUDE', settings.get('include')))
+    exclude = patterns(incar.get('AUTO_SCRATCH_EXCLUDE', settings.get('exclude')))
+    enabled = bool(enabled or incar.get('AUTO_SCRATCH', False))
+    if enabled and int(nodes) > 1:
+        print('Not running in node-local scratch, the other ' + str(int(nodes) - 1) +
+              ' node(s) of the job would not have its inputs')
+        enabled = False
+    return {'scratch': enabled,
+            'scratch_root': settings.get('root', SCRATCH_ROOT),
+            'scratch_include': ' '.join(include),
+            'scratch_exclude': ' '.join(exclude),
+            'scratch_signal': int(settings.get('signal_seconds', SIGNAL_SECONDS))}
+
+
+def selected(path, include, exclude):
+    name = os.path.basename(path)
+    if include and not any(fnmatch.fnmatch(path, p) or fnmatch.fnmatch(name, p) for p in include):
+        return False
+    return not any(fnmatch.fnmatch(path, p) or fnmatch.fnmatch(name, p) for p in exclude)
+
+
+def copy_file(source, destination):
+    # copied under a temporary name so the job directory never holds half a file
+    tmp = destination + '.scratch_tmp'
+    shutil.copy2(source, tmp)
+    os.replace(tmp, destination)
+
+
+def stage(job_dir, scratch_dir):
+    """
+    Args:
+        job_dir: job directory on the shared filesystem
+        scratch_dir: node-local directory to run in, created if missing
+    Returns: list of staged paths relative to job_dir
+    """
+    os.makedirs(scratch_dir, exist_ok=True)
+    staged = []
+    for name in sorted(os.listdir(job_dir)):
+        path = os.path.join(job_dir, name)
+        if name in STAGE_FILES and os.path.isfile(path):
+            copy_file(path, os.path.join(scratch_dir, name))
+            staged.append(name)
+        elif name.isdigit() and os.path.isdir(path):
+            # NEB images
+            os.makedirs(os.path.join(scratch_dir, name), exist_ok=True)
+            for image_file in sorted(os.listdir(path)):
+                if image_file in STAGE_FILES and os.path.isfile(os.path.join(path, image_file)):
+                    copy_file(os.path.join(path, image_file),
+                              os.path.join(scratch_dir, name, image_file))
+                    staged.append(os.path.join(name, image_file))
+    workflow_state.update_job_state(job_dir, scratch=socket.gethostname() + ':' +
+                                    os.path.abspath(scratch_dir))
+    return staged
+
+
+def copy_back(scratch_dir, job_dir, include=None, exclude=None):
+    """
+    Args:
+        scratch_dir: node-local run directory
+        job_dir: job directory to copy results into
+        include: patterns to copy, VASP_SCRATCH_INCLUDE (or everything) if None
+        exclude: patterns not to copy, VASP_SCRATCH_EXCLUDE if None
+    Returns: list of copied paths relative to job_dir; files that have not
+             changed since the last copy are skipped
+    """
+    if include is None:
+        include = patterns(os.environ.get('VASP_SCRATCH_INCLUDE'))
+    if exclude is None:
+        exclude = patterns(os.environ.get('VASP_SCRATCH_EXCLUDE'))
+    copied = []
+    for root, dirs, files in os.walk(scratch_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for name in sorted(files):
+            if name.endswith('.scratch_tmp'):
+                continue
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, scratch_dir)
+            if not selected(relative, include, exclude):
+                continue
+            destination = os.path.join(job_dir, relative)
+            if os.path.exists(destination):
+                (src, dst) = (os.stat(source), os.stat(destination))
+                if src.st_size == dst.st_size and src.st_mtime_ns == dst.st_mtime_ns:
+                    continue
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            copy_file(source, destination)
+            copied.append(relative)
+    return copied
+
+
+def cleanup(scratch_dir):
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=['stage', 'copy-back', 'cleanup'])
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--include', nargs='*')
+    parser.add_argument('--exclude', nargs='*')
+    args = parser.parse_args()
+
+    if args.action == 'stage':
+        staged = stage(args.paths[0], args.paths[1])
+        print('Staged ' + ' '.join(staged) + ' to ' + args.paths[1])
+    elif args.action == 'copy-back':
+        copied = copy_back(args.paths[0], args.paths[1], args.include, args.exclude)
+        print('Copied back ' + (' '.join(copied) if copied else 'nothing'))
+    else:
+        cleanup(args.paths[0])
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Per-stage results of multi-step CONVERGENCE runs. As each stage finishes,
+get_runs in the multistep template appends a record to stages.jsonl in the
+job directory and archives the stage's INCAR, KPOINTS, CONTCAR, OSZICAR and
+vasprun.xml to stages/<stage>/, before the next stage overwrites them. A
+record holds:
+    stage, finished, elapsed_seconds (from the OUTCAR), job_id
+    incar_changes: {tag: [previous stage's value, this stage's value]}
+                   (the whole INCAR for the first stage recorded)
+    energy, energy_per_atom, max_force, forces, stress, magnetization
+    lattice: matrix, abc, angles and volume of the final structure
+    max_strain: largest principal strain of the cell over the stage
+    archive: archived files, relative to the job directory
+    backup: latest backup/N of the job
+so convergence studies and post-processing can follow the stage history
+without parsing XML.
+
+A stage of the CONVERGENCE file can also give skip criteria, checked
+against the stages that already finished before it starts:
+    SKIP_MAX_FORCE   largest force of the previous stage (eV/A)
+    SKIP_MAX_DE      energy change per atom between the two previous stages (eV)
+    SKIP_MAX_STRAIN  largest principal strain of the cell over the previous stage
+When all criteria a stage gives are met the stage is skipped (its INCAR
+changes still carry over to the next one) and a record with skipped set
+and the measured values is appended instead.
+
+    python -m vasp_run.stages [job_dir]
+"""
+
+import os
+import re
+import json
+import shutil
+import argparse
+import numpy as np
+from pymatgen.io.vasp.inputs import Incar
+from pymatgen.io.vasp.outputs import Vasprun
+from vasp_run import compact
+from vasp_run import workflow_state
+
+STAGES_FILE = 'stages.jsonl'
+ARCHIVE_DIR = 'stages'
+ARCHIVE_FILES = ['INCAR', 'KPOINTS', 'CONTCAR', 'OSZICAR', 'vasprun.xml']
+MAG_PATTERN = re.compile(r'mag=\s*(\S+)')
+ELAPSED_PATTERN = re.compile(r'Elapsed time \(sec\):\s+([\d.]+)')
+STEP_PATTERN = re.compile(r'^\s*(\d+)\s+Step\s*$')
+SKIP_TAGS = ['SKIP_MAX_FORCE', 'SKIP_MAX_DE', 'SKIP_MAX_STRAIN']
+
+
+def incar_changes(previous, incar):
+    """
+    Returns: {tag: [previous value, new value]} for every tag that differs
+    """
+    changes = {}
+    for tag in sorted(set(previous) | set(incar)):
+        if previous.get(tag) != incar.get(tag):
+            changes[tag] = [previous.get(tag), incar.get(tag)]
+    return changes
+
+
+def last_match(path, pattern):
+    path = compact.output_path(os.path.dirname(path), os.path.basename(path))
+    if not os.path.exists(path):
+        return None
+    value = None
+    with compact.open_output(path) as f:
+        for line in f:
+            match = pattern.search(line)
+            if match:
+                value = float(match.group(1))
+    return value
+
+
+def latest_backup(job_dir):
+    backup_dir = os.path.join(job_dir, 'backup')
+    if not os.path.isdir(backup_dir):
+        return None
+    runs = [int(d) for d in os.listdir(backup_dir) if d.isdigit()]
+    return os.path.join('backup', str(max(runs))) if runs else None
+
+
+def read_stages(job_dir='.'):
+    """
+    Returns: list of the stage records of job_dir, oldest first
+    """
+    path = os.path.join(job_dir, STAGES_FILE)
+    if not os.path.isdir(job_dir):
+        # archived jobs keep their stage records in the workflow archive
+        from vasp_run import archive
+        if archive.is_archived(job_dir) and STAGES_FILE in archive.lookup(job_dir)['files']:
+            lines = archive.read_member(job_dir, STAGES_FILE).decode().splitlines()
+            return [json.loads(line) for line in lines if line.strip()]
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def max_strain(initial, final):
+    """
+    Returns: largest principal (Green-Lagrange) strain taking lattice matrix
+             initial to final
+    """
+    deformation = np.linalg.solve(np.array(initial), np.array(final))
+    strain = 0.5 * (deformation.dot(deformation.T) - np.identity(3))
+    return float(max(abs(np.linalg.eigvalsh(strain))))
+
+
+def stage_results(directory):
+    """
+    Returns: energy, force, stress and lattice entries of a record from the
+             vasprun.xml in directory, an error entry if it cannot be read
+    """
+    try:
+        vasprun = Vasprun(compact.output_path(directory, 'vasprun.xml'), parse_dos=False,
+                          parse_eigen=False, parse_potcar_file=False)
+    except Exception as e:
+        return {'error': 'unreadable vasprun.xml: ' + str(e)}
+    step = vasprun.ionic_steps[-1]
+    structure = vasprun.final_structure
+    # plain lists, pymatgen may hand back arrays
+    forces = [[float(x) for x in force] for force in step['forces']] \
+        if step.get('forces') is not None else None
+    stress = [[float(x) for x in row] for row in step['stress']] \
+        if step.get('stress') is not None else None
+    return {'energy': float(vasprun.final_energy),
+            'energy_per_atom': float(vasprun.final_energy) / len(structure),
+            'converged': vasprun.converged,
+            'max_force': max(sum(f * f for f in force) ** 0.5 for force in forces) if forces else None,
+            'forces': forces,
+            'stress': stress,
+            'lattice': {'matrix': structure.lattice.matrix.tolist(),
+                        'abc': list(structure.lattice.abc),
+                        'angles': list(structure.lattice.angles),
+                        'volume': structure.lattice.volume},
+            'max_strain': max_strain(vasprun.initial_structure.lattice.matrix,
+                                     structure.lattice.matrix)}
+
+
+def record_stage(directory, stage, job_dir=None):
+    """
+    Args:
+        directory: directory the stage ran in
+        stage: stage number that just finished
+        job_dir: job directory, directory if None (the job directory when
+                 running in node-local scratch)
+    Returns: the record appended to stages.jsonl
+    """
+    job_dir = job_dir or os.environ.get('VASP_SCRATCH_JOB_DIR', directory)
+    archive = os.path.join(ARCHIVE_DIR, str(stage))
+    os.makedirs(os.path.join(job_dir, archive), exist_ok=True)
+    previous = [r for r in read_stages(job_dir) if r['stage'] != stage]
+    previous_incar = os.path.join(job_dir, ARCHIVE_DIR, str(previous[-1]['stage']), 'INCAR') \
+        if previous else None
+    incar = Incar.from_file(os.path.join(directory, 'INCAR'))
+    if previous_incar is not None and os.path.exists(previous_incar):
+        changes = incar_changes(Incar.from_file(previous_incar), incar)
+    else:
+        changes = incar_changes({}, incar)
+
+    record = {'stage': stage,
+              'finished': workflow_state.now(),
+              'elapsed_seconds': last_match(os.path.join(directory, 'OUTCAR'), ELAPSED_PATTERN),
+              'job_id': os.environ.get('SLURM_JOB_ID', os.environ.get('PBS_JOBID')),
+              'incar_changes': changes,
+              'magnetization': last_match(os.path.join(directory, 'OSZICAR'), MAG_PATTERN)}
+    record.update(stage_results(directory))
+    record['archive'] = []
+    for name in ARCHIVE_FILES:
+        if os.path.exists(os.path.join(directory, name)):
+            shutil.copy(os.path.join(directory, name), os.path.join(job_dir, archive, name))
+            record['archive'].append(os.path.join(archive, name))
+    record['backup'] = latest_backup(job_dir)
+    with open(os.path.join(job_dir, STAGES_FILE), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+
+def read_skip_criteria(convergence='CONVERGENCE'):
+    """
+    Returns: {stage: {SKIP_ tag: value}} of the stages in the CONVERGENCE
+             file that give skip criteria
+    """
+    criteria = {}
+    stage = None
+    with open(convergence) as f:
+        for line in f:
+            match = STEP_PATTERN.match(line)
+            if match:
+                stage = int(match.group(1))
+            elif stage is not None and '=' in line:
+                (tag, value) = [part.strip() for part in line.split('=', 1)]
+                if tag.upper() in SKIP_TAGS:
+                    criteria.setdefault(stage, {})[tag.upper()] = float(value)
+    return criteria
+
+
+def skip_measurements(criteria, records):
+    """
+    Args:
+        criteria: {SKIP_ tag: limit} of the stage about to start
+        records: stage records so far, oldest first
+    Returns: {SKIP_ tag: measured value} if every criterion is met, None
+             otherwise (also when there is not enough history to tell)
+    """
+    finished = [r for r in records if not r.get('skipped') and 'energy' in r]
+    if not criteria or not finished:
+        return None
+    measured = {}
+    for (tag, limit) in criteria.items():
+        if tag == 'SKIP_MAX_FORCE':
+            value = finished[-1].get('max_force')
+        elif tag == 'SKIP_MAX_STRAIN':
+            value = finished[-1].get('max_strain')
+        elif len(finished) > 1:
+            value = abs(finished[-1]['energy_per_atom'] - finished[-2]['energy_per_atom'])
+        else:
+            value = None
+        if value is None or value > limit:
+            return None
+        measured[tag] = value
+    return measured
+
+
+def skip_stage(directory, stage, convergence='CONVERGENCE', job_dir=None):
+    """
+    Args:
+        directory: directory the run is in
+        stage: stage about to start
+        convergence: CONVERGENCE file with the skip criteria
+        job_dir: job directory, directory if None (the job directory when
+                 running in node-local scratch)
+    Returns: True if the stage is skipped, after recording it
+    """
+    job_dir = job_dir or os.environ.get('VASP_SCRATCH_JOB_DIR', directory)
+    criteria = read_skip_criteria(os.path.join(directory, convergence)).get(stage)
+    measured = skip_measurements(criteria, read_stages(job_dir))
+    if measured is None:
+        return False
+    record = {'stage': stage, 'skipped': True, 'finished': workflow_state.now(),
+              'job_id': os.environ.get('SLURM_JOB_ID', os.environ.get('PBS_JOBID')),
+              'criteria': criteria, 'measured': measured}
+    with open(os.path.join(job_dir, STAGES_FILE), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return True
+
+
+def finish_skipped(directory, last_stage):
+    """
+    Marks a run whose remaining stages were all skipped as being at its last
+    stage, which is what rerun_workflow.py checks for completion
+    """
+    incar = Incar.from_file(os.path.join(directory, 'INCAR'))
+    incar['STAGE_NUMBER'] = last_stage
+    incar.write_file(os.path.join(directory, 'INCAR'))
+
+
+def skipped_stages(job_dir='.'):
+    """
+    Returns: stages skipped by the last submitted run of job_dir, so the
+             skips of runs before STAGE_NUMBER was reset do not count
+    """
+    last = workflow_state.last_submission(job_dir)
+    skipped = []
+    for record in read_stages(job_dir):
+        if not record.get('skipped'):
+            continue
+        if last is not None:
+            if record.get('job_id') and last.get('job_id'):
+                if str(record['job_id']) != str(last['job_id']):
+                    continue
+            # a skip in the second of the submission is from the run before it
+            elif record['finished'] <= (last.get('submitted') or ''):
+                continue
+        skipped.append(record['stage'])
+    return skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('job_dir', nargs='?', default='.')
+    args = parser.parse_args()
+
+    print('%5s %16s %12s %10s %10s  %s' % ('stage', 'energy (eV)', 'max force', 'volume',
+                                           'time (s)', 'INCAR changes'))
+    for record in read_stages(args.job_dir):
+        if record.get('skipped'):
+            print('%5d  skipped, ' % record['stage'] +
+                  ' '.join('%s=%g' % item for item in record['measured'].items()))
+            continue
+        changes = ' '.join('%s=%s' % (tag, values[1]) for tag, values in record['incar_changes'].items())
+        print('%5d %16s %12s %10s %10s  %s' % (
+            record['stage'],
+            '%.6f' % record['energy'] if record.get('energy') is not None else '-',
+            '%.4f' % record['max_force'] if record.get('max_force') is not None else '-',
+            '%.3f' % record['lattice']['volume'] if 'lattice' in record else '-',
+            '%.0f' % record['elapsed_seconds'] if record.get('elapsed_seconds') else '-',
+            changes))
@@ -0,0 +1,69 @@
+"""
+Job script templates. One TemplateService per template directory compiles
+each template once per process and renders any number of keyword sets with
+it (federated submissions render one script per cluster). With
+VASP_TEMPLATE_CACHE set to a directory, the compiled bytecode is also kept
+there, so later vasp.py runs skip compiling. check() compiles a template and
+everything it extends or includes, so vasp.py stops on a broken template
+before it touches the job.
+"""
+
+import os
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateError, meta
+
+REPO_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 'jinja_templates')
+_services = {}
+
+
+class TemplateService(object):
+    def __init__(self, template_dir, cache_dir=None):
+        options = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            options['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
+        self.template_dir = template_dir
+        self.env = Environment(loader=FileSystemLoader(template_dir), **options)
+
+    def get(self, name):
+        return self.env.get_template(name)
+
+    def render(self, name, keywords):
+        return self.get(name).render(keywords)
+
+    def render_many(self, name, keyword_sets):
+        """
+        Returns: list of the scripts rendered from name with each keyword set
+        """
+        template = self.get(name)
+        return [template.render(keywords) for keywords in keyword_sets]
+
+    def check(self, names):
+        """
+        Compiles names and the templates they extend, include or import
+        Raises: TemplateError naming every template that does not compile
+        """
+        (pending, seen, errors) = (list(names), set(), [])
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            try:
+                (source, _, _) = self.env.loader.get_source(self.env, name)
+                pending.extend(n for n in meta.find_referenced_templates(self.env.parse(source))
+                               if n is not None)
+                self.get(name)
+            except TemplateError as e:
+                errors.append('%s: %s' % (name, e))
+        if errors:
+            raise TemplateError('Broken templates in ' + self.template_dir + ':\n' + '\n'.join(errors))
+
+
+def get_service(template_dir):
+    """
+    Returns: the TemplateService of template_dir, made on first use
+    """
+    if template_dir not in _services:
+        _services[template_dir] = TemplateService(template_dir, os.environ.get('VASP_TEMPLATE_CACHE'))
+    return _services[template_dir]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import unittest
+import io
+import os
+import json
+import tempfile
+from contextlib import redirect_stdout
+from vasp_run import accounting
+from vasp_run import eventlog
+from vasp_run import stages
+from vasp_run import workflow_state
+
+SACCT = {'11': ('TIMEOUT', 7200, 104), '12': ('COMPLETED', 1800, 104),
+         '21': ('COMPLETED', 3600, 36), '22': ('RUNNING', 600, 36)}
+
+
+class FakeScheduler(object):
+    def __init__(self):
+        self.asked = []
+
+    def accounting(self, job_ids):
+        self.asked.extend(job_ids)
+        return [{'job_id': j, 'state': SACCT[j][0], 'elapsed': SACCT[j][1], 'nodes': 1,
+                 'cpus': SACCT[j][2]} for j in job_ids]
+
+
+class TestAccounting(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        with open(os.path.join(self.root, 'WORKFLOW_NAME'), 'w') as f:
+            f.write('NAME = test')
+        (self.multi, self.single) = [os.path.join(self.root, name) for name in ['CsPbBr3', 'CsSnBr3']]
+        for (path, submissions) in [(self.multi, [('11', '2024-01-01T00:00:00', 0),
+                                                  ('12', '2024-01-02T00:00:00', 1)]),
+                                    (self.single, [('21', '2024-01-01T00:00:00', None),
+                                                   ('22', None, None)])]:
+            os.makedirs(path)
+            workflow_state.write_job_state({'submissions': [
+                {'job_id': job_id, 'submitted': submitted, 'scheduler': 'slurm', 'cores': 1,
+                 'stage': stage, 'name': os.path.basename(path)}
+                for (job_id, submitted, stage) in submissions]}, path)
+        with open(os.path.join(self.multi, stages.STAGES_FILE), 'w') as f:
+            f.write(json.dumps({'stage': 0, 'job_id': '11', 'elapsed_seconds': 3600.0}) + '\n')
+        # the sweep after job 21 raised NELM and resubmitted in the same second
+        log = eventlog.EventLog(self.root)
+        with redirect_stdout(io.StringIO()):
+            event = log.emit('incar', 'Increased NELM to 500 max steps for electronic convergence.',
+                             job='CsSnBr3', path=self.single, tag='NELM', old=60, value=500)
+        state = workflow_state.read_job_state(self.single)
+        state['submissions'][1]['submitted'] = event['time'][:19]
+        workflow_state.write_job_state(state, self.single)
+        self.scheduler = FakeScheduler()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def account(self):
+        return accounting.account(self.root, get_backend=lambda name: self.scheduler)
+
+    def test_useful_and_wasted(self):
+        parts = self.account()
+        by_stage = accounting.totals(parts, 'stage')
+        self.assertAlmostEqual(by_stage[(self.multi, 0)]['useful'], 104.0)
+        self.assertEqual(by_stage[(self.multi, 1)]['reasons'], {'timeout': 104.0})
+        self.assertAlmostEqual(by_stage[(self.multi, 1)]['useful'], 52.0)
+        by_job = accounting.totals(parts, 'job')
+        self.assertEqual(by_job[self.single]['reasons'], {'nelm_escalation': 36.0})
+        self.assertAlmostEqual(by_job[self.single]['useful'], 6.0)
+        workflow = accounting.totals(parts, 'workflow')['.']
+        self.assertAlmostEqual(workflow['core_hours'], 302.0)
+        self.assertAlmostEqual(workflow['wasted'], 140.0)
+
+    def test_incremental_cache(self):
+        self.account()
+        self.assertEqual(sorted(self.scheduler.asked), ['11', '12', '21', '22'])
+        self.scheduler.asked = []
+        parts = self.account()
+        # only the running job is asked for again
+        self.assertEqual(self.scheduler.asked, ['22'])
+        self.assertEqual(len(parts), 5)
+        self.scheduler.asked = []
+        self.assertEqual(len(accounting.account(self.root, query=False)), 5)
+        self.assertEqual(self.scheduler.asked, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
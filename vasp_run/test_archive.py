@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from pymatgen.io.vasp.outputs import Vasprun
+from slurm_emulator import mock_vasp
+from vasp_run import archive
+from vasp_run import compact
+from vasp_run import workflow_state
+from vasp_run.test_stages import POSCAR
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        with open(os.path.join(self.root, 'WORKFLOW_NAME'), 'w') as f:
+            f.write('NAME = test')
+        self.dirs = [os.path.join(self.root, 'perovskites', name) for name in ['CsPbBr3', 'CsSnBr3']]
+        for d in self.dirs:
+            os.makedirs(os.path.join(d, '01'))
+            for (name, text) in [('POSCAR', POSCAR), ('KPOINTS', 'auto\n0\nGamma\n4 4 4\n'),
+                                 ('INCAR', 'NSW = 3\nIBRION = 2\n'), ('01/POSCAR', 'image\n')]:
+                with open(os.path.join(d, name), 'w') as f:
+                    f.write(text)
+            mock_vasp.write_outputs(d, outcome='converged')
+            workflow_state.record_submission(d, job_id='7')
+            os.chmod(os.path.join(d, 'INCAR'), 0o600)
+        self.energy = Vasprun(os.path.join(self.dirs[0], 'vasprun.xml')).final_energy
+        self.mtime = os.path.getmtime(os.path.join(self.dirs[0], 'POSCAR'))
+        compact.compact_dir(self.dirs[1])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_archive_and_read(self):
+        path = archive.archive_jobs(self.dirs, {self.dirs[0]: 'CsPbBr3_PBE'})
+        self.assertEqual(os.path.dirname(path), os.path.join(self.root, archive.ARCHIVE_DIR))
+        self.assertFalse(any(os.path.exists(d) for d in self.dirs))
+        self.assertEqual(archive.archived_jobs(self.root),
+                         {self.dirs[0]: 'CsPbBr3_PBE', self.dirs[1]: 'CsSnBr3'})
+        self.assertEqual(archive.archived_jobs(self.dirs[1]), {self.dirs[1]: 'CsSnBr3'})
+
+        self.assertEqual(archive.read_member(self.dirs[0], '01/POSCAR'), b'image\n')
+        with archive.open_member(self.dirs[0], 'POSCAR') as f:
+            self.assertEqual(f.read(), POSCAR)
+        # compacted outputs read back under their plain names
+        for d in self.dirs:
+            with archive.member_path(d, 'vasprun.xml') as vasprun_path:
+                self.assertEqual(Vasprun(vasprun_path).final_energy, self.energy)
+        self.assertEqual(workflow_state.last_submission(self.dirs[0])['job_id'], '7')
+        with self.assertRaises(KeyError):
+            archive.read_member(self.dirs[0], 'WAVECAR')
+
+        restored = archive.restore(self.dirs[0])
+        self.assertEqual(restored, self.dirs[0])
+        self.assertFalse(archive.is_archived(self.dirs[0]))
+        self.assertEqual(os.path.getmtime(os.path.join(self.dirs[0], 'POSCAR')), self.mtime)
+        self.assertEqual(os.stat(os.path.join(self.dirs[0], 'INCAR')).st_mode & 0o777, 0o600)
+        with open(os.path.join(self.dirs[0], '01', 'POSCAR')) as f:
+            self.assertEqual(f.read(), 'image\n')
+
+    def test_second_archive(self):
+        archive.archive_jobs(self.dirs[:1])
+        path = archive.archive_jobs(self.dirs[1:])
+        self.assertTrue(path.endswith('jobs-0001.tar'))
+        self.assertEqual(sorted(archive.archived_jobs(self.root)), self.dirs)
+
+
+if __name__ == '__main__':
+    unittest.main()
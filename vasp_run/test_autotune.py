@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from pymatgen.io.vasp.inputs import Incar
+from vasp_run import autotune
+from vasp_run import resources
+
+POSCAR = '''CsPbBr3
+1.0
+5.9 0.0 0.0
+0.0 5.9 0.0
+0.0 0.0 5.9
+Cs Pb Br
+1 1 3
+Direct
+0.5 0.5 0.5
+0.0 0.0 0.0
+0.5 0.0 0.0
+0.0 0.5 0.0
+0.0 0.0 0.5
+'''
+PROFILE = {'cores_per_node': 104, 'sockets': 2, 'memory_per_node_mb': 246000}
+
+
+class TestAutotune(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue_dir = os.path.join(self.tmp.name, 'queue')
+        os.environ['VASP_SCHEDULER'] = 'local'
+        os.environ['VASP_LOCAL_QUEUE_DIR'] = self.queue_dir
+
+    def tearDown(self):
+        del os.environ['VASP_SCHEDULER']
+        del os.environ['VASP_LOCAL_QUEUE_DIR']
+        self.tmp.cleanup()
+
+    def make_job(self, name, incar='ENCUT = 400\nNPAR = 1\n', mesh='6 6 6'):
+        job_dir = os.path.join(self.tmp.name, 'workflow', name)
+        os.makedirs(job_dir)
+        files = {'POSCAR': POSCAR, 'INCAR': incar, 'POTCAR': '',
+                 'KPOINTS': 'auto\n0\nGamma\n' + mesh + '\n'}
+        for file_name, text in files.items():
+            with open(os.path.join(job_dir, file_name), 'w') as f:
+                f.write(text)
+        return job_dir
+
+    def test_layouts_are_valid(self):
+        size = resources.job_size(self.make_job('CsPbBr3'))
+        layouts = autotune.rank_layouts(size, PROFILE, nodes=2)
+        self.assertTrue(layouts)
+        costs = [layout['cost'] for layout in layouts]
+        self.assertEqual(costs, sorted(costs))
+        for layout in layouts:
+            ranks = layout['nodes'] * layout['ranks_per_node']
+            self.assertEqual(size['nkpts'] % layout['kpar'], 0)
+            self.assertEqual(layout['ranks_per_node'] % layout['ncore'], 0)
+            self.assertEqual((ranks // layout['kpar']) % layout['ncore'], 0)
+            self.assertEqual(52 % layout['threads'], 0)
+            self.assertEqual(layout['ranks_per_node'] * layout['threads'], 104)
+
+    def test_memory_limits_layouts(self):
+        size = resources.job_size(self.make_job('CsPbBr3'))
+        roomy = autotune.rank_layouts(size, PROFILE)
+        # only layouts with few enough ranks per node fit
+        tight = dict(PROFILE, memory_per_node_mb=min(l['memory_mb'] for l in roomy) * 30)
+        layouts = autotune.rank_layouts(size, tight)
+        self.assertTrue(layouts)
+        self.assertLess(len(layouts), len(roomy))
+        self.assertTrue(all(l['ranks_per_node'] <= 30 for l in layouts))
+
+    def test_tune_job_writes_layout(self):
+        job_dir = self.make_job('CsPbBr3')
+        best = autotune.tune_job(job_dir, PROFILE)[0]
+        incar = Incar.from_file(os.path.join(job_dir, 'INCAR'))
+        self.assertNotIn('NPAR', incar)
+        self.assertEqual(incar['KPAR'], best['kpar'])
+        self.assertEqual(incar['NCORE'], best['ncore'])
+        self.assertEqual(incar['AUTO_NODES'], 1)
+        self.assertEqual(incar['AUTO_CORES'] * incar['AUTO_OMP'], 104)
+
+    def test_pending_jobs(self):
+        done = self.make_job('done')
+        self.make_job('pending')
+        self.make_job(os.path.join('pending', 'backup'))
+        with open(os.path.join(self.tmp.name, 'workflow', 'completed_jobs.yml'), 'w') as f:
+            f.write('PATHs:\n  ' + done + ': done\n')
+        pending = autotune.pending_jobs(os.path.join(self.tmp.name, 'workflow'))
+        self.assertEqual(pending, [os.path.join(self.tmp.name, 'workflow', 'pending')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from vasp_run import archive
+from vasp_run import backup_store
+
+OUTCAR = ' running on    8 total cores\n' + '      LOOP:  cpu time    1.00: real time    1.00\n' * 2000
+
+
+class TestBackupStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.write('WORKFLOW_NAME', 'NAME = test')
+        self.job = os.path.join(self.root, 'CsPbBr3')
+        os.makedirs(os.path.join(self.job, '01'))
+        self.write('CsPbBr3/OUTCAR', OUTCAR)
+        self.write('CsPbBr3/INCAR', 'ENCUT = 520\n')
+        self.write('CsPbBr3/01/POSCAR', 'image\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.root, name), 'w') as f:
+            f.write(text)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def objects(self):
+        store = os.path.join(self.root, backup_store.STORE_DIR)
+        return sorted(name for (path, dirs, files) in os.walk(store) for name in files)
+
+    def test_backups_share_objects(self):
+        files = ['OUTCAR', 'INCAR', '01/POSCAR', 'CONTCAR']
+        first = backup_store.backup(self.job, files)
+        self.assertEqual(first, os.path.join(self.job, 'backup', '0', 'manifest.json'))
+        # only changed content adds objects
+        self.write('CsPbBr3/INCAR', 'ENCUT = 600\n')
+        second = backup_store.backup(self.job, files)
+        self.assertEqual(len(self.objects()), 4)
+        # the OUTCAR is kept compressed, the short files are not worth it
+        self.assertEqual(len([name for name in self.objects() if name.endswith('.gz')]), 1)
+        manifest = backup_store.read_manifest(os.path.dirname(second))
+        self.assertEqual(sorted(manifest['files']), ['01/POSCAR', 'INCAR', 'OUTCAR'])
+        self.assertEqual(manifest['files']['OUTCAR']['size'], len(OUTCAR))
+
+        restored = os.path.join(self.root, 'restored')
+        backup_store.restore(os.path.dirname(first), restored)
+        self.assertEqual(self.read(os.path.join(restored, 'OUTCAR')), OUTCAR)
+        self.assertEqual(self.read(os.path.join(restored, 'INCAR')), 'ENCUT = 520\n')
+        self.assertEqual(self.read(os.path.join(restored, '01', 'POSCAR')), 'image\n')
+        backup_store.restore(os.path.dirname(second))
+        self.assertEqual(self.read(os.path.join(self.job, 'backup', '1', 'INCAR')), 'ENCUT = 600\n')
+
+    def test_collect_garbage(self):
+        backup_store.backup(self.job, ['OUTCAR', 'INCAR'])
+        self.write('CsPbBr3/INCAR', 'ENCUT = 600\n')
+        backup_store.backup(self.job, ['INCAR'])
+        os.remove(os.path.join(self.job, 'backup', '0', 'manifest.json'))
+        (removed, freed) = backup_store.collect_garbage(self.job)
+        self.assertEqual(removed, 2)
+        self.assertEqual(len(self.objects()), 1)
+        backup_store.restore(os.path.join(self.job, 'backup', '1'))
+
+    def test_archived_backups_keep_objects(self):
+        backup_store.backup(self.job, ['OUTCAR', 'INCAR'])
+        archive.archive_jobs([self.job])
+        self.assertFalse(os.path.isdir(self.job))
+        (removed, freed) = backup_store.collect_garbage(self.root)
+        self.assertEqual(removed, 0)
+        # the manifest is read from the archive
+        destination = os.path.join(self.root, 'restored')
+        backup_store.restore(os.path.join(self.job, 'backup', '0'), destination)
+        self.assertEqual(self.read(os.path.join(destination, 'OUTCAR')), OUTCAR)
+        archive.restore(self.job)
+        backup_store.restore(os.path.join(self.job, 'backup', '0'))
+        self.assertEqual(self.read(os.path.join(self.job, 'backup', '0', 'INCAR')), 'ENCUT = 520\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+from jinja2 import Environment, FileSystemLoader
+from vasp_run import binding
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'jinja_templates')
+PROFILE = {'binding': {'cpu_bind': 'cores', 'distribution': 'block:block',
+                       'hint': 'nomultithread'}}
+
+
+class TestBinding(unittest.TestCase):
+    def test_precedence(self):
+        settings = binding.binding_settings(PROFILE, {'AUTO_CPU_BIND': 'Sockets'},
+                                            {'distribution': 'cyclic', 'hint': None})
+        self.assertEqual(settings, {'cpu_bind': 'sockets', 'distribution': 'cyclic',
+                                    'hint': 'nomultithread'})
+        threaded = binding.binding_settings({}, threads=4)
+        self.assertEqual(threaded, {'omp_places': 'cores', 'omp_proc_bind': 'close'})
+        self.assertEqual(binding.binding_settings({}), {})
+
+    def test_srun(self):
+        settings = binding.binding_settings(PROFILE, threads=2)
+        self.assertEqual(binding.sbatch_options(settings),
+                         ['--cpu-bind=cores', '--distribution=block:block',
+                          '--hint=nomultithread'])
+        self.assertEqual(binding.launcher_options(settings, 'srun', 2),
+                         ['--cpus-per-task=2', '--cpu-bind=cores',
+                          '--distribution=block:block'])
+        self.assertEqual(binding.environment(settings, 'srun', 2),
+                         ['OMP_PLACES=cores', 'OMP_PROC_BIND=close'])
+
+    def test_mpirun_flavors(self):
+        settings = binding.binding_settings(PROFILE, threads=4)
+        self.assertEqual(binding.launcher_options(settings, 'mpirun', 4),
+                         ['--map-by', 'slot:PE=4', '--bind-to', 'core'])
+        settings['mpi_flavor'] = 'mpich'
+        self.assertEqual(binding.launcher_options(settings, 'mpirun', 4),
+                         ['-bind-to', 'core:4'])
+        settings['mpi_flavor'] = 'intelmpi'
+        self.assertEqual(binding.launcher_options(settings, 'mpirun', 4), [])
+        self.assertIn('I_MPI_PIN_DOMAIN=omp', binding.environment(settings, 'mpirun', 4))
+        self.assertEqual(binding.launcher_options({}, 'mpirun'), [])
+
+    def test_templates_render_binding(self):
+        settings = binding.binding_settings(PROFILE, threads=2)
+        keywords = {'queue_type': 'slurm', 'name': 'CsPbBr3', 'time': 4, 'tasks': 104,
+                    'nodes': 2, 'cores': 52, 'mem': 0, 'account': 'x',
+                    'computer': 'kestrel', 'queue': 'standard', 'shared': False,
+                    'openmp': 2, 'mpi': 'mpirun', 'jobtype': 'Standard',
+                    'logname': 'CsPbBr3.log', 'CONVERGENCE': 'CONVERGENCE',
+                    'binding_sbatch': binding.sbatch_options(settings),
+                    'binding_env': binding.environment(settings, 'mpirun', 2),
+                    'mpi_options': binding.launcher_options(settings, 'mpirun', 2)}
+        env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+        launcher = "['mpirun', '-np', '104', '--map-by', 'slot:PE=2', '--bind-to', 'core', vasp]"
+        for template in ['VASP.base.jinja2.sh', 'VASP.multistep_include_ncl.jinja2.py']:
+            script = env.get_template(template).render(keywords)
+            self.assertIn('#SBATCH --hint=nomultithread\n', script)
+            self.assertIn('export OMP_NUM_THREADS=2 \nexport OMP_PLACES=cores\n'
+                          'export OMP_PROC_BIND=close', script)
+            self.assertIn(launcher, script)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from pymatgen.io.vasp.outputs import Vasprun
+from slurm_emulator import mock_vasp
+from vasp_run import compact
+from vasp_run import resources
+from vasp_run import stages
+from vasp_run.test_stages import POSCAR
+
+
+class TestCompact(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dirs = [os.path.join(self.tmp.name, name) for name in ['CsPbBr3', 'CsSnBr3']]
+        for d in self.dirs:
+            os.makedirs(os.path.join(d, 'stages', '0'))
+            self.write(d, 'POSCAR', POSCAR)
+            self.write(d, 'KPOINTS', 'auto\n0\nGamma\n4 4 4\n')
+            self.write(d, 'INCAR', 'NSW = 3\nIBRION = 2\n')
+            mock_vasp.write_outputs(d, outcome='converged')
+            with open(os.path.join(d, 'OUTCAR'), 'a') as f:
+                f.write(' running on    8 total cores\n Maximum memory used (kb):      204800.\n')
+            self.write(d, 'WAVECAR', 'wavefunctions')
+            self.write(d, 'stages/0/vasprun.xml', 'superseded')
+        self.write(self.dirs[1], 'INCAR', 'NSW = 3\nAUTO_KEEP_WAVECAR = True\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, directory, name, text):
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(text)
+
+    def test_compact(self):
+        vasprun_path = os.path.join(self.dirs[0], 'vasprun.xml')
+        energy = Vasprun(vasprun_path).final_energy
+        mtime = os.path.getmtime(vasprun_path)
+        results = compact.compact(self.dirs, workers=2)
+        self.assertEqual([r['directory'] for r in results], self.dirs)
+        self.assertEqual(len(results[0]['compressed']), 3)
+        self.assertEqual(results[0]['deleted'], [os.path.join(self.dirs[0], 'WAVECAR')])
+        self.assertEqual(results[1]['deleted'], [])
+        self.assertFalse(os.path.exists(vasprun_path))
+        self.assertEqual(os.path.getmtime(vasprun_path + '.gz'), mtime)
+        self.assertTrue(os.path.exists(os.path.join(self.dirs[0], 'stages', '0', 'vasprun.xml.gz')))
+
+        # readers find the compressed outputs
+        self.assertEqual(compact.output_path(self.dirs[0], 'vasprun.xml'), vasprun_path + '.gz')
+        self.assertEqual(Vasprun(compact.output_path(self.dirs[0], 'vasprun.xml')).final_energy, energy)
+        self.assertEqual(stages.stage_results(self.dirs[0])['energy'], energy)
+        self.assertEqual(resources.read_outcar_memory(os.path.join(self.dirs[0], 'OUTCAR'))['ranks'], 8)
+        with compact.open_output(os.path.join(self.dirs[0], 'stages', '0', 'vasprun.xml')) as f:
+            self.assertEqual(f.read(), 'superseded')
+        # a new run's outputs win over the compressed ones
+        self.write(self.dirs[0], 'vasprun.xml', 'new')
+        self.assertEqual(compact.output_path(self.dirs[0], 'vasprun.xml'), vasprun_path)
+
+    def test_converged_dirs(self):
+        self.write(self.tmp.name, compact.COMPLETED_FILE, 'PATHs:\n  %s: CsPbBr3\n' % self.dirs[0])
+        self.assertEqual(compact.converged_dirs(self.tmp.name), [self.dirs[0]])
+        self.assertEqual(compact.converged_dirs(self.dirs[0]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import unittest
+import io
+import os
+import gzip
+import tempfile
+from contextlib import redirect_stdout
+from vasp_run import eventlog
+
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_console_from_log(self):
+        log = eventlog.EventLog(self.dir)
+        out = io.StringIO()
+        with redirect_stdout(out):
+            log.emit('discover', job='CsPbBr3', path='/w/CsPbBr3')
+            log.emit('incar', 'Increased NELM to 500 max steps for electronic convergence.',
+                     job='CsPbBr3', tag='NELM', old=60, value=500)
+            with self.assertRaises(ValueError):
+                with log.timed('parse', job='CsPbBr3', path='/w/CsPbBr3'):
+                    raise ValueError('truncated vasprun.xml')
+        self.assertEqual(out.getvalue(), 'Increased NELM to 500 max steps for electronic convergence.\n')
+        records = eventlog.query(self.dir)
+        self.assertEqual([r['event'] for r in records], ['discover', 'incar', 'error'])
+        self.assertEqual(records[2]['during'], 'parse')
+        self.assertIn('duration', records[2])
+        self.assertEqual([eventlog.console_line(r) for r in records if eventlog.console_line(r)],
+                         out.getvalue().splitlines())
+
+    def test_rotation(self):
+        log = eventlog.EventLog(self.dir, max_bytes=200, keep=2)
+        for n in range(30):
+            log.emit('decision', job='job%d' % (n % 3), decision='in_queue', n=n)
+        paths = eventlog.log_paths(self.dir)
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ['workflow_events.2.jsonl.gz', 'workflow_events.1.jsonl.gz', eventlog.LOG_FILE])
+        with gzip.open(paths[0], 'rt') as f:
+            self.assertTrue(f.readline().startswith('{'))
+        # the oldest logs were dropped, the rest reads back in order
+        numbers = [r['n'] for r in eventlog.read_events(self.dir)]
+        self.assertEqual(numbers, list(range(numbers[0], 30)))
+        self.assertEqual(len(eventlog.query(self.dir, job='job1')), len([n for n in numbers if n % 3 == 1]))
+
+    def test_job_summary(self):
+        records = [
+            {'time': '2024-05-01T10:00:00.000', 'event': 'decision', 'job': 'a', 'path': '/w/a', 'decision': 'initial'},
+            {'time': '2024-05-01T10:00:01.000', 'event': 'submit', 'job': 'a', 'path': '/w/a', 'job_id': '1', 'duration': 1.5},
+            {'time': '2024-05-01T12:00:00.000', 'event': 'decision', 'job': 'a', 'path': '/w/a', 'decision': 'in_queue'},
+            {'time': '2024-05-01T13:00:01.000', 'event': 'decision', 'job': 'a', 'path': '/w/a', 'decision': 'single'},
+            {'time': '2024-05-01T13:00:01.500', 'event': 'incar', 'job': 'a', 'path': '/w/a', 'tag': 'NELM'},
+            {'time': '2024-05-01T13:00:02.000', 'event': 'submit', 'job': 'a', 'path': '/w/a', 'job_id': '2', 'duration': 0.5},
+            {'time': '2024-05-01T14:00:00.000', 'event': 'sweep', 'duration': 3.0},
+        ]
+        summary = eventlog.job_summary(records)['/w/a']
+        self.assertEqual((summary['submissions'], summary['resubmits'], summary['incar_changes']), (2, 1, 1))
+        self.assertEqual(summary['turnaround_h'], [3.0])
+        self.assertEqual(eventlog.durations(records), {'submit': (2, 2.0), 'sweep': (1, 3.0)})
+
+
+if __name__ == '__main__':
+    unittest.main()
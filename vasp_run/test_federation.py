@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import sys
+import json
+import tempfile
+from unittest import mock
+from jinja2 import Environment, FileSystemLoader
+from vasp_run import federation
+from vasp_run import schedulers
+from vasp_run import workflow_state
+from vasp_run.test_resources import TEMPLATE_DIR
+
+# stands in for a cluster's sbatch/squeue/sacct: --test-only reports a fixed
+# start time, a real submission "runs" instantly by writing a vasprun.xml, the
+# job has already left the queue when squeue is asked about it and sacct has
+# it completed. STUB_OUTAGE makes squeue and sacct fail like an ssh outage
+STUB_SBATCH = '''#!{python}
+import sys
+if '--test-only' in sys.argv:
+    sys.stdin.read()
+    sys.stderr.write('sbatch: Job 1 to start at {start} using 104 processors\\n')
+else:
+    open('vasprun.xml', 'w').write('<modeling>{name}</modeling>')
+    print('Submitted batch job 4242')
+'''
+STUB_SQUEUE = '''#!{python}
+import os, sys
+if os.environ.get('STUB_OUTAGE'):
+    sys.exit(255)
+'''
+STUB_SACCT = '''#!{python}
+import os, sys
+if os.environ.get('STUB_OUTAGE'):
+    sys.exit(255)
+print('4242|CsPbBr3|COMPLETED|60|1|8|2030|2030|2030|/remote')
+'''
+
+
+class TestFederation(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        starts = {'kestrel': '2030-01-01T12:00:00', 'alpine': '2030-01-01T10:00:00'}
+        speeds = {'kestrel': 1.0, 'alpine': 0.5}
+        profiles = {}
+        for name in starts:
+            bin_dir = os.path.join(root, name + '_bin')
+            os.makedirs(bin_dir)
+            commands = {}
+            for command, stub in [('sbatch', STUB_SBATCH), ('squeue', STUB_SQUEUE), ('sacct', STUB_SACCT)]:
+                path = os.path.join(bin_dir, command)
+                with open(path, 'w') as f:
+                    f.write(stub.format(python=sys.executable, start=starts[name],
+                                        name=name))
+                os.chmod(path, 0o755)
+                commands[command] = path
+            profiles[name] = {'remote_root': os.path.join(root, name + '_scratch'),
+                              'relative_speed': speeds[name],
+                              'commands': commands,
+                              'keywords': {'cores': 8}}
+        self.profiles_path = os.path.join(root, 'profiles.json')
+        with open(self.profiles_path, 'w') as f:
+            json.dump(profiles, f)
+        os.environ['VASP_CLUSTER_PROFILES'] = self.profiles_path
+
+        self.job_dir = os.path.join(root, 'workflow', 'CsPbBr3')
+        os.makedirs(os.path.join(self.job_dir, 'backup', '0'))
+        for f in ['INCAR', 'POSCAR', 'KPOINTS', 'POTCAR']:
+            with open(os.path.join(self.job_dir, f), 'w') as fd:
+                fd.write(f)
+
+    def tearDown(self):
+        del os.environ['VASP_CLUSTER_PROFILES']
+        self.tmp.cleanup()
+
+    def test_render_keywords(self):
+        cluster = federation.get_federated_clusters(['alpine'])[0]
+        keywords = cluster.render_keywords({'nodes': 2, 'cores': 104, 'queue': 'standard'})
+        self.assertEqual(keywords['computer'], 'alpine')
+        self.assertEqual(keywords['tasks'], 16)
+
+    def test_render_keywords_for_other_scheduler(self):
+        # vasp.py runs under PBS here, the federated cluster runs Slurm
+        cluster = federation.FederatedCluster('alpine', {
+            'cores_per_node': 64, 'memory_per_node_mb': 256000, 'shared_partition': 'shared',
+            'commands': {}})
+        keywords = cluster.render_keywords({
+            'queue_type': 'pbs', 'name': 'CsPbBr3', 'time': 4, 'nodes': 1, 'cores': 64,
+            'tasks': 8, 'mem': 0, 'mem_estimate': 3100, 'shared': True, 'account': 'x',
+            'queue': 'standard', 'openmp': 1})
+        self.assertEqual(keywords['queue_type'], 'slurm')
+        self.assertEqual((keywords['partition'], keywords['mem_per_cpu']), ('shared', 3100))
+        env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+        script = env.get_template('VASP.base.jinja2.sh').render(keywords)
+        self.assertIn('#SBATCH --mem-per-cpu=3100\n', script)
+        self.assertNotIn('#PBS', script)
+
+    def test_pbs_cluster_is_rejected(self):
+        with open(self.profiles_path) as f:
+            profiles = json.load(f)
+        profiles['alpine']['queue_type'] = 'pbs'
+        with open(self.profiles_path, 'w') as f:
+            json.dump(profiles, f)
+        # its script would go to sbatch otherwise
+        with self.assertRaises(Exception):
+            federation.get_federated_clusters(['kestrel', 'alpine'])
+        cluster = federation.FederatedCluster('alpine', profiles['alpine'])
+        self.assertIsInstance(cluster.scheduler, schedulers.PbsScheduler)
+        self.assertEqual(cluster.render_keywords({'nodes': 1, 'cores': 8})['queue_type'], 'pbs')
+
+    def test_submit_to_first_finish(self):
+        # alpine starts 2 h earlier but runs 4 h walltime at half speed, so kestrel wins
+        clusters = federation.get_federated_clusters(['kestrel', 'alpine'])
+        scripts = {'kestrel': '#!/bin/bash\n# kestrel', 'alpine': '#!/bin/bash\n# alpine'}
+        cluster, job_id = federation.submit_federated(
+            self.job_dir, scripts, 4, 'vasp_standard.sh', clusters)
+        self.assertEqual(cluster.name, 'kestrel')
+        self.assertEqual(job_id, '4242')
+
+        remote_dir = cluster.remote_dir(self.job_dir)
+        self.assertTrue(os.path.exists(os.path.join(remote_dir, 'POSCAR')))
+        self.assertFalse(os.path.exists(os.path.join(remote_dir, 'backup')))
+        with open(os.path.join(self.job_dir, 'vasp_standard.sh')) as f:
+            self.assertIn('kestrel', f.read())
+
+        submission = workflow_state.last_submission(self.job_dir)
+        self.assertEqual(submission['cluster'], 'kestrel')
+        self.assertFalse(submission['synced'])
+
+    def test_sync_back_after_job_leaves_queue(self):
+        clusters = federation.get_federated_clusters(['alpine'])
+        federation.submit_federated(self.job_dir, {'alpine': '#!/bin/bash'}, 1,
+                                    'vasp_standard.sh', clusters)
+        self.assertIsNone(federation.federated_status(self.job_dir))
+        with open(os.path.join(self.job_dir, 'vasprun.xml')) as f:
+            self.assertIn('alpine', f.read())
+        submission = workflow_state.last_submission(self.job_dir)
+        self.assertEqual(submission['final_state'], 'COMPLETED')
+        self.assertTrue(submission['synced'])
+
+    def test_unreachable_cluster_is_not_synced(self):
+        clusters = federation.get_federated_clusters(['alpine'])
+        federation.submit_federated(self.job_dir, {'alpine': '#!/bin/bash'}, 1,
+                                    'vasp_standard.sh', clusters)
+        with mock.patch.dict(os.environ, {'STUB_OUTAGE': '1'}):
+            self.assertEqual(federation.federated_status(self.job_dir), 'UNKNOWN')
+        self.assertFalse(os.path.exists(os.path.join(self.job_dir, 'vasprun.xml')))
+        self.assertFalse(workflow_state.last_submission(self.job_dir)['synced'])
+        # a failed sync is retried on the next sweep instead of stopping it
+        remote_dir = workflow_state.last_submission(self.job_dir)['remote_dir']
+        os.rename(remote_dir, remote_dir + '.moved')
+        self.assertEqual(federation.federated_status(self.job_dir), 'SYNC_FAILED')
+        self.assertFalse(workflow_state.last_submission(self.job_dir)['synced'])
+        os.rename(remote_dir + '.moved', remote_dir)
+        self.assertIsNone(federation.federated_status(self.job_dir))
+        self.assertTrue(os.path.exists(os.path.join(self.job_dir, 'vasprun.xml')))
+
+
+if __name__ == '__main__':
+    unittest.main()
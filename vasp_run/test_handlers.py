@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from custodian.custodian import Custodian, Job, NonRecoverableError
+from vasp_run import handlers
+from vasp_run import workflow_state
+
+# writes two SCF steps, then hangs on its first run and finishes on the next
+FAKE_VASP = '''
+import os, time
+with open('OUTCAR', 'a') as f:
+    f.write('LOOP:  cpu time    0.05: real time    0.05\\n' * 2)
+if not os.path.exists('hung_once'):
+    open('hung_once', 'w').close()
+    time.sleep(10)
+'''
+
+
+class FakeVaspJob(Job):
+    def setup(self, directory='./'):
+        pass
+
+    def run(self, directory='./'):
+        self.process = subprocess.Popen([sys.executable, '-c', FAKE_VASP], cwd=directory)
+        return self.process
+
+    def terminate(self, directory='./'):
+        self.process.kill()
+        self.process.wait()
+
+    def postprocess(self, directory='./'):
+        pass
+
+
+class TestHangHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outcar = os.path.join(self.tmp.name, 'OUTCAR')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_threshold_follows_scf_steps(self):
+        handler = handlers.HangHandler(factor=10, min_seconds=60, startup_seconds=600)
+        self.assertFalse(handler.check(self.tmp.name))
+        self.assertEqual(handler.threshold(), 600)
+        with open(self.outcar, 'w') as f:
+            f.write('LOOP:  cpu time   10.0: real time   12.0\n' * 3)
+        self.assertFalse(handler.check(self.tmp.name))
+        self.assertEqual(handler.threshold(), 120)
+        handler.last_change -= 100
+        self.assertFalse(handler.check(self.tmp.name))
+        handler.last_change -= 30
+        self.assertTrue(handler.check(self.tmp.name))
+        with open(self.outcar, 'a') as f:
+            f.write('LOOP:  cpu time    1.0: real time    1.0\n' * 10)
+        self.assertFalse(handler.check(self.tmp.name))
+        # the moving average only keeps the latest steps
+        self.assertEqual(handler.threshold(), 60)
+
+    def test_settings(self):
+        self.assertEqual(handlers.hang_settings({'AUTO_HANG_MINUTES': 5, 'AUTO_HANG_RESTARTS': 1}),
+                         {'min_seconds': 300, 'restarts': 1})
+
+    def custodian(self, handler):
+        # as the job templates build it
+        return Custodian([handler], [FakeVaspJob()], max_errors=1000, skip_over_errors=True,
+                         polling_time_step=0.1, monitor_freq=1, directory=self.tmp.name)
+
+    def events(self):
+        return workflow_state.read_job_state(self.tmp.name)['events']
+
+    def test_custodian_restarts_hung_run(self):
+        with open(os.path.join(self.tmp.name, 'CONTCAR'), 'w') as f:
+            f.write('relaxed')
+        handler = handlers.HangHandler(factor=1, min_seconds=0.5, startup_seconds=5)
+        self.custodian(handler).run()
+        with open(os.path.join(self.tmp.name, 'POSCAR')) as f:
+            self.assertEqual(f.read(), 'relaxed')
+        self.assertEqual([event['event'] for event in self.events()], ['hang_restart'])
+        self.assertEqual(workflow_state.recent_events(self.tmp.name), self.events())
+
+    def test_custodian_gives_up(self):
+        with open(os.path.join(self.tmp.name, 'CONTCAR'), 'w') as f:
+            f.write('relaxed')
+        handler = handlers.HangHandler(factor=1, min_seconds=0.5, startup_seconds=5, restarts=0)
+        start = time.time()
+        with self.assertRaises(NonRecoverableError):
+            self.custodian(handler).run()
+        # the hung run is killed, not left to sleep out its 10 s
+        self.assertLess(time.time() - start, 8)
+        self.assertEqual([(event['event'], event['reason']) for event in self.events()],
+                         [('hang_abandoned', 'restarts used up')])
+
+    def test_custodian_stops_without_contcar(self):
+        handler = handlers.HangHandler(factor=1, min_seconds=0.5, startup_seconds=0.5)
+        with self.assertRaises(NonRecoverableError):
+            self.custodian(handler).run()
+        self.assertEqual([(event['event'], event['reason']) for event in self.events()],
+                         [('hang_abandoned', 'no CONTCAR')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import struct
+import tempfile
+from pymatgen.io.vasp.inputs import Incar, Kpoints
+from vasp_run import handoff
+from vasp_run import workflow_state
+
+POSCAR = '''CsPbBr3
+1.0
+5.9 0.0 0.0
+0.0 5.9 0.0
+0.0 0.0 5.9
+Cs Pb Br
+1 1 3
+Direct
+0.5 0.5 0.5
+0.0 0.0 0.0
+0.5 0.0 0.0
+0.0 0.5 0.0
+0.0 0.0 0.5
+'''
+
+
+class TestHandoff(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        for name in ['POSCAR', 'CONTCAR']:
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(POSCAR)
+        with open(os.path.join(self.dir, 'CHGCAR'), 'w') as f:
+            f.write('charge')
+        self.write_wavecar(spins=2, encut=520)
+        self.incar = Incar({'STAGE_NUMBER': 0, 'ENCUT': 520, 'ISPIN': 2, 'NSW': 99})
+        self.kpoints = Kpoints.gamma_automatic((4, 4, 4))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_wavecar(self, spins, encut, record_length=64):
+        with open(os.path.join(self.dir, 'WAVECAR'), 'wb') as f:
+            f.write(struct.pack('3d', record_length, spins, 45200).ljust(record_length, b'\0'))
+            f.write(struct.pack('3d', 10, 48, encut).ljust(record_length, b'\0'))
+
+    def start(self, *changes):
+        settings = [{'dict': 'INCAR', 'action': {'_set': {'STAGE_NUMBER': 1, 'NSW': 0}}}] + list(changes)
+        actions = handoff.handoff_settings(self.dir, self.incar, self.kpoints, settings, 1)
+        return actions[0]['action']['_set'] if actions else None
+
+    def test_wavecar(self):
+        self.assertEqual(self.start(), handoff.FROM_WAVECAR)
+        event = workflow_state.recent_events(self.dir)[-1]
+        self.assertEqual((event['event'], event['stage'], event['source']), ('handoff', 1, 'WAVECAR'))
+
+    def test_falls_back(self):
+        # a new basis or k-mesh only leaves the charge density
+        self.assertEqual(self.start({'dict': 'INCAR', 'action': {'_set': {'ENCUT': 600}}}), handoff.FROM_CHGCAR)
+        self.assertEqual(self.start({'dict': 'KPOINTS', 'action': {'_set': {'kpoints': [[6, 6, 6]]}}}),
+                         handoff.FROM_CHGCAR)
+        self.assertIn('k-mesh', workflow_state.recent_events(self.dir)[-1]['incompatible']['WAVECAR'])
+        # switching to SOC needs a fresh start
+        self.assertEqual(self.start({'dict': 'INCAR', 'action': {'_set': {'LSORBIT': True}}}),
+                         handoff.FROM_SCRATCH)
+        # a WAVECAR that does not match its INCAR is not trusted
+        self.write_wavecar(spins=1, encut=520)
+        self.assertEqual(self.start(), handoff.FROM_CHGCAR)
+        self.incar['LCHARG'] = False
+        self.assertEqual(self.start(), handoff.FROM_SCRATCH)
+
+    def test_stage_settings_win(self):
+        self.assertIsNone(self.start({'dict': 'INCAR', 'action': {'_set': {'ICHARG': 11}}}))
+        self.assertIsNone(self.start({'dict': 'INCAR', 'action': {'_set': {'AUTO_HANDOFF': False}}}))
+
+    def test_incar_settings_win(self):
+        # a non-selfconsistent run keeps its fixed charge density
+        self.incar['ICHARG'] = 11
+        self.assertIsNone(self.start())
+        # start tags written in the INCAR are kept
+        self.incar['ICHARG'] = 1
+        self.assertIsNone(self.start())
+        # those left behind by the last handoff are replaced
+        del self.incar['ICHARG']
+        self.assertEqual(self.start(), handoff.FROM_WAVECAR)
+        self.incar.update(handoff.FROM_WAVECAR)
+        self.write_wavecar(spins=1, encut=520)
+        self.assertEqual(self.start(), handoff.FROM_CHGCAR)
+
+    def test_wavecar_header(self):
+        self.assertEqual(handoff.wavecar_header(os.path.join(self.dir, 'WAVECAR')), (2, 10, 520.0))
+        self.assertIsNone(handoff.wavecar_header(os.path.join(self.dir, 'CHGCAR')))
+
+
+if __name__ == '__main__':
+    unittest.main()
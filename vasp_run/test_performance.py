@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from unittest import mock
+from slurm_emulator import mock_vasp
+from vasp_run import compact
+from vasp_run import performance
+from vasp_run.test_stages import POSCAR
+
+OUTCAR = ''' running   16 mpi-ranks, with    4 threads/rank
+ distrk:  each k-point on    8 cores,    2 groups
+ distr:  one band on NCORE=   4 cores,    2 groups
+   k-points           NKPTS =      6   k-points in BZ     NKDIM =      6   number of bands    NBANDS=     96
+   total plane-waves  NPLWV =  110592
+      LOOP:  cpu time     20.1000: real time     20.5000
+      LOOP:  cpu time     10.0000: real time     10.2000
+     LOOP+:  cpu time     31.0000: real time     31.5000
+      LOOP:  cpu time     10.0000: real time     16.0000
+     LOOP+:  cpu time     17.0000: real time     17.5000
+                   Maximum memory used (kb):        2048000.
+                   Total CPU time used (sec):          40.000
+                             Elapsed time (sec):          60.000
+'''
+
+
+class TestPerformance(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dirs = [os.path.join(self.tmp.name, 'wf', 'CsPbBr3_%d' % n) for n in range(5)]
+        for (n, d) in enumerate(self.dirs):
+            os.makedirs(os.path.join(d, 'backup', '1'))
+            for (name, text) in [('POSCAR', POSCAR), ('INCAR', 'NSW = 3\nIBRION = 2\n')]:
+                with open(os.path.join(d, name), 'w') as f:
+                    f.write(text)
+            # the last job runs its SCF steps five times slower than its peers
+            with mock.patch.dict(os.environ, {'MOCK_VASP_SCF_TIME': '10.0' if n == 4 else '2.0'}):
+                mock_vasp.write_outputs(d, outcome='converged', ranks=4)
+            with open(os.path.join(d, 'backup', '1', 'OUTCAR'), 'w') as f:
+                f.write(OUTCAR)
+        compact.compress_file(os.path.join(self.dirs[0], 'OUTCAR'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_outcar(self):
+        record = performance.job_record(os.path.join(self.dirs[0], 'backup', '1'))
+        self.assertEqual(performance.layout_key(record), (16, 4, 2, 4))
+        self.assertEqual((record['nbands'], record['nplwv'], record['nkpts']), (96, 110592, 6))
+        self.assertEqual((record['scf_steps'], record['first_scf_seconds'], record['scf_seconds']),
+                         (3, 20.5, 13.1))
+        self.assertEqual(record['ionic_seconds'], [31.5, 17.5])
+        self.assertEqual(record['scf_per_ionic'], [2, 1])
+        self.assertEqual((record['max_memory_mb'], record['cpu_ratio']), (2000.0, 0.667))
+        self.assertEqual(record['scf_slowdown'], 1.569)
+        self.assertEqual(performance.flag_anomalies([record])[0]['flags'], ['low_cpu_ratio', 'scf_slowdown'])
+
+    def test_flag_slow_jobs(self):
+        directories = performance.job_dirs(os.path.join(self.tmp.name, 'wf'))
+        # backup folders are not jobs, compacted OUTCARs are read
+        self.assertEqual(directories, self.dirs)
+        records = performance.flag_anomalies(performance.profile_jobs(directories, workers=2))
+        self.assertEqual([r['directory'] for r in records], self.dirs)
+        self.assertEqual([r['flags'] for r in records], [[]] * 4 + [['slow_scf']])
+        self.assertEqual(records[4]['peer_ratio'], 5.0)
+        self.assertEqual(records[0]['ionic_steps'], len(records[0]['scf_per_ionic']))
+
+
+if __name__ == '__main__':
+    unittest.main()
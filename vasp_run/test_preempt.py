@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import time
+import signal
+import tempfile
+import subprocess
+from jinja2 import Environment, FileSystemLoader, ChoiceLoader, DictLoader
+from vasp_run import preempt
+from vasp_run import scratch
+from vasp_run import workflow_state
+from vasp_run.handlers import PreemptionHandler
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_DIR = os.path.join(REPO_DIR, 'jinja_templates')
+# stands in for Custodian: relaxes until VASP is asked to stop
+FAKE_RUN = '''{% extends "VASP.base.jinja2.sh" %}
+{% block python %}
+import os, time
+open('CONTCAR', 'w').write('relaxed')
+for i in range(300):
+    if os.path.exists('STOPCAR'):
+        break
+    time.sleep(0.1)
+open('WAVECAR', 'w').write('wavefunctions')
+{% endblock python %}
+'''
+KEYWORDS = {'queue_type': 'slurm', 'name': 'CsPbBr3', 'time': 4, 'tasks': 4, 'nodes': 1,
+            'cores': 4, 'mem': 0, 'account': 'x', 'computer': 'kestrel', 'openmp': 1,
+            'vasp_bashrc': '/dev/null', 'binding_sbatch': [], 'binding_env': []}
+
+
+class TestPreempt(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.job_dir = os.path.join(self.tmp.name, 'job')
+        os.makedirs(self.job_dir)
+        files = {'INCAR': 'STAGE_NUMBER = 2\n', 'POSCAR': 'initial', 'KPOINTS': '', 'POTCAR': ''}
+        for name, text in files.items():
+            with open(os.path.join(self.job_dir, name), 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.job_dir, name)) as f:
+            return f.read()
+
+    def test_checkpoint(self):
+        handler = PreemptionHandler()
+        self.assertFalse(handler.check(self.job_dir))
+        preempt.stop(self.job_dir, 'TERM')
+        self.assertEqual(self.read('STOPCAR'), 'LABORT = .TRUE.\n')
+        self.assertTrue(handler.check(self.job_dir))
+        self.assertIsNone(handler.correct(self.job_dir)['actions'])
+        with open(os.path.join(self.job_dir, 'CONTCAR'), 'w') as f:
+            f.write('relaxed')
+        record = preempt.checkpoint(self.job_dir)
+        self.assertEqual((record['signal'], record['stage']), ('TERM', 2))
+        self.assertEqual(self.read('POSCAR'), 'relaxed')
+        self.assertFalse(os.path.exists(os.path.join(self.job_dir, 'STOPCAR')))
+        self.assertEqual(preempt.resume_pending(self.job_dir), record)
+        preempt.start(self.job_dir)
+        self.assertIsNone(preempt.resume_pending(self.job_dir))
+        self.assertEqual(workflow_state.read_job_state(self.job_dir)['preemptions'], [record])
+
+    def test_settings(self):
+        profile = {'preemptible': {'partition': 'preempt'}}
+        self.assertFalse(preempt.preempt_settings(profile)['preemptible'])
+        self.assertEqual(preempt.preempt_settings(profile, {'AUTO_PREEMPTIBLE': True}),
+                         {'preemptible': True, 'preempt_partition': 'preempt',
+                          'preempt_signal': preempt.SIGNAL_SECONDS})
+
+    def test_job_script_checkpoints_on_signal(self):
+        keywords = dict(KEYWORDS)
+        keywords.update(scratch.scratch_settings({'scratch': {'exclude': ['WAVECAR']}},
+                                                 enabled=True))
+        keywords.update(preempt.preempt_settings({}, enabled=True))
+        loader = ChoiceLoader([DictLoader({'fake.sh': FAKE_RUN}), FileSystemLoader(TEMPLATE_DIR)])
+        text = Environment(loader=loader).get_template('fake.sh').render(keywords)
+        self.assertIn('#SBATCH --requeue\n#SBATCH --signal=B:USR1@120\n', text)
+        self.assertNotIn('USR2@', text)
+        script = os.path.join(self.job_dir, 'vasp_standard.sh')
+        with open(script, 'w') as f:
+            f.write(text)
+        run_dir = os.path.join(self.tmp.name, 'scratch', 'vasp_1234')
+        env = dict(os.environ, TMPDIR=os.path.join(self.tmp.name, 'scratch'), SLURM_JOB_ID='1234',
+                   PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''),
+                   PATH=os.path.join(self.tmp.name, 'bin') + os.pathsep + os.environ['PATH'])
+        # scontrol requeue is only recorded
+        os.makedirs(os.path.join(self.tmp.name, 'bin'))
+        scontrol = os.path.join(self.tmp.name, 'bin', 'scontrol')
+        with open(scontrol, 'w') as f:
+            f.write('#!/bin/bash\necho "$@" > ' + os.path.join(self.tmp.name, 'requeued') + '\n')
+        os.chmod(scontrol, 0o755)
+        job = subprocess.Popen(['bash', script], cwd=self.job_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.time() + 20
+            while not os.path.exists(os.path.join(run_dir, 'CONTCAR')):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.1)
+            job.send_signal(signal.SIGUSR1)
+            self.assertEqual(job.wait(20), 0)
+        finally:
+            if job.poll() is None:
+                job.kill()
+        self.assertEqual(self.read('POSCAR'), 'relaxed')
+        # a restart file, saved even though the copy-back lists leave it out
+        self.assertEqual(self.read('WAVECAR'), 'wavefunctions')
+        self.assertFalse(os.path.exists(os.path.join(self.job_dir, 'STOPCAR')))
+        self.assertFalse(os.path.exists(run_dir))
+        self.assertEqual(preempt.resume_pending(self.job_dir)['stage'], 2)
+        with open(os.path.join(self.tmp.name, 'requeued')) as f:
+            self.assertEqual(f.read(), 'requeue 1234\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
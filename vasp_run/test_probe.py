@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import time
+import tempfile
+from pymatgen.io.vasp.inputs import Incar
+from vasp_run import probe
+from vasp_run import schedulers
+
+BIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                   'slurm_emulator', 'bin')
+POSCAR = '''{formula}
+1.0
+5.9 0.0 0.0
+0.0 5.9 0.0
+0.0 0.0 5.9
+{species}
+1 1 3
+Direct
+0.5 0.5 0.5
+0.0 0.0 0.0
+0.5 0.0 0.0
+0.0 0.5 0.0
+0.0 0.0 0.5
+'''
+PROFILE = {'cores_per_node': 4, 'sockets': 1}
+ENVIRONMENT = {'VASP_SCHEDULER': 'local', 'VASP_LOCAL_WORKERS': '4',
+               'VASP_MPI': 'mpirun', 'VASP_KPTS': 'mock_vasp',
+               'MOCK_VASP_SCF_TIME': '1.0', 'MOCK_VASP_SERIAL_FRACTION': '0.05',
+               'MOCK_VASP_FIZZLE_FRACTION': '0'}
+
+
+class TestProbe(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = dict(os.environ)
+        os.environ.update(ENVIRONMENT)
+        os.environ['PATH'] = BIN + os.pathsep + os.environ['PATH']
+        os.environ['VASP_LOCAL_QUEUE_DIR'] = os.path.join(self.tmp.name, 'queue')
+        self.workflow = os.path.join(self.tmp.name, 'workflow')
+        os.makedirs(self.workflow)
+        with open(os.path.join(self.workflow, 'WORKFLOW_NAME'), 'w') as f:
+            f.write('NAME = perovskites')
+        self.scheduler = schedulers.get_scheduler()
+
+    def tearDown(self):
+        self.assertTrue(self.scheduler.shutdown(timeout=30))
+        os.environ.clear()
+        os.environ.update(self.saved)
+        self.tmp.cleanup()
+
+    def make_job(self, formula, species):
+        job_dir = os.path.join(self.workflow, formula)
+        os.makedirs(job_dir)
+        files = {'POSCAR': POSCAR.format(formula=formula, species=species),
+                 'INCAR': 'ENCUT = 400\nNSW = 99\nIBRION = 2\n', 'POTCAR': '',
+                 'KPOINTS': 'auto\n0\nGamma\n4 4 4\n'}
+        for file_name, text in files.items():
+            with open(os.path.join(job_dir, file_name), 'w') as f:
+                f.write(text)
+        return job_dir
+
+    def wait(self, job_dir, timeout=30):
+        end = time.time() + timeout
+        while probe.probes_running(job_dir, self.scheduler):
+            self.assertLess(time.time(), end, 'probes never finished')
+            time.sleep(0.1)
+
+    def test_fit_scaling(self):
+        points = [(c, 2.0 * (0.1 + 0.9 / c)) for c in [4, 8, 16]]
+        (serial, parallel) = probe.fit_scaling(points)
+        self.assertAlmostEqual(serial, 0.2)
+        self.assertAlmostEqual(parallel, 1.8)
+
+    def test_probe_mode(self):
+        job_dir = self.make_job('CsPbBr3', 'Cs Pb Br')
+        self.assertIsNone(probe.probe_layout(job_dir, PROFILE, 'local'))
+        probes = probe.read_probes(job_dir)['probes']
+        self.assertEqual(len(probes), 6)
+        incar = Incar.from_file(os.path.join(probes[0]['dir'], 'INCAR'))
+        self.assertEqual((incar['NELM'], incar['NSW']), (3, 0))
+        self.wait(job_dir)
+
+        layout = probe.probe_layout(job_dir, PROFILE, 'local')
+        # 5% serial: 2 nodes run at 85% of the 1 node efficiency, 4 nodes at 66%
+        self.assertEqual(layout['nodes'], 2)
+        entry = list(probe.read_json(os.path.join(self.workflow, probe.CACHE_FILE), {}).values())[0]
+        self.assertAlmostEqual(entry['fit']['serial'], 0.05, places=3)
+        self.assertAlmostEqual(entry['fit']['parallel'], 0.95, places=3)
+
+        # a structurally similar job reuses the layout without probing
+        similar = self.make_job('CsSnBr3', 'Cs Sn Br')
+        self.assertEqual(probe.probe_layout(similar, PROFILE, 'local'), layout)
+        self.assertIsNone(probe.read_probes(similar))
+
+    def test_serial_job_stays_small(self):
+        os.environ['MOCK_VASP_SERIAL_FRACTION'] = '0.4'
+        job_dir = self.make_job('CsPbBr3', 'Cs Pb Br')
+        probe.start_probes(job_dir, PROFILE, self.scheduler, 'local')
+        self.wait(job_dir)
+        entry = probe.collect_probes(job_dir)
+        self.assertEqual(entry['layout']['nodes'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from vasp_run import progress
+from vasp_run.handlers import ProgressHandler
+
+OSZICAR = '''       N       E                     dE             d eps       ncg     rms          rms(c)
+DAV:   1    -0.120E+03   -0.120E+03   -0.500E+03   300   0.5E+02
+DAV:   2    -0.125E+03   -0.500E+01   -0.500E+01   300   0.5E+01
+RMM:   3    -0.126E+03   -0.100E+01   -0.100E+00   300   0.5E+00    0.3E+00
+   1 F= -.12600000E+03 E0= -.12590000E+03  d E =-.126000E+03
+DAV:   1    -0.127E+03   -0.100E+01   -0.500E+01   300   0.5E+01
+'''
+FORCES = ''' POSITION                                       TOTAL-FORCE (eV/Angst)
+ -----------------------------------------------------------------------------------
+      0.00000      0.00000      0.00000         0.000000      0.300000     -0.400000
+      2.95000      2.95000      2.95000         0.100000      0.000000      0.000000
+ -----------------------------------------------------------------------------------
+'''
+OUTCAR = FORCES + '      LOOP+:  cpu time  100.00: real time  120.00\n'
+
+
+class TestProgress(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.write('INCAR', 'STAGE_NUMBER = 1\nNSW = 11\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text, mode='w'):
+        with open(os.path.join(self.dir, name), mode) as f:
+            f.write(text)
+
+    def test_reader_follows_outputs(self):
+        reader = progress.OutputReader(self.dir)
+        reader.update()
+        self.assertEqual(reader.ionic_step, 0)
+        # an unfinished line is read once it is complete
+        self.write('OSZICAR', OSZICAR[:-20])
+        self.write('OUTCAR', OUTCAR[:200])
+        reader.update()
+        self.assertEqual((reader.ionic_step, reader.current_scf_steps, reader.energy), (1, 3, -125.9))
+        self.assertIsNone(reader.max_force)
+        self.write('OSZICAR', OSZICAR[-20:], 'a')
+        self.write('OUTCAR', OUTCAR[200:], 'a')
+        reader.update()
+        self.assertEqual(reader.current_scf_steps, 1)
+        self.assertAlmostEqual(reader.max_force, 0.5)
+        self.assertEqual(reader.step_times, [120.0])
+        # a new run starts over
+        self.write('OSZICAR', OSZICAR.splitlines(True)[1])
+        reader.update()
+        self.assertEqual((reader.ionic_step, reader.current_scf_steps, reader.energy), (0, 1, None))
+
+    def test_progress_file(self):
+        self.write('OSZICAR', OSZICAR)
+        self.write('OUTCAR', OUTCAR)
+        handler = ProgressHandler(walltime=3600)
+        handler.started -= 600
+        self.assertFalse(handler.check(self.dir))
+        job_progress = progress.read_progress(self.dir)
+        self.assertEqual(job_progress['stage'], 1)
+        self.assertEqual(job_progress['ionic_step'], 1)
+        self.assertEqual(job_progress['elapsed_seconds'], 600)
+        # 10 ionic steps left at 120 s each
+        self.assertEqual(job_progress['remaining_seconds'], 1200)
+        self.assertEqual(progress.summary(job_progress),
+                         'stage 1, ionic step 1/11, 1 SCF, E0 -125.9000 eV, '
+                         'max force 0.500 eV/A, ~0.3 h left')
+        self.assertEqual(list(progress.job_dirs(self.dir)), [self.dir])
+        # the estimate never goes past the walltime
+        handler.started -= 2500
+        handler.check(self.dir)
+        self.assertAlmostEqual(progress.read_progress(self.dir)['remaining_seconds'], 500, delta=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from jinja2 import Environment, FileSystemLoader
+from vasp_run import resources
+from slurm_emulator import mock_vasp
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'jinja_templates')
+PROFILE = {'cores_per_node': 104, 'memory_per_node_mb': 246000,
+           'shared_partition': 'shared'}
+POSCAR = '''CsPbBr3
+1.0
+{a} 0.0 0.0
+0.0 {a} 0.0
+0.0 0.0 {a}
+Cs Pb Br
+{n} {n} {n3}
+Direct
+'''
+POTCAR = '''  PAW_PBE {species} 01Jan2000
+   POMASS =  100.000; ZVAL   =   {zval}    mass and valenz
+   ENMAX  =  {enmax}; ENMIN  =  150.000 eV
+'''
+
+
+class TestResources(unittest.TestCase):
+    def test_memory_to_mb(self):
+        self.assertEqual(resources.memory_to_mb(4000), 4000)
+        self.assertEqual(resources.memory_to_mb('64G'), 65536)
+        self.assertEqual(resources.memory_to_mb('1.5gb'), 1536)
+        with self.assertRaises(Exception):
+            resources.memory_to_mb('lots')
+
+    def test_shared_task_count(self):
+        # 5 atoms -> 20 tasks, rounded up to whole KPAR * NPAR groups
+        self.assertEqual(resources.shared_task_count(5, {}, 104), 20)
+        self.assertEqual(resources.shared_task_count(5, {'KPAR': 3}, 104), 21)
+        self.assertEqual(resources.shared_task_count(1, {'NCORE': 8}, 104), 8)
+        self.assertIsNone(resources.shared_task_count(40, {}, 104))
+
+    def test_shared_mem_per_cpu(self):
+        self.assertEqual(resources.shared_mem_per_cpu(PROFILE, 20), 2365)
+        self.assertEqual(resources.shared_mem_per_cpu(PROFILE, 20, '10G'), 512)
+        self.assertEqual(resources.shared_mem_per_cpu(PROFILE, 20, 0, 900), 900)
+
+    def make_job(self, cells=1, incar='ENCUT = 400\n'):
+        # CsPbBr3 perovskite, repeated cells times along each axis
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        job_dir = self.tmp.name
+        sites = {'Cs': [(0.5, 0.5, 0.5)], 'Pb': [(0, 0, 0)],
+                 'Br': [(0.5, 0, 0), (0, 0.5, 0), (0, 0, 0.5)]}
+        lines = []
+        for species in ['Cs', 'Pb', 'Br']:
+            for (x, y, z) in sites[species]:
+                for i in range(cells):
+                    for j in range(cells):
+                        for k in range(cells):
+                            lines.append('%.6f %.6f %.6f\n' % ((x + i) / cells,
+                                                               (y + j) / cells,
+                                                               (z + k) / cells))
+        n = cells ** 3
+        with open(os.path.join(job_dir, 'POSCAR'), 'w') as f:
+            f.write(POSCAR.format(a=5.9 * cells, n=n, n3=3 * n) + ''.join(lines))
+        with open(os.path.join(job_dir, 'POTCAR'), 'w') as f:
+            for (species, zval, enmax) in [('Cs_sv', 9, 220.3), ('Pb_d', 14, 237.8),
+                                           ('Br', 7, 216.3)]:
+                f.write(POTCAR.format(species=species, zval=zval, enmax=enmax))
+        with open(os.path.join(job_dir, 'KPOINTS'), 'w') as f:
+            f.write('auto\n0\nGamma\n4 4 4\n')
+        with open(os.path.join(job_dir, 'INCAR'), 'w') as f:
+            f.write(incar)
+        return job_dir
+
+    def test_job_size(self):
+        job_dir = self.make_job(incar='ISPIN = 2\n')
+        self.assertEqual(resources.read_potcar(os.path.join(job_dir, 'POTCAR'))[1],
+                         (237.8, 14.0))
+        size = resources.job_size(job_dir)
+        self.assertEqual(size['natoms'], 5)
+        self.assertEqual(size['nelect'], 44)
+        self.assertEqual(size['encut'], 237.8)
+        # 4x4x4 Gamma mesh in a cubic cell -> 10 irreducible k-points
+        self.assertEqual(size['nkpts'], 10)
+        self.assertEqual(size['nbands'], 26)
+        soc = resources.job_size(self.make_job(incar='LSORBIT = True\n'))
+        self.assertEqual(soc['nbands'], 52)
+        self.assertTrue(soc['noncollinear'])
+
+    def test_rank_memory_scaling(self):
+        size = resources.job_size(self.make_job(cells=3))
+        one = resources.estimate_rank_memory(size, 1)
+        many = resources.estimate_rank_memory(size, 104)
+        self.assertGreater(one, many)
+        self.assertGreater(many, resources.RANK_OVERHEAD_MB)
+        # k-point groups replicate the plane-wave coefficients they share
+        self.assertGreater(resources.estimate_rank_memory(size, 104, kpar=4), many)
+
+    def test_calibration_from_outcar(self):
+        job_dir = self.make_job()
+        uncalibrated = resources.MemoryEstimate(job_dir).per_rank(4)
+        mock_vasp.write_outputs(job_dir, 'converged', ranks=4)
+        recorded = resources.read_outcar_memory(os.path.join(job_dir, 'OUTCAR'))
+        self.assertEqual(recorded['ranks'], 4)
+        self.assertAlmostEqual(recorded['max_memory_mb'], 200000 / 1024.0)
+        calibrated = resources.MemoryEstimate(job_dir)
+        self.assertNotEqual(calibrated.per_rank(4), uncalibrated)
+        self.assertAlmostEqual(calibrated.per_rank(4),
+                               recorded['max_memory_mb'] * resources.MEMORY_MARGIN, delta=1)
+
+    def test_minimum_nodes(self):
+        memory = resources.MemoryEstimate(self.make_job(cells=4, incar='ENCUT = 520\n'))
+        small_nodes = {'memory_per_node_mb': memory.per_node(1, 36) // 2}
+        nodes = memory.minimum_nodes(small_nodes, 36)
+        self.assertGreater(nodes, 1)
+        self.assertLessEqual(memory.per_node(nodes, 36), small_nodes['memory_per_node_mb'])
+        self.assertEqual(resources.MemoryEstimate(self.make_job()).minimum_nodes(PROFILE, 104), 1)
+        # the per rank overhead alone does not fit
+        self.assertIsNone(memory.minimum_nodes({'memory_per_node_mb': 1000}, 36))
+
+    def test_shared_header(self):
+        env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+        keywords = {'queue_type': 'slurm', 'name': 'CsPbBr3', 'time': 4,
+                    'tasks': 20, 'nodes': 1, 'cores': 104, 'mem': 0,
+                    'account': 'x', 'computer': 'kestrel', 'queue': 'standard',
+                    'shared': True, 'partition': 'shared', 'mem_per_cpu': 2365,
+                    'openmp': 1}
+        script = env.get_template('VASP.base.jinja2.sh').render(keywords)
+        self.assertIn('#SBATCH --ntasks 20\n', script)
+        self.assertIn('#SBATCH --mem-per-cpu=2365\n', script)
+        self.assertIn('#SBATCH --partition=shared\n', script)
+        self.assertNotIn('--nodes', script)
+        keywords['shared'] = False
+        script = env.get_template('VASP.base.jinja2.sh').render(keywords)
+        self.assertIn('#SBATCH --nodes 1\n', script)
+        self.assertNotIn('--partition', script)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import time
+import json
+import tempfile
+import subprocess
+from unittest import mock
+from vasp_run import schedulers
+
+QSTAT_F = '''Job Id: 101.server
+    Job_Name = CsPbBr3
+    job_state = R
+    Resource_List.nodect = 2
+    Variable_List = PBS_O_HOME=/home/me,PBS_O_WORKDIR=/home/me/wf/CsPbBr3,
+\tPBS_O_SHELL=/bin/bash
+Job Id: 102.server
+    Job_Name = CsSnBr3
+    job_state = C
+    init_work_dir = /home/me/wf/CsSnBr3
+'''
+
+
+def fake_runner(stdout):
+    def runner(command, cwd=None, input=None):
+        return subprocess.CompletedProcess(command, 0, stdout=stdout, stderr='')
+    return runner
+
+
+class TestSchedulers(unittest.TestCase):
+    def test_pbs_status(self):
+        pbs = schedulers.PbsScheduler(runner=fake_runner(QSTAT_F))
+        self.assertEqual(pbs.status(), {'/home/me/wf/CsPbBr3': 'RUNNING'})
+
+    def test_slurm_accounting(self):
+        sacct = '7|CsPbBr3|CANCELLED by 99|3600|2|208|2024|2024|2024|/wf/CsPbBr3\n'
+        slurm = schedulers.SlurmScheduler(runner=fake_runner(sacct))
+        record = slurm.accounting(['7'])[0]
+        self.assertEqual(record['state'], 'CANCELLED')
+        self.assertEqual(record['elapsed'], 3600)
+        self.assertEqual(record['nodes'], 2)
+
+    def test_get_scheduler(self):
+        os.environ['VASP_SCHEDULER'] = 'pbs'
+        try:
+            self.assertIsInstance(schedulers.get_scheduler('slurm'), schedulers.PbsScheduler)
+        finally:
+            del os.environ['VASP_SCHEDULER']
+        self.assertIsInstance(schedulers.get_scheduler(), schedulers.SlurmScheduler)
+
+    def test_computer_queue_type(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'profiles.json')
+            with open(path, 'w') as f:
+                json.dump({'kestrel': {'queue_type': 'slurm'}, 'summit': {'queue_type': 'pbs'}}, f)
+            with mock.patch.dict(os.environ, {'VASP_CLUSTER_PROFILES': path}):
+                os.environ.pop('VASP_SCHEDULER', None)
+                self.assertEqual(schedulers.computer_queue_type('summit'), 'pbs')
+                self.assertEqual(schedulers.computer_queue_type('eagle'), 'slurm')
+                self.assertEqual(schedulers.computer_queue_type('stampede'), 'pbs')
+                os.environ['VASP_SCHEDULER'] = 'local'
+                self.assertEqual(schedulers.computer_queue_type('kestrel'), 'local')
+
+
+class TestLocalScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.local = schedulers.LocalScheduler(os.path.join(self.tmp.name, 'queue'),
+                                               max_workers=1)
+
+    def tearDown(self):
+        # the wrapper of a finished job still dispatches the queue
+        self.assertTrue(self.local.shutdown(timeout=20))
+        self.tmp.cleanup()
+
+    def write_job(self, name, body):
+        job_dir = os.path.join(self.tmp.name, name)
+        os.makedirs(job_dir)
+        with open(os.path.join(job_dir, 'vasp_standard.sh'), 'w') as f:
+            f.write('#!/bin/bash\n' + body + '\n')
+        return job_dir
+
+    def wait(self, job_id, timeout=20):
+        end = time.time() + timeout
+        while self.local.job_status(job_id) is not None:
+            if time.time() > end:
+                self.fail('local job ' + job_id + ' did not finish')
+            time.sleep(0.1)
+
+    def test_pool_is_bounded_and_drains(self):
+        first = self.write_job('first', 'sleep 0.5; touch done')
+        second = self.write_job('second', 'touch done; exit 3')
+        first_id = self.local.submit('vasp_standard.sh', cwd=first)
+        second_id = self.local.submit('vasp_standard.sh', cwd=second)
+        self.assertEqual(self.local.status(), {first: 'RUNNING', second: 'PENDING'})
+
+        # the first job starts the second when it finishes
+        self.wait(second_id)
+        self.assertTrue(os.path.exists(os.path.join(second, 'done')))
+        states = {r['job_id']: r['state'] for r in self.local.accounting([first_id, second_id])}
+        self.assertEqual(states, {first_id: 'COMPLETED', second_id: 'FAILED'})
+        self.assertEqual(self.local.status(), {})
+
+    def test_cancel(self):
+        job_dir = self.write_job('slow', 'sleep 30')
+        job_id = self.local.submit('vasp_standard.sh', cwd=job_dir)
+        self.local.cancel(job_id)
+        self.assertIsNone(self.local.job_status(job_id))
+        self.assertEqual(self.local.accounting([job_id])[0]['state'], 'CANCELLED')
+
+    def test_shutdown(self):
+        job_ids = [self.local.submit('vasp_standard.sh', cwd=self.write_job(name, 'sleep 30'))
+                   for name in ['running', 'pending']]
+        self.assertTrue(self.local.shutdown(timeout=20))
+        self.assertEqual([r['state'] for r in self.local.accounting(job_ids)], ['CANCELLED'] * 2)
+        # the pending job was never started
+        self.assertNotIn('pid', self.local.read_queue()['jobs'][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
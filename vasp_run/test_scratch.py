@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import unittest
+import io
+import os
+import time
+import signal
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+from jinja2 import Environment, FileSystemLoader, ChoiceLoader, DictLoader
+from vasp_run import scratch
+from vasp_run import workflow_state
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_DIR = os.path.join(REPO_DIR, 'jinja_templates')
+# stands in for Custodian: writes outputs and runs until STOP shows up
+FAKE_RUN = '''{% extends "VASP.base.jinja2.sh" %}
+{% block python %}
+import os, time
+open('OUTCAR', 'w').write('step 1')
+open('WAVECAR', 'w').write('wavefunctions')
+for i in range(300):
+    if os.path.exists('STOP'):
+        break
+    time.sleep(0.1)
+open('OUTCAR', 'w').write('step 2')
+{% endblock python %}
+'''
+
+
+class TestScratch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.job_dir = os.path.join(self.tmp.name, 'job')
+        self.scratch_dir = os.path.join(self.tmp.name, 'scratch', 'vasp_1234')
+        os.makedirs(os.path.join(self.job_dir, '01'))
+        os.makedirs(os.path.join(self.job_dir, 'backup', '0'))
+        for name in ['INCAR', 'POSCAR', 'KPOINTS', 'POTCAR', 'WAVECAR', 'OUTCAR',
+                     os.path.join('01', 'POSCAR'), os.path.join('backup', '0', 'INCAR')]:
+            with open(os.path.join(self.job_dir, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_stage(self):
+        staged = scratch.stage(self.job_dir, self.scratch_dir)
+        self.assertEqual(staged, [os.path.join('01', 'POSCAR'), 'INCAR', 'KPOINTS', 'POSCAR',
+                                  'POTCAR', 'WAVECAR'])
+        self.assertFalse(os.path.exists(os.path.join(self.scratch_dir, 'OUTCAR')))
+        self.assertFalse(os.path.exists(os.path.join(self.scratch_dir, 'backup')))
+        state = workflow_state.read_job_state(self.job_dir)
+        self.assertTrue(state['scratch'].endswith(':' + self.scratch_dir))
+
+    def test_copy_back(self):
+        scratch.stage(self.job_dir, self.scratch_dir)
+        for name in ['OUTCAR', 'CONTCAR', 'WAVECAR', os.path.join('01', 'OUTCAR')]:
+            with open(os.path.join(self.scratch_dir, name), 'w') as f:
+                f.write('new ' + name)
+        copied = scratch.copy_back(self.scratch_dir, self.job_dir, exclude=['WAVECAR', '01/*'])
+        self.assertEqual(copied, ['CONTCAR', 'OUTCAR'])
+        with open(os.path.join(self.job_dir, 'WAVECAR')) as f:
+            self.assertEqual(f.read(), 'WAVECAR')
+        # unchanged files are not copied again
+        self.assertEqual(scratch.copy_back(self.scratch_dir, self.job_dir,
+                                           exclude=['WAVECAR', '01/*']), [])
+        copied = scratch.copy_back(self.scratch_dir, self.job_dir, include=['OUTCAR'], exclude=[])
+        self.assertEqual(copied, [os.path.join('01', 'OUTCAR')])
+
+    def test_settings(self):
+        profile = {'scratch': {'root': '$TMPDIR', 'exclude': ['WAVECAR']}}
+        self.assertFalse(scratch.scratch_settings(profile)['scratch'])
+        settings = scratch.scratch_settings(profile, {'AUTO_SCRATCH': True,
+                                                      'AUTO_SCRATCH_EXCLUDE': 'WAVECAR CHGCAR'})
+        self.assertEqual(settings, {'scratch': True, 'scratch_root': '$TMPDIR',
+                                    'scratch_include': '', 'scratch_exclude': 'WAVECAR CHGCAR',
+                                    'scratch_signal': 300})
+        self.assertEqual(scratch.scratch_settings({}, enabled=True)['scratch_root'],
+                         scratch.SCRATCH_ROOT)
+        # only the first node of a multi-node job would have the inputs
+        with redirect_stdout(io.StringIO()):
+            self.assertFalse(scratch.scratch_settings(profile, {'AUTO_SCRATCH': True}, nodes=2)['scratch'])
+
+    def test_job_script_copies_back_on_signal(self):
+        keywords = {'queue_type': 'slurm', 'name': 'CsPbBr3', 'time': 4, 'tasks': 4,
+                    'nodes': 1, 'cores': 4, 'mem': 0, 'account': 'x', 'computer': 'kestrel',
+                    'openmp': 1, 'vasp_bashrc': '/dev/null', 'binding_sbatch': [],
+                    'binding_env': []}
+        keywords.update(scratch.scratch_settings({'scratch': {'exclude': ['WAVECAR']}},
+                                                 enabled=True))
+        loader = ChoiceLoader([DictLoader({'fake.sh': FAKE_RUN}), FileSystemLoader(TEMPLATE_DIR)])
+        text = Environment(loader=loader).get_template('fake.sh').render(keywords)
+        self.assertIn('#SBATCH --signal=B:USR2@300\n', text)
+        script = os.path.join(self.job_dir, 'vasp_standard.sh')
+        with open(script, 'w') as f:
+            f.write(text)
+        env = dict(os.environ, TMPDIR=os.path.join(self.tmp.name, 'scratch'), SLURM_JOB_ID='1234',
+                   PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+        job = subprocess.Popen(['bash', script], cwd=self.job_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        outcar = os.path.join(self.job_dir, 'OUTCAR')
+        try:
+            deadline = time.time() + 20
+            while not os.path.exists(os.path.join(self.scratch_dir, 'OUTCAR')):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.1)
+            job.send_signal(signal.SIGUSR2)
+            while open(outcar).read() != 'step 1':
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.1)
+            self.assertIsNone(job.poll())
+            open(os.path.join(self.scratch_dir, 'STOP'), 'w').close()
+            self.assertEqual(job.wait(20), 0)
+        finally:
+            if job.poll() is None:
+                job.kill()
+        with open(outcar) as f:
+            self.assertEqual(f.read(), 'step 2')
+        with open(os.path.join(self.job_dir, 'WAVECAR')) as f:
+            self.assertEqual(f.read(), 'WAVECAR')
+        self.assertFalse(os.path.exists(self.scratch_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
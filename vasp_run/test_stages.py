@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from unittest import mock
+import numpy as np
+from slurm_emulator import mock_vasp
+from vasp_run import stages
+from vasp_run import workflow_state
+
+POSCAR = '''CsPbBr3
+1.0
+5.9 0.0 0.0
+0.0 5.9 0.0
+0.0 0.0 5.9
+Cs Pb Br
+1 1 3
+Direct
+0.5 0.5 0.5
+0.0 0.0 0.0
+0.5 0.0 0.0
+0.0 0.5 0.0
+0.0 0.0 0.5
+'''
+
+
+class TestStages(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.write('POSCAR', POSCAR)
+        self.write('KPOINTS', 'auto\n0\nGamma\n4 4 4\n')
+        os.makedirs(os.path.join(self.dir, 'backup', '0'))
+        os.makedirs(os.path.join(self.dir, 'backup', '1'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.dir, name), 'w') as f:
+            f.write(text)
+
+    def run_stage(self, incar):
+        self.write('INCAR', incar)
+        mock_vasp.write_outputs(self.dir, outcome='converged')
+        with open(os.path.join(self.dir, 'OSZICAR'), 'a') as f:
+            f.write('   2 F= -.2E+02 E0= -.2E+02  d E =-.1E-01  mag=     0.5000\n')
+
+    def test_records(self):
+        self.run_stage('STAGE_NUMBER = 0\nNSW = 3\nIBRION = 2\nENCUT = 400\n')
+        first = stages.record_stage(self.dir, 0)
+        self.run_stage('STAGE_NUMBER = 1\nNSW = 3\nIBRION = 2\nENCUT = 520\nEDIFF = 1e-6\n')
+        second = stages.record_stage(self.dir, 1)
+
+        self.assertEqual(stages.read_stages(self.dir), [first, second])
+        self.assertEqual(first['incar_changes']['ENCUT'], [None, 400])
+        self.assertEqual(second['incar_changes'], {'EDIFF': [None, 1e-6], 'ENCUT': [400, 520],
+                                                   'STAGE_NUMBER': [0, 1]})
+        self.assertAlmostEqual(second['max_force'], 0.01 * 2 ** 0.5)
+        self.assertEqual(len(second['forces']), 5)
+        self.assertEqual(second['stress'][0], [1.0, 0.0, 0.0])
+        self.assertAlmostEqual(second['lattice']['volume'], 5.9 ** 3)
+        self.assertEqual(second['magnetization'], 0.5)
+        self.assertIsNotNone(second['elapsed_seconds'])
+        self.assertEqual(second['backup'], os.path.join('backup', '1'))
+        self.assertIn(os.path.join('stages', '1', 'vasprun.xml'), second['archive'])
+        for path in second['archive']:
+            self.assertTrue(os.path.exists(os.path.join(self.dir, path)))
+
+    def test_unreadable_vasprun(self):
+        self.run_stage('STAGE_NUMBER = 0\nNSW = 3\nIBRION = 2\n')
+        self.write('vasprun.xml', '<modeling>')
+        record = stages.record_stage(self.dir, 0)
+        self.assertIn('error', record)
+        self.assertNotIn('energy', record)
+
+    def test_skip_stages(self):
+        self.write('CONVERGENCE', '\n0 Step\nNSW = 3\n\n1 Step\nSKIP_MAX_FORCE = 0.05\nNSW = 0\n'
+                                  '\n2 Step\nSKIP_MAX_DE = 0.001\nSKIP_MAX_STRAIN = 0.01\n\nKPOINTS 6 6 6\n')
+        self.assertEqual(stages.read_skip_criteria(os.path.join(self.dir, 'CONVERGENCE')),
+                         {1: {'SKIP_MAX_FORCE': 0.05},
+                          2: {'SKIP_MAX_DE': 0.001, 'SKIP_MAX_STRAIN': 0.01}})
+        self.assertFalse(stages.skip_stage(self.dir, 1))
+        self.run_stage('STAGE_NUMBER = 0\nNSW = 3\nIBRION = 2\n')
+        record = stages.record_stage(self.dir, 0)
+        self.assertAlmostEqual(record['max_strain'], 0.0)
+        self.assertTrue(stages.skip_stage(self.dir, 1))
+        # the energy change needs two finished stages
+        self.assertFalse(stages.skip_stage(self.dir, 2))
+        self.assertEqual(stages.skipped_stages(self.dir), [1])
+        # a later submission (STAGE_NUMBER reset) did not skip anything yet
+        workflow_state.record_submission(self.dir, '7', scheduler='slurm')
+        self.assertEqual(stages.skipped_stages(self.dir), [])
+        with mock.patch.dict(os.environ, {'SLURM_JOB_ID': '7'}):
+            self.assertTrue(stages.skip_stage(self.dir, 1))
+        self.assertEqual(stages.skipped_stages(self.dir), [1])
+        self.assertEqual(stages.read_stages(self.dir)[-1]['measured'],
+                         {'SKIP_MAX_FORCE': record['max_force']})
+        stages.finish_skipped(self.dir, 2)
+        with open(os.path.join(self.dir, 'INCAR')) as f:
+            self.assertIn('STAGE_NUMBER = 2', f.read())
+
+    def test_skip_measurements(self):
+        records = [{'stage': 0, 'energy': -10.0, 'energy_per_atom': -2.0, 'max_force': 0.2, 'max_strain': 0.02},
+                   {'stage': 1, 'skipped': True},
+                   {'stage': 2, 'energy': -10.001, 'energy_per_atom': -2.0002, 'max_force': 0.01,
+                    'max_strain': 0.001}]
+        self.assertEqual(stages.skip_measurements({'SKIP_MAX_STRAIN': 0.005}, records),
+                         {'SKIP_MAX_STRAIN': 0.001})
+        self.assertAlmostEqual(stages.skip_measurements({'SKIP_MAX_DE': 0.001}, records)['SKIP_MAX_DE'],
+                               0.0002)
+        self.assertIsNone(stages.skip_measurements({'SKIP_MAX_DE': 0.001, 'SKIP_MAX_FORCE': 0.001}, records))
+        self.assertIsNone(stages.skip_measurements({}, records))
+        self.assertAlmostEqual(stages.max_strain(np.identity(3), np.identity(3) * 1.01), 0.01005)
+
+
+if __name__ == '__main__':
+    unittest.main()
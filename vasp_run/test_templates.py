@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from jinja2 import TemplateError
+from vasp_run import templates
+
+BASE = '#!/bin/bash\n#SBATCH -J {{ name }}\n{% block run %}{% endblock run %}\n'
+CHILD = '{% extends "base.sh" %}{% block run %}srun vasp_std > {{ name }}.log{% endblock run %}\n'
+
+
+class TestTemplates(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = os.path.join(self.tmp.name, 'templates')
+        os.makedirs(self.dir)
+        self.write('base.sh', BASE)
+        self.write('child.sh', CHILD)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.dir, name), 'w') as f:
+            f.write(text)
+
+    def test_render_many(self):
+        service = templates.TemplateService(self.dir)
+        service.check(['child.sh'])
+        scripts = service.render_many('child.sh', [{'name': 'a'}, {'name': 'b'}])
+        self.assertEqual(scripts[1], '#!/bin/bash\n#SBATCH -J b\nsrun vasp_std > b.log')
+        # compiled once per service
+        self.assertIs(service.get('child.sh'), service.get('child.sh'))
+
+    def test_check_finds_broken_parent(self):
+        self.write('base.sh', BASE + '{% if %}\n')
+        service = templates.TemplateService(self.dir)
+        with self.assertRaises(TemplateError) as raised:
+            service.check(['child.sh'])
+        self.assertIn('base.sh', str(raised.exception))
+        with self.assertRaises(TemplateError):
+            service.check(['missing.sh'])
+
+    def test_bytecode_cache(self):
+        cache = os.path.join(self.tmp.name, 'cache')
+        templates.TemplateService(self.dir, cache).render('child.sh', {'name': 'a'})
+        self.assertEqual(len(os.listdir(cache)), 2)
+        self.assertEqual(templates.TemplateService(self.dir, cache).render('child.sh', {'name': 'a'}),
+                         templates.TemplateService(self.dir).render('child.sh', {'name': 'a'}))
+
+    def test_repo_templates(self):
+        service = templates.get_service(templates.REPO_TEMPLATE_DIR)
+        self.assertIs(service, templates.get_service(templates.REPO_TEMPLATE_DIR))
+        service.check(['VASP.multistep_include_ncl.jinja2.py'])
+
+
+if __name__ == '__main__':
+    unittest.main()
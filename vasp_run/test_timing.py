@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import time
+import tempfile
+from vasp_run import timing
+
+
+class TestTiming(unittest.TestCase):
+    def test_phases_and_counters(self):
+        timer = timing.PhaseTimer()
+        for n in range(3):
+            with timer.phase('walk'):
+                time.sleep(0.01)
+                timer.count('dirs_walked')
+        timer.count('bytes_parsed', 2048)
+        with self.assertRaises(KeyError):
+            with timer.phase('incar'):
+                raise KeyError('SYSTEM')
+        self.assertGreaterEqual(timer.phases['walk'], 0.03)
+        self.assertIn('incar', timer.phases)
+        self.assertEqual(timer.counts, {'dirs_walked': 3, 'bytes_parsed': 2048})
+        table = timer.table().splitlines()
+        self.assertEqual([line.split()[0] for line in table],
+                         ['phase', 'walk', 'incar', 'other', 'total', 'bytes_parsed', 'dirs_walked'])
+        self.assertTrue(timer.summary().endswith('2048 bytes_parsed, 3 dirs_walked'))
+        timer.reset()
+        self.assertEqual((timer.phases, timer.counts), ({}, {}))
+
+    def test_prometheus_textfile(self):
+        timer = timing.PhaseTimer()
+        timer.lap('scheduler')
+        timer.count('scheduler_queries', 4)
+        text = timer.prometheus('vasp_sweep', {'workflow': 'perov "A"'}, {'jobs': 12})
+        samples = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+        self.assertEqual(samples['vasp_sweep_operations{counter="scheduler_queries",workflow="perov \\"A\\""}'],
+                         '4.0')
+        self.assertEqual(samples['vasp_sweep_jobs{workflow="perov \\"A\\""}'], '12.0')
+        self.assertIn('# TYPE vasp_sweep_phase_seconds gauge', text)
+        with tempfile.TemporaryDirectory() as directory:
+            path = timing.write_textfile(directory, 'vasp_sweep_perov A', text)
+            self.assertEqual(os.listdir(directory), ['vasp_sweep_perov_A.prom'])
+            with open(path) as f:
+                self.assertEqual(f.read(), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
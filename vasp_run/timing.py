@@ -0,0 +1,145 @@
+"""
+Wall time of the phases of a vasp.py submission (setup, backup, restart,
+settings, render, submit), printed after submitting and kept with the
+submission in job_state.json, and of the phases of a rerun_workflow.py sweep
+(walk, scheduler, incar, vasprun, submit) with counters of the work done
+(files stat'ed, bytes parsed, subprocesses started). A sweep prints its table
+at the end and, with VASP_METRICS_DIR set to the textfile collector directory
+of node_exporter, writes it there in the Prometheus text format.
+
+Both scripts take --profile [file] to write a cProfile of the whole run,
+readable with python -m pstats or snakeviz.
+"""
+
+import os
+import re
+import atexit
+import cProfile
+from contextlib import contextmanager
+from time import perf_counter, time
+
+
+class PhaseTimer(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counts = {}
+        self.start = perf_counter()
+        self.last = self.start
+
+    def lap(self, phase):
+        """
+        Charges the time since the previous lap to phase
+        """
+        now = perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    @contextmanager
+    def phase(self, phase):
+        """
+        Charges the time spent in the block to phase
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + perf_counter() - start
+
+    def count(self, counter, n=1):
+        self.counts[counter] = self.counts.get(counter, 0) + n
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def elapsed(self):
+        return perf_counter() - self.start
+
+    def summary(self):
+        return ', '.join('%s %.2f s' % item for item in self.phases.items()) + \
+            ' (total %.2f s)' % self.total() + \
+            ''.join(', %d %s' % (n, counter) for (counter, n) in sorted(self.counts.items()))
+
+    def table(self):
+        """
+        Returns: the time of each phase, the rest of the time since the timer
+                 started and the counters, one per line
+        """
+        elapsed = self.elapsed()
+        rows = sorted(self.phases.items(), key=lambda item: -item[1])
+        rows.append(('other', max(elapsed - self.total(), 0.0)))
+        lines = ['%-20s %10s %7s' % ('phase', 'seconds', 'share')]
+        for (phase, seconds) in rows + [('total', elapsed)]:
+            lines.append('%-20s %10.3f %6.1f%%' % (phase, seconds, 100 * seconds / elapsed if elapsed else 0))
+        for (counter, n) in sorted(self.counts.items()):
+            lines.append('%-20s %10d' % (counter, n))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {phase: round(seconds, 4) for (phase, seconds) in self.phases.items()}
+
+    def prometheus(self, prefix, labels=None, gauges=None):
+        """
+        Args:
+            prefix: metric name prefix, e.g. vasp_sweep
+            labels: labels of every sample, e.g. {'workflow': name}
+            gauges: further values to export, {name: value}
+        Returns: the phases, counters and gauges in the Prometheus text format
+        """
+        labels = labels or {}
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s_%s gauge' % (prefix, name))
+            for (extra, value) in samples:
+                lines.append('%s_%s%s %s' % (prefix, name, label_text(dict(labels, **extra)), repr(float(value))))
+
+        metric('duration_seconds', 'Wall time of the last run', [({}, self.elapsed())])
+        metric('last_run_timestamp_seconds', 'Unix time the last run finished', [({}, time())])
+        metric('phase_seconds', 'Wall time of each phase of the last run',
+               [({'phase': phase}, seconds) for (phase, seconds) in sorted(self.phases.items())])
+        metric('operations', 'Work done in the last run',
+               [({'counter': counter}, n) for (counter, n) in sorted(self.counts.items())])
+        for (name, value) in sorted((gauges or {}).items()):
+            metric(name, name.replace('_', ' '), [({}, value)])
+        return '\n'.join(lines) + '\n'
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (key, escape(value)) for (key, value) in sorted(labels.items())) + '}'
+
+
+def write_textfile(directory, name, text):
+    """
+    Writes name.prom to the node_exporter textfile directory, renamed into
+    place so the collector never reads a partial file
+    Returns: path of the file written
+    """
+    path = os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.prom')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return path
+
+
+def start_profile(path):
+    """
+    Profiles the rest of the process, the stats are written to path when it exits
+    """
+    profiler = cProfile.Profile()
+
+    def dump():
+        profiler.disable()
+        profiler.dump_stats(path)
+        print('Profile written to ' + path + ' (python -m pstats ' + path + ')')
+
+    atexit.register(dump)
+    profiler.enable()
+    return profiler
@@ -6,7 +6,6 @@
 
 import sys
 import os
-from jinja2 import Environment, FileSystemLoader
 from pymatgen.io.vasp.outputs import *
 from Classes_Pymatgen import *
 from Helpers import *
@@ -17,27 +16,43 @@ import socket
 import random
 import argparse
 import subprocess
+from vasp_run import autotune
+from vasp_run import backup_store
+from vasp_run import binding
+from vasp_run import cluster_profiles
+from vasp_run import compact
+from vasp_run import federation
+from vasp_run import handlers
+from vasp_run import preempt
+from vasp_run import probe
+from vasp_run import resources
+from vasp_run import schedulers
+from vasp_run import scratch
+from vasp_run import templates
+from vasp_run import timing
+from vasp_run import workflow_state
 
 
 def get_instructions_for_backup(jobtype, incar='INCAR'):
     """
     Args:
         jobtype:
-        incar:
-    Returns: Dict containing lists to backup, move, and execute in a shell
+        incar: path of the INCAR, or the Incar itself
+    Returns: Dict containing lists to remove, backup, move, and execute in a shell
     """
     instructions = {}
-    instructions["commands"] = ['rm *.sh *.err STOPCAR ' +
-                                '*.e[0-9][0-9][0-9]* *.o[0-9][0-9][0-9]* ' +
-                                '&> /dev/null']
+    instructions['remove'] = ['*.sh', '*.err', 'STOPCAR',
+                              '*.e[0-9][0-9][0-9]*', '*.o[0-9][0-9][0-9]*']
+    instructions["commands"] = []
     instructions['backup'] = []
     instructions['move'] = []
     if jobtype == 'Standard':
         instructions['backup'] = ['OUTCAR', 'POSCAR', 'INCAR', 'KPOINTS']
         instructions['move'] = [('CONTCAR', 'POSCAR')]
     elif jobtype == 'NEB':
-        if os.path.isfile(incar):
+        if isinstance(incar, str) and os.path.isfile(incar):
             incar = Incar.from_file(incar)
+        if isinstance(incar, dict):
             instructions['commands'].extend(
                 ['nebmovie.pl', 'nebbarrier.pl', 'nebef.pl > nebef.dat'])
             instructions['backup'] = [
@@ -84,58 +99,59 @@ def get_instructions_for_backup(jobtype, incar='INCAR'):
     return instructions
 
 
-def backup_vasp(dir, backup_dir='backup'):
+def remove_files(dir, patterns):
+    # one listing of the directory for all the patterns, no shell
+    for name in os.listdir(dir):
+        if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            try:
+                os.remove(os.path.join(dir, name))
+            except OSError:
+                pass
+
+
+def backup_vasp(dir, backup_dir='backup', instructions=None):
     """
-    Do backup of given directory
+    Do backup of given directory, as a manifest in backup_dir/N (see
+    backup_store.py)
     Args:
         dir: VASP directory to backup
         backup_dir: directory files will be backed up to
+        instructions: from get_instructions_for_backup, worked out here if None
     Returns: None
     """
-    jobtype = getJobType(dir)
+    if instructions is None:
+        instructions = get_instructions_for_backup(
+            getJobType(dir), os.path.join(dir, 'INCAR'))
 
-    if os.path.isdir(backup_dir):  # Find what directory to backup to
-        last_run = -1
-        backups = os.listdir(backup_dir)
-        for backup in backups:
-            try:
-                if int(backup) > last_run:
-                    last_run = int(backup)
-            except BaseException:
-                pass
-        this_run = last_run + 1
-    else:
-        this_run = 0
-    backup_dir = os.path.join(backup_dir, str(this_run))
+    backup_dir = backup_store.next_backup(backup_dir)
 
-    instructions = get_instructions_for_backup(
-        jobtype, os.path.join(dir, 'INCAR'))
+    remove_files(dir, instructions['remove'])
     for command in instructions["commands"]:
         try:
             os.system(command)
         except BaseException:
             print('Could not execute command:  ' + command)
-    for original_file in instructions["backup"]:
-        try:
-            backup_file = os.path.join(backup_dir, original_file)
-            if not os.path.exists(os.path.dirname(backup_file)):
-                os.makedirs(os.path.dirname(backup_file))
-            shutil.copy(original_file, backup_file)
-        except BaseException:
-            print('Could not backup file at:  ' + original_file)
+    # backup/N only gets a manifest, the files go to the workflow's object store
+    try:
+        backup_store.backup(dir, instructions["backup"], backup_dir)
+    except OSError as e:
+        print('Could not backup files:  ' + str(e))
 
     return
 
 
-def restart_vasp(dir):
+def restart_vasp(dir, jobtype=None, instructions=None):
     """
     Args:
         dir:
+        jobtype: getJobType(dir) if None
+        instructions: from get_instructions_for_backup, worked out here if None
     Returns:
     """
-    jobtype = getJobType(dir)
-    instructions = get_instructions_for_backup(
-        jobtype, os.path.join(dir, 'INCAR'))
+    jobtype = jobtype or getJobType(dir)
+    if instructions is None:
+        instructions = get_instructions_for_backup(
+            jobtype, os.path.join(dir, 'INCAR'))
     for (old_file, new_file) in instructions["move"]:
         try:
             if os.path.getsize(old_file) > 0:
@@ -201,11 +217,32 @@ def get_queue(computer, jobtype, time, nodes):
         raise Exception('Unrecognized Computer')
 
 
+def get_run_kind(args):
+    """
+    Returns: (special run the template is picked for, None for a plain run,
+              keywords that run adds to the template)
+    """
+    if args.multi_step is not None:
+        return ('multi', {'CONVERGENCE': args.multi_step})
+    elif args.encut:
+        return ('encut', {'target': args.encut})
+    elif args.kpoints:
+        return ('kpoints', {'target': args.kpoints})
+    elif args.ts:
+        return ('hse_ts', {'target': args.ts})
+    elif args.diffusion:
+        return ('diffusion', {})
+    elif args.pc:
+        return ('pc', {})
+    elif args.find_max:
+        return ('find_max', {'target': args.find_max})
+    return (None, {})
+
+
 def get_template(computer, jobtype, special=None):
     if special == 'multi':
         #return (os.environ["VASP_TEMPLATE_DIR"], 'VASP.multistep.jinja2.py')
-        template_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'jinja_templates')
-        return (template_path, 'VASP.multistep_include_ncl.jinja2.py')
+        return (templates.REPO_TEMPLATE_DIR, 'VASP.multistep_include_ncl.jinja2.py')
     if special == 'encut':
         return (os.environ["VASP_TEMPLATE_DIR"], 'VASP.encut.sh.jinja2')
     if special == 'kpoints':
@@ -304,13 +341,59 @@ parser.add_argument('--pc', help='Do plane constrained run',
                     action='store_true')
 parser.add_argument('--frozen', help='Monitors jobs which constantlyfreeze',
                     action='store_true')
+parser.add_argument(
+    '--federate',
+    help='Submit to whichever cluster in VASP_FEDERATION is expected to ' +
+         'finish the job first',
+    action='store_true')
+parser.add_argument(
+    '--shared',
+    help='Request only the tasks and memory the job needs on a shared node ' +
+         '(also AUTO_SHARED in INCAR), needs shared_partition in the ' +
+         'cluster profile',
+    action='store_true')
+parser.add_argument(
+    '--autotune',
+    help='Write the fastest KPAR/NCORE/NSIM and MPI x OpenMP layout for ' +
+         'this cluster into the INCAR before submitting',
+    action='store_true')
+parser.add_argument(
+    '--probe',
+    help='Submit short scaling probes at several layouts first and run with ' +
+         'the best measured one, shared with similar jobs of the workflow',
+    action='store_true')
+parser.add_argument('--cpu-bind', help='srun --cpu-bind (cores, sockets, none...)')
+parser.add_argument('--distribution',
+                    help='srun --distribution (block:block, cyclic...)')
+parser.add_argument('--hint', help='sbatch --hint (nomultithread...)')
+parser.add_argument(
+    '--scratch',
+    help='Run in node-local scratch and copy results back at the end of ' +
+         'each stage and on the walltime signal (also AUTO_SCRATCH in INCAR)',
+    action='store_true')
+parser.add_argument(
+    '--preemptible',
+    help='Checkpoint and requeue on the walltime signal or preemption, on ' +
+         'the preemptible partition of the cluster profile if it has one ' +
+         '(also AUTO_PREEMPTIBLE in INCAR)',
+    action='store_true')
+parser.add_argument(
+    '--profile', nargs='?', const='vasp_profile.prof', default=None,
+    metavar='FILE',
+    help='Write a cProfile of this run to FILE (default vasp_profile.prof)')
 
 args = parser.parse_args()
 
 if __name__ == '__main__':
+    if args.profile is not None:
+        timing.start_profile(os.path.abspath(args.profile))
+    timer = timing.PhaseTimer()
+    # the INCAR is parsed once here and only read again after a step rewrites it
+    incar = Incar.from_file('INCAR')
+    timer.count('incar_reads')
     if args.finish_convergence is not None:
         run = Vasprun(
-            'vasprun.xml',
+            compact.output_path('.', 'vasprun.xml'),
             parse_dos=False,
             parse_eigen=False,
             parse_potcar_file=False, 
@@ -318,47 +401,64 @@ if __name__ == '__main__':
         if run.converged:
             exit('Run is already converged')
         elif args.finish_convergence != []:
-            stage = Incar.from_file('INCAR')['STAGE_NUMBER']
+            stage = incar['STAGE_NUMBER']
             if stage not in args.finish_convergence:
                 exit('Not correct stage')
     jobtype = getJobType('.')
-    incar = Incar.from_file('INCAR')
+    instructions = get_instructions_for_backup(jobtype, incar)
     computer = getComputerName()
     print('Running vasp.py for ' + jobtype + ' on ' + computer)
+    # What kind of run.  load correct template, and stop on a broken one
+    # before the job is touched
+    (special, additional_keywords) = get_run_kind(args)
+    if not args.backup:
+        (template_dir, template) = get_template(
+            computer, jobtype + '-Halting' if args.frozen else jobtype, special)
+        template_service = templates.get_service(template_dir)
+        template_service.check([template])
+    profile = cluster_profiles.get_cluster_profile(computer)
+    layout = None
+    if args.probe:
+        layout = probe.probe_layout('.', profile,
+                                    schedulers.computer_queue_type(computer))
+        if layout is None:
+            exit(0)
+    elif args.nodes == 0 and os.path.exists(probe.find_cache('.')):
+        layout = probe.cached_layout('.', incar)
+    timer.lap('setup')
     print('Backing up previous run')
-    backup_vasp('.')
+    backup_vasp('.', instructions=instructions)
+    timer.lap('backup')
     if args.backup:
         exit(0)
     if not args.inplace:
         print('Setting up next run')
-        restart_vasp('.')
+        restart_vasp('.', jobtype, instructions)
+        timer.lap('restart')
     print('Determining settings for run')
 
-    # What kind of run.  load correct template
-    additional_keywords = {}
-    special = None
-    if args.multi_step is not None:
-        additional_keywords['CONVERGENCE'] = args.multi_step
-        if args.init:
-            subprocess.call(['Upgrade_Run.py', '-i', args.multi_step])
-            incar = Incar.from_file('INCAR')
-        special = 'multi'
-    elif args.encut:
-        additional_keywords['target'] = args.encut
-        special = 'encut'
-    elif args.kpoints:
-        additional_keywords['target'] = args.kpoints
-        special = 'kpoints'
-    elif args.ts:
-        additional_keywords['target'] = args.ts
-        special = 'hse_ts'
-    elif args.diffusion:
-        special = 'diffusion'
-    elif args.pc:
-        special = 'pc'
-    elif args.find_max:
-        special = 'find_max'
-        additional_keywords['target'] = args.find_max
+    if special == 'multi' and args.init:
+        subprocess.call(['Upgrade_Run.py', '-i', args.multi_step])
+        timer.count('subprocesses')
+        incar = Incar.from_file('INCAR')
+        timer.count('incar_reads')
+
+    if layout is not None:
+        print('Using probed layout ' + str(layout))
+        autotune.write_layout(layout, 'INCAR')
+        incar = Incar.from_file('INCAR')
+        timer.count('incar_reads')
+    elif args.autotune:
+        if 'cores_per_node' in profile:
+            layouts = autotune.tune_job('.', profile, args.nodes or None)
+            if layouts:
+                incar = Incar.from_file('INCAR')
+                timer.count('incar_reads')
+            else:
+                print('No layout fits in the memory of ' + computer)
+        else:
+            print('No cores_per_node in cluster profile for ' + computer +
+                  ', not autotuning')
 
     # Set Time
     if args.time == 0:
@@ -383,8 +483,25 @@ if __name__ == '__main__':
     else:
         time = args.time
 
+    # Shared node, only on clusters whose profile names a shared partition
+    shared = (args.shared or ('AUTO_SHARED' in incar and incar['AUTO_SHARED'])) \
+        and args.nodes == 0 and 'AUTO_NODES' not in incar
+    if shared and 'shared_partition' not in profile:
+        print('No shared partition in cluster profile for ' + computer +
+              ', requesting whole nodes')
+        shared = False
+    if shared:
+        natoms = len(Poscar.from_file('POSCAR').structure)
+        tasks = resources.shared_task_count(natoms, incar,
+                                            profile['cores_per_node'])
+        if tasks is None:
+            print('Job needs a whole node, not running on a shared node')
+            shared = False
+
     # Find number of Nodes
-    if args.nodes == 0:
+    if shared:
+        nodes = 1
+    elif args.nodes == 0:
         if 'AUTO_NODES' in incar:
             nodes = incar['AUTO_NODES']
         elif 'NPAR' in incar:
@@ -444,6 +561,41 @@ if __name__ == '__main__':
     else:
         cores = int(os.environ["VASP_NCORE"])
 
+    # Estimate memory (calibrated by the last OUTCAR) before the job queues
+    memory = None
+    mem_estimate = 0
+    if 'memory_per_node_mb' in profile and jobtype == 'Standard':
+        try:
+            memory = resources.MemoryEstimate('.', incar)
+        except BaseException:
+            print('Could not estimate memory for this job')
+    if shared:
+        if memory is not None:
+            mem_estimate = memory.per_rank(tasks)
+        mem_per_cpu = resources.shared_mem_per_cpu(profile, tasks, mem,
+                                                   mem_estimate)
+        if mem_per_cpu * tasks > profile['memory_per_node_mb']:
+            print('WARNING: ' + str(tasks) + ' tasks at ' + str(mem_per_cpu) +
+                  ' MB do not fit in one node of ' + computer)
+    else:
+        if memory is not None:
+            min_nodes = memory.minimum_nodes(profile, cores, nodes)
+            if min_nodes is None:
+                print('WARNING: ' + str(cores) + ' ranks per node at ' +
+                      str(memory.per_rank(nodes * cores)) + ' MB each do ' +
+                      'not fit in ' + str(profile['memory_per_node_mb']) +
+                      ' MB nodes, use fewer cores per node (-c) or a larger NCORE')
+            elif min_nodes > nodes and (args.nodes or 'AUTO_NODES' in incar):
+                print('WARNING: estimated memory needs ' + str(min_nodes) +
+                      ' nodes, running on ' + str(nodes) + ' as requested')
+            elif min_nodes > nodes:
+                print('Raising nodes from ' + str(nodes) + ' to ' +
+                      str(min_nodes) + ' to fit the estimated memory')
+                nodes = min_nodes
+            mem_estimate = memory.per_rank(nodes * cores)
+        tasks = int(nodes * cores)
+        mem_per_cpu = 0
+
     # Set Allocation
     if 'AUTO_ALLOCATION' in incar:
         account = incar['AUTO_ALLOCATION']
@@ -452,23 +604,31 @@ if __name__ == '__main__':
     else:
         account = ''
 
-    if 'VASP_OMP_NUM_THREADS' in os.environ:
+    if 'AUTO_OMP' in incar:
+        openmp = int(incar['AUTO_OMP'])
+    elif 'VASP_OMP_NUM_THREADS' in os.environ:
         openmp = int(os.environ['VASP_OMP_NUM_THREADS'])
     else:
         openmp = 1
 
-    if computer == 'kestrel':
-        queue_type = 'slurm'
-        submit = 'sbatch '
-    elif computer == 'janus' or computer == 'rapunzel' or computer == 'eagle':
-        queue_type = 'slurm'
-        submit = 'sbatch '
-    elif computer == 'summit':
-        queue_type = 'slurm'
-        submit = 'sbatch --export=NONE '
-    else:
-        queue_type = 'pbs'
-        submit = 'qsub '
+    # CPU binding: vasp.py options, then AUTO_ tags, then the cluster profile
+    job_binding = binding.binding_settings(
+        {}, incar, {'cpu_bind': args.cpu_bind,
+                    'distribution': args.distribution,
+                    'hint': args.hint})
+    placement = binding.binding_settings(profile, overrides=job_binding,
+                                         threads=openmp)
+
+    # Node-local scratch, opt-in
+    scratch_keywords = scratch.scratch_settings(profile, incar, args.scratch, nodes)
+    preempt_keywords = preempt.preempt_settings(profile, incar, args.preemptible)
+
+    submit_options = []
+    queue_type = schedulers.computer_queue_type(computer)
+    if computer == 'summit' and queue_type == 'slurm':
+        submit_options = ['--export=NONE']
+    scheduler = schedulers.get_scheduler(queue_type,
+                                         submit_options=submit_options)
 
     if args.queue:
         queue = args.queue
@@ -482,7 +642,6 @@ if __name__ == '__main__':
     if args.frozen:
         jobtype = jobtype + '-Halting'
 
-    (template_dir, template) = get_template(computer, jobtype, special)
     script = 'vasp_standard.sh'
 
     keywords = {
@@ -506,25 +665,55 @@ if __name__ == '__main__':
                         if 'VASP_BASHRC' in os.environ
                         else '~/.bashrc_vasp'),
         'jobtype': jobtype,
-        'tasks': int(
-            nodes * cores),
-        'openmp': openmp}
+        'tasks': tasks,
+        'shared': shared,
+        'partition': profile.get('shared_partition', ''),
+        'mem_per_cpu': mem_per_cpu,
+        'mem_estimate': mem_estimate,
+        'openmp': openmp,
+        'job_binding': job_binding,
+        'binding_sbatch': binding.sbatch_options(placement),
+        'binding_env': binding.environment(placement, os.environ["VASP_MPI"],
+                                           openmp),
+        'mpi_options': binding.launcher_options(placement,
+                                                os.environ["VASP_MPI"],
+                                                openmp)}
+    keywords['hang'] = handlers.hang_settings(incar)
+    keywords.update(scratch_keywords)
+    keywords.update(preempt_keywords)
     keywords.update(additional_keywords)
 
-    env = Environment(loader=FileSystemLoader(template_dir))
-    template = env.get_template(template)
-    with open(script, 'w+') as f:
-        f.write(template.render(keywords))
-
-    # adds the account variable to the submission script 
-    account_line = '#SBATCH --account=%s' % account
-    with open(script, 'r') as f:
-        data = f.readlines()
-
-#    data[9] = str(account_line)+'\n'
+    timer.lap('settings')
+    if args.federate:
+        clusters = federation.get_federated_clusters()
+        scripts = dict(zip([cluster.name for cluster in clusters],
+                           template_service.render_many(template, [
+                               cluster.render_keywords(keywords)
+                               for cluster in clusters])))
+        (cluster, job_id) = federation.submit_federated(
+            '.', scripts, time, script, clusters)
+        print('Submitted ' + name + ' to ' + cluster.name + ' as job ' + job_id)
+        exit(0)
+    # the template renders the account line itself, the script is written once
     with open(script, 'w') as f:
-        f.writelines(data)
-
-    os.system(submit + script)
-    # subprocess.call([submit, script])
-    print('Submitted ' + name + ' to ' + queue)
+        f.write(template_service.render(template, keywords))
+    timer.lap('render')
+
+    job_id = scheduler.submit(script)
+    timer.count('subprocesses')
+    timer.lap('submit')
+    workflow_state.record_submission('.', job_id, scheduler=queue_type,
+                                     queue=queue, nodes=nodes, cores=cores,
+                                     tasks=tasks, shared=shared, openmp=openmp,
+                                     binding=placement,
+                                     mpi_options=keywords['mpi_options'],
+                                     mem_estimate=mem_estimate,
+                                     scratch=keywords['scratch'],
+                                     preemptible=keywords['preemptible'],
+                                     time=time, name=name,
+                                     stage=incar.get('STAGE_NUMBER'),
+                                     timings=timer.as_dict())
+    # the new submission picks up from any preemption checkpoint
+    workflow_state.update_job_state('.', resume=None)
+    print('Submitted ' + name + ' to ' + queue + ' as job ' + job_id)
+    print('Timings: ' + timer.summary())
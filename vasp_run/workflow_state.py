@@ -0,0 +1,89 @@
+"""
+Small per-job state file (job_state.json) kept in every VASP directory.
+vasp.py records each submission here and rerun_workflow.py reads it back
+"""
+
+import os
+import json
+import datetime
+
+STATE_FILE = 'job_state.json'
+
+
+def now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def read_job_state(path='.'):
+    """
+    Args:
+        path: VASP job directory
+    Returns: state dict, with an empty submission list if no state was recorded yet
+    """
+    state_path = os.path.join(path, STATE_FILE)
+    if not os.path.isdir(path):
+        # archived jobs keep their state in the workflow archive
+        from vasp_run import archive
+        if archive.is_archived(path) and STATE_FILE in archive.lookup(path)['files']:
+            state = json.loads(archive.read_member(path, STATE_FILE))
+            state.setdefault('submissions', [])
+            return state
+    if os.path.exists(state_path):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            print('Unreadable ' + state_path + ', starting a new one')
+            state = {}
+    else:
+        state = {}
+    state.setdefault('submissions', [])
+    return state
+
+
+def write_job_state(state, path='.'):
+    # write to a temporary file and rename so readers never see a partial file
+    state_path = os.path.join(path, STATE_FILE)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, state_path)
+
+
+def update_job_state(path='.', **fields):
+    state = read_job_state(path)
+    state.update(fields)
+    write_job_state(state, path)
+    return state
+
+
+def record_submission(path='.', job_id=None, **details):
+    """
+    Args:
+        path: VASP job directory
+        job_id: scheduler job id, None if it could not be determined
+        details: anything else worth keeping (cluster, queue, nodes, ...)
+    Returns: the submission record that was appended
+    """
+    state = read_job_state(path)
+    submission = {'job_id': job_id, 'submitted': now()}
+    submission.update(details)
+    state['submissions'].append(submission)
+    write_job_state(state, path)
+    return submission
+
+
+def last_submission(path='.'):
+    submissions = read_job_state(path)['submissions']
+    if len(submissions) == 0:
+        return None
+    return submissions[-1]
+
+
+def recent_events(path='.'):
+    """
+    Returns: events (see handlers.py) recorded since the last submission
+    """
+    state = read_job_state(path)
+    since = state['submissions'][-1]['submitted'] if state['submissions'] else ''
+    return [event for event in state.get('events', []) if event['time'] >= since]
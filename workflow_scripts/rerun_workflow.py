@@ -1,17 +1,38 @@
 #!/usr/bin/env python
 
 import os
-import subprocess
+import argparse
 import json
 import yaml
-from vasp_run import vasp
+from time import perf_counter
+import vasp_run
+from vasp_run import archive
+from vasp_run import backup_store
+from vasp_run import compact
+from vasp_run import eventlog
+from vasp_run import federation
+from vasp_run import preempt
+from vasp_run import probe
+from vasp_run import progress
+from vasp_run import schedulers
+from vasp_run import stages
+from vasp_run import timing
+from vasp_run import workflow_state
 from pymatgen.io.vasp.inputs import Incar
 from pymatgen.io.vasp.inputs import Poscar
 from pymatgen.io.vasp.outputs import Vasprun
 
+# every decision of a sweep is logged to workflow_events.jsonl (see eventlog.py),
+# the console lines are the messages of the logged events
+log = eventlog.EventLog()
+# time spent walking the tree, asking the scheduler, reading INCARs, parsing
+# vasprun.xml and submitting, with counters of the work done (see timing.py)
+timer = timing.PhaseTimer()
+
 def check_path_exists(path):
     # check if path exists, return True or False. Honestly not a necessary function, but I like to have it for clarity.
     # called in check_vasp_input, among others
+    timer.count('files_stat')
     if os.path.exists(path):
         return True
     else:
@@ -28,18 +49,38 @@ def check_vasp_input(path):
     else:
         return False
 
+def walk(pwd):
+    # os.walk, with the time spent listing directories charged to the walk phase
+    walker = os.walk(pwd)
+    while True:
+        with timer.phase('walk'):
+            entry = next(walker, None)
+        if entry is None:
+            return
+        timer.count('dirs_walked')
+        yield entry
+
 def check_num_jobs_in_workflow(pwd):
     # called in driver
     num_jobs = 0
-    for root, dirs, files in os.walk(pwd):
+    for root, dirs, files in walk(pwd):
+        # scaling probes and the backup object store are not jobs
+        dirs[:] = [d for d in dirs if d not in [probe.PROBE_DIR, backup_store.STORE_DIR, archive.ARCHIVE_DIR]]
         for file in files:
             if file == 'POTCAR' and check_vasp_input(root) == True:
                 num_jobs +=1
-    return num_jobs
+    # archived jobs are converged jobs of the workflow
+    return num_jobs + len(archive.archived_jobs(pwd))
+
+def read_incar(path):
+    # called in get_incar_value and replace_incar_tags
+    with timer.phase('incar'):
+        timer.count('incar_reads')
+        return Incar.from_file(os.path.join(path, 'INCAR'))
 
 def get_incar_value(path, tag):
     # called in get_job_name
-    incar = Incar.from_file(os.path.join(path,'INCAR'))
+    incar = read_incar(path)
     value = incar[tag]
     return value
 
@@ -51,49 +92,56 @@ def default_naming(path):
 
     return formula + '-' + directories[-2] + '-' + directories[-1]
 
-def replace_incar_tags(path, tag, value):
+def replace_incar_tags(path, tag, value, job=None, message=None):
     # called in get_job_name
-    incar = Incar.from_file(os.path.join(path, 'INCAR'))
+    incar = read_incar(path)
+    old = incar.get(tag)
     incar.__setitem__(tag, value)
-    incar.write_file(os.path.join(path, 'INCAR'))
+    with timer.phase('incar'):
+        incar.write_file(os.path.join(path, 'INCAR'))
+    log.emit('incar', message, job=job, path=path, tag=tag, old=old, value=value)
 
 def get_job_name(path):
     # called in get_single_job_name
-    if 'SYSTEM' in open(os.path.join(path, 'INCAR')).read():
+    with timer.phase('incar'):
+        timer.count('incar_reads')
+        with open(os.path.join(path, 'INCAR')) as f:
+            named = 'SYSTEM' in f.read()
+    if named:
         name = get_incar_value(path, 'SYSTEM')
         return str(name)
     else:
         name = default_naming(path)
-        replace_incar_tags(path, 'SYSTEM', name)
+        replace_incar_tags(path, 'SYSTEM', name, job=name)
         return str(name)
 
 def get_single_job_name(pwd):
     # called in driver
-    for root, dirs, files in os.walk(pwd):
+    for root, dirs, files in walk(pwd):
         for file in files:
             if file == 'POTCAR' and check_vasp_input(root) == True:
                 job_name = get_job_name(root)
     return job_name
 
 def jobs_in_queue():
-    # gets a dictionary of all jobs in user's slurm queue with their status
+    # gets a dictionary of all jobs in user's queue with their status
     # dict format: {job directory: job status}
+    # the scheduler (slurm, pbs or local) is picked with VASP_SCHEDULER, or from
+    # the computer name and its cluster profile as vasp.py does
     # called in not_in_queue
-    p = subprocess.Popen(['squeue' ,'-o', '"%Z %T"'], stdout=subprocess.PIPE)
-    #can be user specific, add -u username
-    jobs_running = []
-    line_count = 0
-    for line in p.stdout:
-        if line_count > 0:
-            line = str(line, 'utf-8').replace('"', '').split()
-            jobs_running.append((line[0], line[1])) # tuple is (directory, status)
-        line_count += 1
-    all_jobs_dict = {job[0]:job[1] for job in jobs_running}
-    return all_jobs_dict
+    timer.count('scheduler_queries')
+    return schedulers.get_scheduler(schedulers.computer_queue_type()).status()
 
 def not_in_queue(path):
     # called in vasp_run_main
-    all_jobs_dict = jobs_in_queue()
+    # jobs submitted with vasp.py --federate are queued on another cluster;
+    # federated_status syncs their results back once their cluster reports them finished
+    with timer.phase('scheduler'):
+        remote_status = federation.federated_status(path)
+        if remote_status is not None:
+            return remote_status
+
+        all_jobs_dict = jobs_in_queue()
 
     if path not in all_jobs_dict:
         # job is not in queue, return True to continue processing in  vasp_run_main
@@ -105,6 +153,16 @@ def not_in_queue(path):
         # job is in queue and has not completed, return status to print in vasp_run_main
         return all_jobs_dict[path]
 
+def parse_vasprun(path, job_name):
+    # called in is_converged and vasp_run_main. Compacted jobs only have vasprun.xml.gz
+    vasprun_path = compact.output_path(path, 'vasprun.xml')
+    with log.timed('parse', job=job_name, path=path) as parsed, timer.phase('vasprun'):
+        timer.count('vasprun_parses')
+        timer.count('bytes_parsed', os.path.getsize(vasprun_path))
+        V = Vasprun(vasprun_path)
+        parsed['converged'] = V.converged
+    return V
+
 def is_converged(path):
     '''
     Checks if a VASP job has converged. Return values are used to identify job type
@@ -137,53 +195,84 @@ def is_converged(path):
             # if INCAR stage number is less than max stage number, rerun job. If equal, check vasprun.xml for convergence.
             if current_stage_number < max_stage_number:
                 rerun = 'multi'    #RERUN JOB
-                print('Rerunning ' + job_name + ' stage ' + str(current_stage_number) + ' of ' + str(max_stage_number))
+                log.emit('decision', 'Rerunning ' + job_name + ' stage ' + str(current_stage_number) + ' of ' + str(max_stage_number),
+                         job=job_name, path=path, decision=rerun, stage=current_stage_number, max_stage=max_stage_number)
+            elif max_stage_number in stages.skipped_stages(path):
+                # the criteria of the final stage were met by the stages before it
+                rerun = 'converged'
+                log.emit('decision', job_name + ' skipped stage ' + str(max_stage_number) + ' of ' + str(max_stage_number),
+                         job=job_name, path=path, decision=rerun, stage=current_stage_number, max_stage=max_stage_number,
+                         reason='skipped')
             elif current_stage_number == max_stage_number:
-                V = Vasprun(os.path.join(path, 'vasprun.xml'))
+                V = parse_vasprun(path, job_name)
                 if V.converged != True:
                     if V.converged_electronic != True:
-                        replace_incar_tags(path, 'NELM', 500) #increase number of electronic steps
-                        print('Increased NELM to 500 max steps for electronic convergence.')
+                        replace_incar_tags(path, 'NELM', 500, job=job_name,
+                                           message='Increased NELM to 500 max steps for electronic convergence.') #increase number of electronic steps
                         rerun = 'multi'  #RERUN JOB
+                        message = None
                     elif V.converged_ionic != True and int(get_incar_value(path, 'NSW')) == 0:
-                        print(job_name + ' Assuming you do not want to resubmit job! Single point energy calculation: converged_electronic = TRUE, converged_ionic = FALSE')
+                        message = job_name + ' Assuming you do not want to resubmit job! Single point energy calculation: converged_electronic = TRUE, converged_ionic = FALSE'
                         rerun = 'converged'
                     else:
-                        print('Rerunning ' + job_name + ' stage ' + str(current_stage_number) + ' of ' + str(max_stage_number))
+                        message = 'Rerunning ' + job_name + ' stage ' + str(current_stage_number) + ' of ' + str(max_stage_number)
                         rerun = 'multi'  #RERUN JOB    Catch-all for all other errors
                 else:
-                    print(job_name + ' Complete and ready for post processing.') #Job complete. Can perform post processing (bader lobster bandstructure defects adsorbates etc.)
+                    message = job_name + ' Complete and ready for post processing.' #Job complete. Can perform post processing (bader lobster bandstructure defects adsorbates etc.)
                     rerun = 'converged'
+                log.emit('decision', message, job=job_name, path=path, decision=rerun,
+                         stage=current_stage_number, max_stage=max_stage_number)
             # elif 'IMAGES' in open(os.path.join(path,'INCAR')).read():
             #     print('DOES NOT HANDLE NEB YET')
             else:
                 # for jobs with no STAGE_NUMBER tag in INCAR, check vasprun.xml for convergence
-                V = Vasprun(os.path.join(path, 'vasprun.xml'))
+                V = parse_vasprun(path, job_name)
+                message = None
                 if V.converged != True:        #Job not converge
                     if V.converged_electronic != True:
-                        replace_incar_tags(path, 'NELM', 500) #increase number of electronic steps
-                        print('Increased NELM to 500 max steps for electronic convergence.')
+                        replace_incar_tags(path, 'NELM', 500, job=job_name,
+                                           message='Increased NELM to 500 max steps for electronic convergence.') #increase number of electronic steps
                         rerun = 'single'  #RERUN JOB
                     elif V.converged_ionic != True and int(get_incar_value(path, 'NSW')) == 0:
-                        print(job_name + ' Assuming you do not want to resubmit job!! Single point energy calculation: converged_electronic = TRUE, converged_ionic = FALSE')
+                        message = job_name + ' Assuming you do not want to resubmit job!! Single point energy calculation: converged_electronic = TRUE, converged_ionic = FALSE'
                         rerun = 'converged'
                     else:
                         rerun = 'single'  #RERUN JOB    Catch-all for all other errors
                 else:
-                    print(job_name + ' Complete and ready for post processing.') #Job has completed #post processing bader lobster bandstructure ect...
+                    message = job_name + ' Complete and ready for post processing.' #Job has completed #post processing bader lobster bandstructure ect...
                     rerun = 'converged'
+                log.emit('decision', message, job=job_name, path=path, decision=rerun)
 
             return rerun
 
 def rerun_job(job_type, job_name):
-    # called in vasp_run_main. Requires vasp.py to be in path
-    vasp_path = os.path.abspath(vasp.__file__)
-    if job_type == 'multi':
-        os.system(vasp_path + ' -m CONVERGENCE -n ' + job_name)
-    if job_type == 'single':
-        os.system(vasp_path + ' -n ' + job_name)
-    if job_type == 'multi_initial':
-        os.system(vasp_path + ' -m CONVERGENCE --init -n ' + job_name)
+    # called in vasp_run_main. Requires vasp.py to be executable (see setup.py)
+    # vasp.py is run as a script, so only its path is needed, not an import
+    vasp_path = os.path.join(os.path.dirname(os.path.abspath(vasp_run.__file__)), 'vasp.py')
+    if job_type not in ['multi', 'single', 'multi_initial']:
+        return
+    submitted = len(workflow_state.read_job_state('.')['submissions'])
+    start = perf_counter()
+    with timer.phase('submit'):
+        timer.count('subprocesses')
+        if job_type == 'multi':
+            status = os.system(vasp_path + ' -m CONVERGENCE -n ' + job_name)
+        if job_type == 'single':
+            status = os.system(vasp_path + ' -n ' + job_name)
+        if job_type == 'multi_initial':
+            status = os.system(vasp_path + ' -m CONVERGENCE --init -n ' + job_name)
+    duration = round(perf_counter() - start, 4)
+    # vasp.py records the job id and resources of the submission in job_state.json
+    submissions = workflow_state.read_job_state('.')['submissions']
+    if len(submissions) > submitted:
+        submission = dict(submissions[-1])
+        log.emit('submit', job=job_name, path=os.getcwd(), job_type=job_type, duration=duration,
+                 job_id=submission.pop('job_id'), submitted=submission.pop('submitted'),
+                 timings=submission.pop('timings', None), resources=submission)
+    else:
+        log.emit('error', job_name + ' vasp.py did not submit (exit status ' + str(status) + ')',
+                 job=job_name, path=os.getcwd(), during='submit', job_type=job_type,
+                 status=status, duration=duration)
 
 def store_data(vasprun_obj, job_name):
     # called in vasp_run_main
@@ -218,22 +307,39 @@ def vasp_run_main(pwd):
     # called in driver
     completed_jobs = {'PATHs': {}}
     computed_entries = []
-    for root, dirs, files in os.walk(pwd):
+    for root, dirs, files in walk(pwd):
+        dirs[:] = [d for d in dirs if d not in [probe.PROBE_DIR, backup_store.STORE_DIR, archive.ARCHIVE_DIR]]
         for file in files:
             if file == 'POTCAR':
                 if check_vasp_input(root) == True:
                     print('#********************************************#\n')
                     job_name = get_job_name(root)
+                    log.emit('discover', job=job_name, path=root)
                     if not_in_queue(root) == True:
                         # True = continue processing in vasp_run_main
                         # False = job is in queue and has not completed, print status for user
-                        if check_path_exists(os.path.join(root, 'vasprun.xml')):
+                        hangs = [e for e in workflow_state.recent_events(root) if e['event'].startswith('hang')]
+                        if hangs:
+                            abandoned = hangs[-1]['event'] == 'hang_abandoned'
+                            log.emit('hang', job_name + ' Hung ' + str(len(hangs)) + ' time(s) in its last run' +
+                                     (', gave up restarting it' if abandoned else ''),
+                                     job=job_name, path=root, hangs=len(hangs), abandoned=abandoned)
+                        resume = preempt.resume_pending(root)
+                        if resume is not None:
+                            # checkpointed on preemption or the walltime signal, not a failed run
+                            log.emit('decision', job_name + ' Resuming after ' + resume['signal'] + ' at stage ' + str(resume['stage']),
+                                     job=job_name, path=root, decision='resume', signal=resume['signal'], stage=resume['stage'])
+                            os.chdir(root)
+                            rerun_job('multi' if resume['stage'] is not None else 'single', job_name)
+                        elif check_path_exists(compact.output_path(root, 'vasprun.xml')):
                             try:
-                                V = Vasprun(os.path.join(root, 'vasprun.xml'))
+                                V = parse_vasprun(root, job_name)
                                 fizzled = False
                             except:
                                 # if vasprun.xml is corrupted, the job has failed. Attempt to resubmit job.
-                                print(root, '  Fizzled job, check errors! Attempting to resubmit...')
+                                # parse_vasprun logged the error
+                                log.emit('decision', root + '   Fizzled job, check errors! Attempting to resubmit...',
+                                         job=job_name, path=root, decision='fizzled')
                                 fizzled = True
                             if fizzled == False:
                                 os.chdir(root)
@@ -250,17 +356,40 @@ def vasp_run_main(pwd):
                                 job = fizzled_job(root)
                                 rerun_job(job, job_name)
                         elif check_path_exists(os.path.join(root, 'CONVERGENCE')):
-                            print(job_name + ' Initializing multi-step run.')
+                            log.emit('decision', job_name + ' Initializing multi-step run.',
+                                     job=job_name, path=root, decision='multi_initial')
                             os.chdir(root)
                             rerun_job('multi_initial', job_name)
                         else:
-                            print(job_name + ' Initializing run.')
+                            log.emit('decision', job_name + ' Initializing run.',
+                                     job=job_name, path=root, decision='initial')
                             os.chdir(root)
                             rerun_job('single', job_name)
                     else:
-                        print(job_name + ' Job in queue. Status: ' + not_in_queue(root))
+                        status = not_in_queue(root)
+                        log.emit('decision', job_name + ' Job in queue. Status: ' + status,
+                                 job=job_name, path=root, decision='in_queue', status=status)
+                        job_progress = progress.read_progress(root)
+                        if job_progress is not None:
+                            log.emit('progress', job_name + ' ' + progress.summary(job_progress),
+                                     job=job_name, path=root, progress=job_progress)
                     print('\n')
 
+    # archived jobs converged, their vasprun.xml is read straight from the archive
+    for (root, job_name) in sorted(archive.archived_jobs(pwd).items()):
+        try:
+            with archive.member_path(root, 'vasprun.xml') as vasprun_path, timer.phase('vasprun'):
+                timer.count('vasprun_parses')
+                timer.count('bytes_parsed', os.path.getsize(vasprun_path))
+                V = Vasprun(vasprun_path)
+        except Exception as e:
+            log.emit('error', job_name + ' Archived without a readable vasprun.xml, skipped.',
+                     job=job_name, path=root, during='archived', error=repr(e))
+            continue
+        log.emit('decision', job_name + ' Archived, converged.', job=job_name, path=root, decision='archived')
+        completed_jobs['PATHs'][str(root)] = str(job_name)
+        computed_entries.append(store_data(V, job_name))
+
     num_jobs_in_workflow = check_num_jobs_in_workflow(pwd)
     if num_jobs_in_workflow > 1:
         if not completed_jobs:
@@ -270,7 +399,7 @@ def vasp_run_main(pwd):
                 yaml.dump(completed_jobs, outfile, default_flow_style=False)
 
         if len(list(completed_jobs['PATHs'].keys())) == num_jobs_in_workflow:
-            print('\n  ALL JOBS HAVE CONVERGED!  \n')
+            log.emit('workflow_converged', '\n  ALL JOBS HAVE CONVERGED!  \n', jobs=num_jobs_in_workflow)
             # rewrite WORKFLOW_CONVERGENCE file to indicate that the workflow has fully converged
             with open(os.path.join(pwd, 'WORKFLOW_CONVERGENCE'), 'w') as f:
                 f.write('WORKFLOW_CONVERGED = True')
@@ -278,8 +407,20 @@ def vasp_run_main(pwd):
 
     return computed_entries
 
+def report_metrics(workflow_name, num_jobs_in_workflow, converged):
+    # called in driver. Prints where the sweep time went, logs it and exports it
+    # to the node_exporter textfile collector directory if VASP_METRICS_DIR is set
+    log.emit('metrics', 'Sweep profile\n' + timer.table(), workflow=workflow_name,
+             elapsed=round(timer.elapsed(), 4), phases=timer.as_dict(), counts=timer.counts)
+    if os.environ.get('VASP_METRICS_DIR'):
+        timing.write_textfile(os.environ['VASP_METRICS_DIR'], 'vasp_sweep_' + str(workflow_name),
+                              timer.prometheus('vasp_sweep', {'workflow': workflow_name},
+                                               {'jobs': num_jobs_in_workflow, 'converged_jobs': converged}))
+
 def driver():
     pwd = os.getcwd()
+    log.open(pwd)
+    timer.reset()
     num_jobs_in_workflow = check_num_jobs_in_workflow(pwd)
     
     # label the workflow as not converged at the start of the run, change after run
@@ -306,12 +447,23 @@ def driver():
         workflow_name = get_single_job_name(pwd)
 
     # need dependencies for vasp_run_main
-    computed_entries = vasp_run_main(pwd)
+    with log.timed('sweep', path=pwd, workflow=workflow_name, jobs=num_jobs_in_workflow) as sweep:
+        computed_entries = vasp_run_main(pwd)
+        sweep['converged'] = 0 if computed_entries is None else len(computed_entries)
     if computed_entries is None:
         pass
     else:
         with open(os.path.join(pwd, str(workflow_name) + '_converged.json'), 'w') as f:
             json.dump(computed_entries, f)
+    report_metrics(workflow_name, num_jobs_in_workflow, sweep['converged'])
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Checks every job of the workflow in the current directory, '
+                    'resubmits the unfinished ones and collects the converged ones')
+    parser.add_argument('--profile', nargs='?', const='sweep.prof', default=None, metavar='FILE',
+                        help='write a cProfile of the sweep to FILE (default sweep.prof)')
+    args = parser.parse_args()
+    if args.profile is not None:
+        timing.start_profile(os.path.abspath(args.profile))
     driver()